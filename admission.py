@@ -0,0 +1,194 @@
+"""
+Admission control for render requests: per-client token-bucket rate limits
+and CPU-time quotas.
+"""
+import math
+import threading
+import time
+from collections import deque
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to `capacity` tokens and refills at
+    `rate` tokens per second.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount=1):
+        """
+        Takes `amount` tokens if available. Returns (allowed, retry_after)
+        where retry_after is the number of seconds until enough tokens
+        will have accumulated.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True, 0
+        if self.rate <= 0:
+            return False, None
+        return False, (amount - self.tokens) / self.rate
+
+class RateLimiter:
+    """
+    Per-client rate limiter. Each client key (IP address or API key) gets
+    its own token bucket of `burst` tokens refilled at `per_minute` tokens
+    per minute. A per_minute of 0 disables the limit.
+    """
+
+    # Forget buckets of clients idle for this long (they are full again anyway)
+    IDLE_SECONDS = 3600
+
+    def __init__(self, per_minute, burst):
+        self.per_minute = per_minute
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._allowed = 0
+        self._limited = 0
+        self._last_prune = time.monotonic()
+
+    def _prune(self, now):
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        idle = [key for key, bucket in self._buckets.items()
+                if now - bucket.updated > self.IDLE_SECONDS]
+        for key in idle:
+            del self._buckets[key]
+
+    def check(self, client_key):
+        """
+        Counts one request for the client. Returns (allowed, retry_after)
+        with retry_after in whole seconds.
+        """
+        if not self.per_minute:
+            return True, 0
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            bucket = self._buckets.get(client_key)
+            if bucket is None:
+                bucket = TokenBucket(self.per_minute / 60.0, self.burst)
+                self._buckets[client_key] = bucket
+            allowed, retry_after = bucket.take()
+            if allowed:
+                self._allowed += 1
+                return True, 0
+            self._limited += 1
+            return False, max(1, math.ceil(retry_after))
+
+    def stats(self):
+        """
+        Returns a snapshot of the limiter's configuration and counters.
+        """
+        with self._lock:
+            return {
+                'per_minute': self.per_minute,
+                'burst': self.burst,
+                'clients': len(self._buckets),
+                'allowed': self._allowed,
+                'limited': self._limited,
+            }
+
+class CpuQuota:
+    """
+    Per-client quota on render CPU time. Each client may spend `budget`
+    CPU-seconds per rolling `window` seconds, and may borrow up to `burst`
+    more for a spike; borrowed time stays on the books for the whole
+    window, so the long-run average still converges to the budget.
+
+    `overrides` maps client keys to their own budget, e.g. for batch
+    customers. A budget of 0 disables the quota.
+    """
+
+    def __init__(self, budget, window, burst=0, overrides=None):
+        self.budget = budget
+        self.window = window
+        self.burst = burst
+        self.overrides = overrides or {}
+        # client key -> deque of (timestamp, cpu_seconds)
+        self._usage = {}
+        self._lock = threading.Lock()
+        self._charged = 0.0
+        self._limited = 0
+
+    def _budget_for(self, client_key):
+        return self.overrides.get(client_key, self.budget)
+
+    def _expire(self, charges, now):
+        while charges and charges[0][0] <= now - self.window:
+            charges.popleft()
+
+    def _used(self, client_key, now):
+        charges = self._usage.get(client_key)
+        if not charges:
+            return 0.0
+        self._expire(charges, now)
+        if not charges:
+            del self._usage[client_key]
+            return 0.0
+        return sum(cost for _, cost in charges)
+
+    def check(self, client_key):
+        """
+        Returns (allowed, retry_after): whether the client may start another
+        render now, and otherwise how many seconds until enough of its
+        usage has left the window.
+        """
+        budget = self._budget_for(client_key)
+        if not budget:
+            return True, 0
+        limit = budget + self.burst
+        with self._lock:
+            now = time.time()
+            used = self._used(client_key, now)
+            if used < limit:
+                return True, 0
+            self._limited += 1
+            # Find when enough old charges expire to bring usage under the limit
+            for timestamp, cost in self._usage[client_key]:
+                used -= cost
+                if used < limit:
+                    return False, max(1, math.ceil(timestamp + self.window - now))
+            return False, max(1, math.ceil(self.window))
+
+    def charge(self, client_key, cpu_seconds):
+        """
+        Records CPU time spent on the client's behalf.
+        """
+        if cpu_seconds <= 0:
+            return
+        with self._lock:
+            self._usage.setdefault(client_key, deque()).append((time.time(), cpu_seconds))
+            self._charged += cpu_seconds
+
+    def usage(self, client_key):
+        """
+        Returns the CPU-seconds the client has used in the current window.
+        """
+        with self._lock:
+            return self._used(client_key, time.time())
+
+    def stats(self):
+        """
+        Returns a snapshot of the quota's configuration and counters.
+        """
+        with self._lock:
+            return {
+                'budget': self.budget,
+                'window': self.window,
+                'burst': self.burst,
+                'clients': len(self._usage),
+                'cpu_seconds_charged': round(self._charged, 3),
+                'limited': self._limited,
+            }
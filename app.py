@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, redirect
 from flask_cors import CORS
 import os
 from PIL import Image, ImageDraw
@@ -7,7 +7,13 @@ import uuid
 import time
 from werkzeug.utils import secure_filename
 import sys
+import json
+import functools
+import select
+import socket
 import logging
+import threading
+import zipfile
 
 # Add compatibility for ANTIALIAS or LANCZOS
 try:
@@ -43,50 +49,6 @@ os.makedirs(videos_dir, exist_ok=True)
 logger.info(f"Videos directory: {videos_dir}")
 logger.info(f"Videos directory exists: {os.path.exists(videos_dir)}")
 
-# Add route for videos
-@app.route('/videos/<filename>')
-def serve_video(filename):
-    """
-    Serve video files from the videos directory.
-    """
-    try:
-        # Get the full path to the video file
-        file_path = os.path.join(videos_dir, filename)
-        logger.info(f"=== Video Request ===")
-        logger.info(f"Requested filename: {filename}")
-        logger.info(f"Full path: {file_path}")
-        
-        if not os.path.exists(file_path):
-            logger.error(f"File not found at path: {file_path}")
-            return jsonify({'error': 'File not found'}), 404
-            
-        # Serve the file with proper headers
-        response = send_file(
-            file_path,
-            mimetype='video/mp4',
-            as_attachment=False,
-            download_name=filename,
-            conditional=True,
-            max_age=0
-        )
-        
-        # Add CORS headers
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        
-        return response
-        
-    except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"=== Error Serving Video ===")
-        logger.error(f"Error: {str(e)}")
-        logger.error(error_details)
-        return jsonify({
-            'error': f'Failed to serve video: {str(e)}',
-            'details': error_details
-        }), 500
-
 # Add route for favicon
 @app.route('/favicon.ico')
 def favicon():
@@ -156,8 +118,379 @@ for file_path in required_files:
     else:
         print(f"Found required file: {file_path}")
 
-# Import the animation generation function after monkey patch
-from pepe_slash import create_slash_animation
+# Render jobs run on a pool of warm worker processes
+# Quality tier used when a request doesn't ask for one (see render_tiers.py)
+app.config['DEFAULT_RENDER_TIER'] = os.environ.get('DEFAULT_RENDER_TIER', 'hq')
+# Step down a tier while renders would wait longer than RENDER_DEGRADE_WAIT seconds
+# for a worker, and back up once the wait is under RENDER_RECOVER_WAIT
+app.config['RENDER_AUTO_DEGRADE'] = os.environ.get('RENDER_AUTO_DEGRADE', '1') == '1'
+app.config['RENDER_DEGRADE_WAIT'] = float(os.environ.get('RENDER_DEGRADE_WAIT', '20'))
+app.config['RENDER_RECOVER_WAIT'] = float(os.environ.get('RENDER_RECOVER_WAIT', '5'))
+from render_pool import RenderPool, MemoryBudgetExceeded, QueueFull, RenderCancelled
+from admission import RateLimiter, CpuQuota
+from render_cache import RenderCache, cache_key, frame_key
+from render_tiers import RENDER_TIERS, AdaptiveTierSelector, get_tier, tier_scale
+from render_jobs import JobRegistry
+from video_index import VideoIndex
+from storage import make_storage
+from video_cache import VideoMemoryCache
+from retention import ArtifactIndex, RetentionManager
+from render_batch import BatchRender
+from pepe_slash import load_profile_image, frame_index, POSTER_PROGRESS
+
+app.config['RENDER_WORKERS'] = int(os.environ.get('RENDER_WORKERS', '0')) or None
+# Recycle a worker after this many jobs, or once its RSS passes the watermark (MB)
+app.config['RENDER_MAX_JOBS_PER_WORKER'] = int(os.environ.get('RENDER_MAX_JOBS_PER_WORKER', '50'))
+app.config['RENDER_WORKER_MEMORY_LIMIT_MB'] = int(os.environ.get('RENDER_WORKER_MEMORY_LIMIT_MB', '1024'))
+# Total memory renders may use at once (MB); 0 means three quarters of physical memory
+app.config['RENDER_MEMORY_BUDGET_MB'] = int(os.environ.get('RENDER_MEMORY_BUDGET_MB', '0'))
+# How long a render may wait for memory before it is rejected (seconds)
+app.config['RENDER_MEMORY_WAIT'] = float(os.environ.get('RENDER_MEMORY_WAIT', '30'))
+# Longest a render may take, queueing included (seconds); clients can ask for
+# less with the X-Render-Timeout header
+app.config['RENDER_DEADLINE'] = float(os.environ.get('RENDER_DEADLINE', '120'))
+# Renders allowed to wait for a busy worker before /generate returns 503
+app.config['RENDER_QUEUE_DEPTH'] = int(os.environ.get('RENDER_QUEUE_DEPTH', '8'))
+# While every worker is busy, up to this many waiting renders of the same tier
+# are rendered together in one pass (1 disables it), gathered for up to this long (seconds)
+app.config['RENDER_BATCH_SIZE'] = int(os.environ.get('RENDER_BATCH_SIZE', '4'))
+app.config['RENDER_BATCH_WINDOW'] = float(os.environ.get('RENDER_BATCH_WINDOW', '0.05'))
+# Where the template is compiled for the render workers to memory-map (empty:
+# each worker prepares its own copy)
+app.config['TEMPLATE_BUNDLE_DIR'] = os.environ.get('TEMPLATE_BUNDLE_DIR', os.path.join(OUTPUT_FOLDER, 'templates'))
+# Processes that draw the frames of a render while no other render is in
+# flight, for boxes with more cores than render workers (0 disables it)
+app.config['RENDER_COMPOSITORS'] = int(os.environ.get('RENDER_COMPOSITORS', '0'))
+# Threads each render worker composites a frame with, in horizontal tiles (0 disables it)
+app.config['RENDER_TILE_THREADS'] = int(os.environ.get('RENDER_TILE_THREADS', '0'))
+# Drop frames that repeat the one before and show that one for longer instead
+# (variable frame rate MP4s; otherwise repeats are encoded as skipped frames)
+app.config['RENDER_VARIABLE_FRAME_RATE'] = os.environ.get('RENDER_VARIABLE_FRAME_RATE', '0') == '1'
+# Per-client /generate limit (0 disables it) and how many requests may burst at once
+app.config['RATE_LIMIT_PER_MINUTE'] = float(os.environ.get('RATE_LIMIT_PER_MINUTE', '6'))
+app.config['RATE_LIMIT_BURST'] = int(os.environ.get('RATE_LIMIT_BURST', '3'))
+# Per-client render CPU time: CPU-seconds per rolling window (0 disables it),
+# extra seconds a client may borrow for a burst, and per-client budget overrides
+app.config['CPU_QUOTA_SECONDS'] = float(os.environ.get('CPU_QUOTA_SECONDS', '900'))
+app.config['CPU_QUOTA_WINDOW'] = float(os.environ.get('CPU_QUOTA_WINDOW', '3600'))
+app.config['CPU_QUOTA_BURST'] = float(os.environ.get('CPU_QUOTA_BURST', '120'))
+app.config['CPU_QUOTA_OVERRIDES'] = json.loads(os.environ.get('CPU_QUOTA_OVERRIDES', '{}'))
+# CPU-seconds charged for a request answered from the render cache
+app.config['CPU_QUOTA_CACHE_HIT_COST'] = float(os.environ.get('CPU_QUOTA_CACHE_HIT_COST', '0'))
+# How long renders of X handles are reused (avatars change; uploads are keyed by content)
+app.config['RENDER_CACHE_HANDLE_TTL'] = int(os.environ.get('RENDER_CACHE_HANDLE_TTL', '3600'))
+
+# Videos get unique names and never change, so clients and CDNs may keep them (seconds)
+app.config['VIDEO_MAX_AGE'] = int(os.environ.get('VIDEO_MAX_AGE', str(365 * 24 * 3600)))
+
+# How video bytes are delivered: 'direct' (this process, zero-copy when the
+# WSGI server provides wsgi.file_wrapper), 'x-accel-redirect' (nginx serves
+# VIDEO_ACCEL_PREFIX/<filename> from an internal location) or 'x-sendfile'
+# (Apache mod_xsendfile, lighttpd)
+app.config['VIDEO_DELIVERY'] = os.environ.get('VIDEO_DELIVERY', 'direct')
+app.config['VIDEO_ACCEL_PREFIX'] = os.environ.get('VIDEO_ACCEL_PREFIX', '/protected-videos')
+if app.config['VIDEO_DELIVERY'] not in ('direct', 'x-accel-redirect', 'x-sendfile'):
+    raise ValueError(f"Unknown VIDEO_DELIVERY '{app.config['VIDEO_DELIVERY']}', "
+                     f"expected direct, x-accel-redirect or x-sendfile")
+
+# Memory for the bytes of recently rendered or watched videos (MB, 0 disables
+# it) and the largest video kept there (KB)
+app.config['VIDEO_MEMORY_CACHE_MB'] = int(os.environ.get('VIDEO_MEMORY_CACHE_MB', '64'))
+app.config['VIDEO_MEMORY_CACHE_ITEM_KB'] = int(os.environ.get('VIDEO_MEMORY_CACHE_ITEM_KB', '2048'))
+
+video_cache = VideoMemoryCache(
+    app.config['VIDEO_MEMORY_CACHE_MB'] * 1024 * 1024,
+    app.config['VIDEO_MEMORY_CACHE_ITEM_KB'] * 1024
+)
+# Retention of rendered videos and uploads: total size (MB), age (hours),
+# and free disk space to keep (evict down to RETENTION_MIN_FREE_MB, then
+# keep evicting until RETENTION_TARGET_FREE_MB is free); 0 disables a limit
+app.config['RETENTION_DB'] = os.environ.get('RETENTION_DB', os.path.join(OUTPUT_FOLDER, 'artifacts.sqlite3'))
+app.config['RETENTION_MAX_MB'] = int(os.environ.get('RETENTION_MAX_MB', '10240'))
+app.config['RETENTION_MAX_AGE_HOURS'] = float(os.environ.get('RETENTION_MAX_AGE_HOURS', '24'))
+app.config['RETENTION_MIN_FREE_MB'] = int(os.environ.get('RETENTION_MIN_FREE_MB', '1024'))
+app.config['RETENTION_TARGET_FREE_MB'] = int(os.environ.get('RETENTION_TARGET_FREE_MB', '2048'))
+app.config['RETENTION_INTERVAL'] = float(os.environ.get('RETENTION_INTERVAL', '60'))
+
+# Where videos, cached avatars and render cache records are stored: 'local'
+# disk, or a 'shared' directory mounted on every app node (STORAGE_ROOT).
+# Without a root, videos go to static/videos and the rest under outputs/
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+app.config['STORAGE_ROOT'] = os.environ.get('STORAGE_ROOT', '')
+# How long a fetched avatar is reused (seconds)
+app.config['AVATAR_CACHE_TTL'] = int(os.environ.get('AVATAR_CACHE_TTL', '3600'))
+
+# Batch renders (/generate/batch): most items per batch, how many avatars
+# are fetched at once, and how many renders a batch keeps in flight
+# (0: one per render worker, so interactive requests still get through)
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', '100'))
+app.config['BATCH_AVATAR_CONCURRENCY'] = int(os.environ.get('BATCH_AVATAR_CONCURRENCY', '8'))
+app.config['BATCH_RENDER_WINDOW'] = int(os.environ.get('BATCH_RENDER_WINDOW', '0'))
+
+if app.config['STORAGE_ROOT']:
+    storage_roots = {name: os.path.join(app.config['STORAGE_ROOT'], name)
+                     for name in ('videos', 'avatars', 'render-cache', 'frames')}
+else:
+    storage_roots = {
+        'videos': videos_dir,
+        'avatars': os.path.join(OUTPUT_FOLDER, 'avatars'),
+        'render-cache': os.path.join(OUTPUT_FOLDER, 'render-cache'),
+        'frames': os.path.join(OUTPUT_FOLDER, 'frames'),
+    }
+# Videos live in a hash-sharded tree (see storage.py)
+video_store = make_storage(app.config['STORAGE_BACKEND'], storage_roots['videos'])
+# Batches prefetch avatars into the cache the render workers read from
+avatar_store = make_storage(app.config['STORAGE_BACKEND'], storage_roots['avatars'],
+                            on_put=lambda path, size: retention.add(path, 'avatar', size))
+# Posters and single frames (see /frame), named after their render's cache key
+frame_store = make_storage(app.config['STORAGE_BACKEND'], storage_roots['frames'])
+
+render_pool = RenderPool(
+    'pepe_chainsaw.jpg',
+    max_workers=app.config['RENDER_WORKERS'],
+    max_jobs_per_worker=app.config['RENDER_MAX_JOBS_PER_WORKER'],
+    worker_memory_limit=app.config['RENDER_WORKER_MEMORY_LIMIT_MB'] * 1024 * 1024,
+    memory_budget=(app.config['RENDER_MEMORY_BUDGET_MB'] * 1024 * 1024) or None,
+    max_queue=app.config['RENDER_QUEUE_DEPTH'],
+    batch_size=app.config['RENDER_BATCH_SIZE'],
+    batch_window=app.config['RENDER_BATCH_WINDOW'],
+    template_bundle_dir=app.config['TEMPLATE_BUNDLE_DIR'] or None,
+    compositors=app.config['RENDER_COMPOSITORS'],
+    tile_threads=app.config['RENDER_TILE_THREADS'],
+    variable_frame_rate=app.config['RENDER_VARIABLE_FRAME_RATE'],
+    # Workers record the avatars they cache for retention
+    artifact_db=app.config['RETENTION_DB'],
+    # Finished renders come back with their bytes to warm the video cache
+    return_video_bytes=app.config['VIDEO_MEMORY_CACHE_ITEM_KB'] * 1024 if app.config['VIDEO_MEMORY_CACHE_MB'] else 0,
+    video_storage=(app.config['STORAGE_BACKEND'], storage_roots['videos']),
+    avatar_storage=(app.config['STORAGE_BACKEND'], storage_roots['avatars']),
+    avatar_max_age=app.config['AVATAR_CACHE_TTL']
+)
+rate_limiter = RateLimiter(app.config['RATE_LIMIT_PER_MINUTE'], app.config['RATE_LIMIT_BURST'])
+cpu_quota = CpuQuota(
+    app.config['CPU_QUOTA_SECONDS'],
+    app.config['CPU_QUOTA_WINDOW'],
+    burst=app.config['CPU_QUOTA_BURST'],
+    overrides=app.config['CPU_QUOTA_OVERRIDES']
+)
+# Render cache records are stored next to the videos, so nodes share hits
+render_cache = RenderCache(
+    storage=make_storage(app.config['STORAGE_BACKEND'], storage_roots['render-cache'],
+                         on_put=lambda path, size: retention.add(path, 'render-cache', size)),
+    videos=video_store
+)
+tier_selector = AdaptiveTierSelector(
+    degrade_wait=app.config['RENDER_DEGRADE_WAIT'],
+    recover_wait=app.config['RENDER_RECOVER_WAIT'],
+    enabled=app.config['RENDER_AUTO_DEGRADE']
+)
+render_jobs = JobRegistry()
+video_index = VideoIndex(video_store)
+
+def forget_artifact(path, render_key):
+    """Drop a deleted artifact from the in-memory indexes"""
+    filename = os.path.basename(path)
+    video_index.discard(filename)
+    video_cache.discard(filename)
+    if render_key:
+        render_cache.discard(render_key)
+
+retention = RetentionManager(
+    ArtifactIndex(app.config['RETENTION_DB']),
+    max_bytes=app.config['RETENTION_MAX_MB'] * 1024 * 1024,
+    max_age=app.config['RETENTION_MAX_AGE_HOURS'] * 3600,
+    disk_path=video_store.root,
+    min_free_bytes=app.config['RETENTION_MIN_FREE_MB'] * 1024 * 1024,
+    target_free_bytes=app.config['RETENTION_TARGET_FREE_MB'] * 1024 * 1024,
+    interval=app.config['RETENTION_INTERVAL'],
+    on_evict=forget_artifact
+)
+
+@app.before_request
+def start_retention():
+    # Started from the first request so it runs in the serving process only
+    # (not in the debug reloader's watcher); files from before the index
+    # existed are picked up once. Shared storage is written by every node
+    # and each node only evicts what it wrote itself, so it isn't adopted.
+    adopt = [(UPLOAD_FOLDER, 'upload')]
+    if app.config['STORAGE_BACKEND'] != 'shared':
+        adopt += [(video_store.root, 'video'), (avatar_store.root, 'avatar'),
+                  (storage_roots['render-cache'], 'render-cache'), (frame_store.root, 'frame')]
+    retention.start(adopt=adopt)
+
+def request_deadline():
+    """Absolute deadline (time.time()) for the render started by this request"""
+    timeout = app.config['RENDER_DEADLINE']
+    try:
+        requested = float(request.headers.get('X-Render-Timeout', timeout))
+        if requested > 0:
+            timeout = min(timeout, requested)
+    except ValueError:
+        pass
+    return time.time() + timeout
+
+def client_disconnected(environ):
+    """
+    Checks whether the client behind a request has closed its connection.
+    Only works on servers that expose the socket (werkzeug, gunicorn);
+    elsewhere it always returns False.
+    """
+    sock = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A readable socket with nothing to read has been closed by the peer
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+def request_option(name, default=None):
+    """Read an option from the form fields (uploads), the JSON body or the query string"""
+    value = request.form.get(name)
+    if value is None:
+        value = (request.get_json(silent=True) or {}).get(name)
+    if value is None:
+        value = request.args.get(name)
+    return default if value is None else value
+
+def request_flag(name):
+    """Read a boolean option sent as JSON true/false or a form string"""
+    value = request_option(name, False)
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def publish_video(output_path, result, render_key=None):
+    """
+    Make a finished render servable, with the validators its worker computed
+    and, for small videos, its bytes already in memory for the first views.
+    The video is handed to the retention manager from here on.
+    """
+    video_index.add(output_path, **result['video'])
+    retention.add(output_path, 'video', result['video']['size'], cache_key=render_key)
+    if result.get('video_bytes') is not None:
+        video_cache.put(os.path.basename(output_path), result['video_bytes'])
+    if result.get('poster') is not None and render_key:
+        # Captured while rendering, so /frame never renders or decodes it
+        store_frame(render_key, result['poster_frame'], result['poster'])
+
+def store_frame(render_key, frame, image):
+    """Keep a JPEG of one frame of a render for /frame requests"""
+    path = frame_store.put_bytes(f"{frame_key(render_key, frame)}.jpg", image)
+    if path is not None:
+        retention.add(path, 'frame', len(image))
+
+def finish_background_render(future, job_id, client, render_key, output_path, cache_ttl):
+    """
+    Done-callback of a render that keeps going after the response was sent:
+    charges its CPU time and publishes the result to the job registry.
+    """
+    if future.cancelled():
+        render_jobs.update(job_id, status='failed', error='Render cancelled')
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Background render {job_id} failed: {str(error)}")
+        render_jobs.update(job_id, status='failed', error=str(error))
+        return
+    result = future.result()
+    cpu_quota.charge(client, result['cpu_seconds'])
+    publish_video(output_path, result, render_key)
+    render_cache.put(render_key, output_path, ttl=cache_ttl)
+    render_jobs.update(job_id, status='done', video_url=f'/videos/{os.path.basename(output_path)}')
+    logger.info(f"Background render {job_id} finished: {output_path}")
+
+def too_many_requests(error, retry_after):
+    """429 response asking the client to come back in retry_after seconds"""
+    response = jsonify({
+        'error': error,
+        'details': f'Retry in {retry_after} seconds'
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def server_busy(e, retry_after):
+    """503 response for a render the pool could not take on"""
+    response = jsonify({
+        'error': 'Server is too busy to render right now, please try again later',
+        'details': str(e)
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+def client_key():
+    """Identify the client by API key when one is sent, otherwise by IP address"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return f"key:{api_key}"
+    return f"ip:{request.remote_addr}"
+
+def save_upload(profile_file):
+    """Save an uploaded image to the uploads folder and return its path"""
+    # Secure the filename and save the file
+    filename = secure_filename(profile_file.filename)
+    timestamp = int(time.time())
+    unique_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{filename}"
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    
+    # Check if upload directory exists
+    upload_dir = os.path.dirname(file_path)
+    if not os.path.exists(upload_dir):
+        logger.warning(f"Creating upload directory: {upload_dir}")
+        os.makedirs(upload_dir, exist_ok=True)
+    
+    profile_file.save(file_path)
+    retention.add(file_path, 'upload', os.path.getsize(file_path))
+    logger.info(f"Saved uploaded file to: {file_path}")
+    logger.info(f"File size: {os.path.getsize(file_path)} bytes")
+    return file_path
+
+def read_profile_source(save=True):
+    """
+    Reads the profile to render from the request: an uploaded image (saved
+    to the uploads folder) or an X handle. Returns ((profile_source,
+    source_type, x_handle), None), or (None, error response) for bad input.
+    With save=False an upload is returned as its file object instead, for
+    the caller to save_upload() only if it has to render it.
+    """
+    # Check if form data with file upload
+    if request.files and 'profile_image' in request.files:
+        profile_file = request.files['profile_image']
+        logger.info(f"Received file upload: {profile_file.filename}")
+        logger.info(f"File content type: {profile_file.content_type}")
+        
+        # If no file selected
+        if profile_file.filename == '':
+            logger.error("No file selected")
+            return None, (jsonify({'error': 'No file selected'}), 400)
+        
+        # If file is valid
+        if profile_file and allowed_file(profile_file.filename):
+            # Use the uploaded file for animation
+            profile_source = save_upload(profile_file) if save else profile_file
+            source_type = "uploaded_image"
+            x_handle = None
+        else:
+            logger.error("Invalid file type")
+            return None, (jsonify({'error': 'File type not allowed. Please upload a PNG, JPG, JPEG, or GIF'}), 400)
+    else:
+        # Check for JSON data (or a query parameter) with X handle
+        x_handle = (request_option('x_handle') or '').strip()
+        logger.info(f"Received X handle: {x_handle}")
+        
+        # Validate X handle
+        if not x_handle:
+            logger.error("No X handle provided")
+            return None, (jsonify({'error': 'Either an X handle or an image upload is required'}), 400)
+        if x_handle.startswith('@'):
+            x_handle = x_handle[1:]  # Remove @ if present
+        
+        # Use X handle for animation
+        profile_source = x_handle
+        source_type = "x_handle"
+    
+    return (profile_source, source_type, x_handle), None
 
 def allowed_file(filename):
     """Check if the file extension is allowed"""
@@ -175,74 +508,73 @@ def generate_animation():
     Accepts either an X handle or an uploaded image.
     """
     try:
+        # The deadline covers the whole request, queueing included
+        deadline = request_deadline()
+        environ = request.environ
+        
+        # Rate limit before doing any work for this request
+        client = client_key()
+        allowed, retry_after = rate_limiter.check(client)
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for {client}")
+            return too_many_requests('Too many requests, please slow down', retry_after)
+        
         logger.info("=== Starting animation generation ===")
         logger.info(f"Request headers: {dict(request.headers)}")
-        logger.info(f"Request data: {request.get_json()}")
+        logger.info(f"Request data: {request.get_json(silent=True)}")
         logger.info(f"Request form: {dict(request.form)}")
         logger.info(f"Request files: {dict(request.files)}")
         
-        # Check if form data with file upload
-        if request.files and 'profile_image' in request.files:
-            profile_file = request.files['profile_image']
-            logger.info(f"Received file upload: {profile_file.filename}")
-            logger.info(f"File content type: {profile_file.content_type}")
-            
-            # If no file selected
-            if profile_file.filename == '':
-                logger.error("No file selected")
-                return jsonify({'error': 'No file selected'}), 400
-                
-            # If file is valid
-            if profile_file and allowed_file(profile_file.filename):
-                # Secure the filename and save the file
-                filename = secure_filename(profile_file.filename)
-                timestamp = int(time.time())
-                unique_filename = f"{timestamp}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                
-                # Check if upload directory exists
-                upload_dir = os.path.dirname(file_path)
-                if not os.path.exists(upload_dir):
-                    logger.warning(f"Creating upload directory: {upload_dir}")
-                    os.makedirs(upload_dir, exist_ok=True)
-                
-                profile_file.save(file_path)
-                logger.info(f"Saved uploaded file to: {file_path}")
-                logger.info(f"File size: {os.path.getsize(file_path)} bytes")
-                logger.info(f"File exists: {os.path.exists(file_path)}")
-                
-                # Use the uploaded file for animation
-                profile_source = file_path
-                source_type = "uploaded_image"
-            else:
-                logger.error("Invalid file type")
-                return jsonify({'error': 'File type not allowed. Please upload a PNG, JPG, JPEG, or GIF'}), 400
-        else:
-            # Check for JSON data with X handle
-            data = request.get_json() or {}
-            x_handle = data.get('x_handle', '').strip()
-            logger.info(f"Received X handle: {x_handle}")
-            
-            # Validate X handle
-            if not x_handle:
-                logger.error("No X handle provided")
-                return jsonify({'error': 'Either an X handle or an image upload is required'}), 400
-            if x_handle.startswith('@'):
-                x_handle = x_handle[1:]  # Remove @ if present
-            
-            # Use X handle for animation
-            profile_source = x_handle
-            source_type = "x_handle"
+        source, error = read_profile_source()
+        if error:
+            return error
+        profile_source, source_type, x_handle = source
+        
+        # Pick the quality tier (preview, standard, hq)
+        quality = request_option('quality') or app.config['DEFAULT_RENDER_TIER']
+        if quality not in RENDER_TIERS:
+            logger.error(f"Unknown quality tier: {quality}")
+            return jsonify({'error': f"Unknown quality '{quality}', expected one of: {', '.join(RENDER_TIERS)}"}), 400
         
         # Get Pepe image path
         pepe_image_path = os.path.join('pepe_chainsaw.jpg')
         logger.info(f"Using Pepe image: {pepe_image_path}")
         logger.info(f"Pepe image exists: {os.path.exists(pepe_image_path)}")
         
+        # Repeat requests are answered from the render cache and are (nearly) free
+        render_key = cache_key(profile_source, source_type, pepe_image_path, duration=5.0, quality=quality)
+        cached_path = render_cache.get(render_key)
+        if cached_path:
+            logger.info(f"Render cache hit: {cached_path}")
+            retention.touch(cached_path)
+            cpu_quota.charge(client, app.config['CPU_QUOTA_CACHE_HIT_COST'])
+            return jsonify({
+                'success': True,
+                'source': x_handle,
+                'source_type': source_type,
+                'video_url': f'/videos/{os.path.basename(cached_path)}',
+                'quality': quality,
+                'requested_quality': quality,
+                'cached': True
+            })
+        
+        # Renders are charged by the CPU time they actually use
+        allowed, retry_after = cpu_quota.check(client)
+        if not allowed:
+            logger.warning(f"CPU quota exceeded for {client}: {cpu_quota.usage(client):.1f}s used")
+            return too_many_requests('Render quota exceeded, please try again later', retry_after)
+        
+        # Under load, render a cheaper tier rather than make the client wait
+        requested_quality = quality
+        quality = tier_selector.choose(requested_quality, render_pool.expected_wait())
+        if quality != requested_quality:
+            logger.info(f"Render queue is backed up, rendering {quality} instead of {requested_quality}")
+            render_key = cache_key(profile_source, source_type, pepe_image_path, duration=5.0, quality=quality)
+        
         # Create unique output filename
         output_filename = f"pepe_slash_{uuid.uuid4()}.mp4"
         # Save in videos subdirectory of static for proper serving
-        output_path = os.path.join(videos_dir, output_filename)
+        output_path = video_store.path_for(output_filename)
         logger.info(f"Creating animation at: {output_path}")
         logger.info(f"Absolute output path: {os.path.abspath(output_path)}")
         logger.info(f"Videos directory exists: {os.path.exists(videos_dir)}")
@@ -255,11 +587,6 @@ def generate_animation():
                 'details': f'Could not find or create videos directory: {videos_dir}'
             }), 500
             
-        # Generate the animation
-        create_slash_animation(profile_source, pepe_image_path, output_path, duration=5.0)
-        logger.info(f"Animation generated successfully: {output_path}")
-        logger.info(f"Output file exists: {os.path.exists(output_path)}")
-        
         # Check output directory permissions
         if os.path.exists(OUTPUT_FOLDER):
             logger.info(f"Output directory permissions: {oct(os.stat(OUTPUT_FOLDER).st_mode)}")
@@ -294,8 +621,71 @@ def generate_animation():
                 'details': f'Could not find Pepe image at {pepe_image_path}'
             }), 500
             
-        create_slash_animation(profile_source, pepe_image_path, output_path, duration=5.0)
+        cache_ttl = app.config['RENDER_CACHE_HANDLE_TTL'] if source_type == 'x_handle' else None
+        
+        # Progressive delivery: answer with a fast preview and keep the full
+        # quality render going in the background
+        progressive = request_flag('progressive') and quality != 'preview'
+        job_id = None
+        
+        try:
+            if progressive:
+                preview_filename = f"pepe_slash_{uuid.uuid4()}.mp4"
+                preview_path = video_store.path_for(preview_filename)
+                preview_future = render_pool.submit(profile_source, preview_path, duration=5.0,
+                                                    timeout=app.config['RENDER_MEMORY_WAIT'],
+                                                    deadline=deadline, tier='preview')
+                try:
+                    # The full render isn't tied to this request, so it gets a deadline of its own
+                    full_future = render_pool.submit(profile_source, output_path, duration=5.0,
+                                                     timeout=app.config['RENDER_MEMORY_WAIT'],
+                                                     deadline=time.time() + app.config['RENDER_DEADLINE'],
+                                                     tier=quality)
+                except Exception:
+                    render_pool.cancel(preview_future)
+                    raise
+                job_id = render_jobs.create(status='rendering', quality=quality)
+                full_future.add_done_callback(
+                    functools.partial(finish_background_render, job_id=job_id, client=client,
+                                      render_key=render_key, output_path=output_path, cache_ttl=cache_ttl))
+                try:
+                    result = render_pool.wait(preview_future, deadline=deadline,
+                                              abandoned=lambda: client_disconnected(environ))
+                except RenderCancelled:
+                    render_pool.cancel(full_future)
+                    raise
+                # From here on the response is about the preview
+                render_key = cache_key(profile_source, source_type, pepe_image_path, duration=5.0,
+                                       quality='preview')
+                render_cache.put(render_key, preview_path, ttl=cache_ttl)
+                output_filename = preview_filename
+                output_path = preview_path
+            else:
+                result = render_pool.render(profile_source, output_path, duration=5.0,
+                                            timeout=app.config['RENDER_MEMORY_WAIT'],
+                                            deadline=deadline,
+                                            abandoned=lambda: client_disconnected(environ),
+                                            tier=quality)
+        except QueueFull as e:
+            logger.error(f"Render queue full: {str(e)}")
+            return server_busy(e, e.retry_after)
+        except RenderCancelled as e:
+            logger.warning(f"Render cancelled: {str(e)}")
+            if time.time() > deadline:
+                return jsonify({
+                    'error': 'Rendering took too long, please try again later',
+                    'details': str(e)
+                }), 504
+            # Nobody is listening any more; 499 is what nginx logs for this
+            return jsonify({'error': str(e)}), 499
+        except MemoryBudgetExceeded as e:
+            logger.error(f"Render rejected: {str(e)}")
+            return server_busy(e, render_pool.retry_after())
         logger.info(f"Animation generated successfully: {output_path}")
+        logger.info(f"Render memory: {result['memory']}")
+        logger.info(f"Render CPU time: {result['cpu_seconds']:.2f}s")
+        cpu_quota.charge(client, result['cpu_seconds'])
+        publish_video(output_path, result, render_key)
         logger.info(f"Output file exists: {os.path.exists(output_path)}")
         
         # Return the video URL
@@ -310,11 +700,31 @@ def generate_animation():
                 'details': f'Video file not found at: {output_path}'
             }), 500
         
+        if job_id:
+            # The full render is still going; the client polls job_url for it
+            return jsonify({
+                'success': True,
+                'source': x_handle,
+                'source_type': source_type,
+                'video_url': video_url,
+                'quality': 'preview',
+                'requested_quality': requested_quality,
+                'full_quality': quality,
+                'job_id': job_id,
+                'job_url': f'/jobs/{job_id}',
+                'cached': False
+            })
+        
+        render_cache.put(render_key, output_path, ttl=cache_ttl)
+        
         return jsonify({
             'success': True,
             'source': x_handle,
             'source_type': source_type,
-            'video_url': video_url
+            'video_url': video_url,
+            'quality': quality,
+            'requested_quality': requested_quality,
+            'cached': False
         })
         
     except Exception as e:
@@ -325,86 +735,547 @@ def generate_animation():
             'details': traceback.format_exc()
         }), 500
 
-@app.route('/videos/<filename>', methods=['GET'])
-def download_file(filename):
+@app.route('/generate/stream', methods=['GET', 'POST'])
+def stream_animation():
     """
-    Endpoint to serve the generated video file.
+    Endpoint to watch a Pepe slash animation while it renders.
+    Takes the same input as /generate (an X handle can also be passed as a
+    query parameter) and answers with a fragmented MP4 that is sent as the
+    frames are encoded. The finished file is published at X-Video-Url.
     """
     try:
-        # Get the full path to the video file
-        file_path = os.path.join(app.static_folder, 'videos', filename)
-        logger.info(f"=== Video Request ===")
-        logger.info(f"Requested filename: {filename}")
-        logger.info(f"Full path: {file_path}")
-        logger.info(f"File exists: {os.path.exists(file_path)}")
-        
-        if not os.path.exists(file_path):
-            logger.error(f"File not found at path: {file_path}")
-            return jsonify({'error': 'File not found'}), 404
-            
-        # Serve the file with proper headers
-        response = send_file(
-            file_path,
-            mimetype='video/mp4',
-            as_attachment=False,
-            download_name=filename,
-            conditional=True,
-            max_age=0
-        )
+        deadline = request_deadline()
+        environ = request.environ
         
-        # Add CORS headers
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        client = client_key()
+        allowed, retry_after = rate_limiter.check(client)
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for {client}")
+            return too_many_requests('Too many requests, please slow down', retry_after)
+        
+        source, error = read_profile_source()
+        if error:
+            return error
+        profile_source, source_type, x_handle = source
+        
+        quality = request_option('quality') or app.config['DEFAULT_RENDER_TIER']
+        if quality not in RENDER_TIERS:
+            logger.error(f"Unknown quality tier: {quality}")
+            return jsonify({'error': f"Unknown quality '{quality}', expected one of: {', '.join(RENDER_TIERS)}"}), 400
+        
+        pepe_image_path = 'pepe_chainsaw.jpg'
         
+        # A finished render is already a faststart MP4, nothing to stream
+        render_key = cache_key(profile_source, source_type, pepe_image_path, duration=5.0, quality=quality)
+        cached_path = render_cache.get(render_key)
+        if cached_path:
+            logger.info(f"Render cache hit: {cached_path}")
+            retention.touch(cached_path)
+            cpu_quota.charge(client, app.config['CPU_QUOTA_CACHE_HIT_COST'])
+            return redirect(f'/videos/{os.path.basename(cached_path)}')
+        
+        allowed, retry_after = cpu_quota.check(client)
+        if not allowed:
+            logger.warning(f"CPU quota exceeded for {client}: {cpu_quota.usage(client):.1f}s used")
+            return too_many_requests('Render quota exceeded, please try again later', retry_after)
+        
+        requested_quality = quality
+        quality = tier_selector.choose(requested_quality, render_pool.expected_wait())
+        if quality != requested_quality:
+            logger.info(f"Render queue is backed up, rendering {quality} instead of {requested_quality}")
+            render_key = cache_key(profile_source, source_type, pepe_image_path, duration=5.0, quality=quality)
+        
+        output_filename = f"pepe_slash_{uuid.uuid4()}.mp4"
+        output_path = video_store.path_for(output_filename)
+        cache_ttl = app.config['RENDER_CACHE_HANDLE_TTL'] if source_type == 'x_handle' else None
+        
+        try:
+            future = render_pool.submit(profile_source, output_path, duration=5.0,
+                                        timeout=app.config['RENDER_MEMORY_WAIT'],
+                                        deadline=deadline, tier=quality, stream=True)
+            # The finished file is charged and cached like any other render
+            job_id = render_jobs.create(status='rendering', quality=quality)
+            future.add_done_callback(
+                functools.partial(finish_background_render, job_id=job_id, client=client,
+                                  render_key=render_key, output_path=output_path, cache_ttl=cache_ttl))
+            chunks = render_pool.iter_stream(future, deadline=deadline,
+                                             abandoned=lambda: client_disconnected(environ))
+            # Wait for the MP4 header before committing to a 200, so a render
+            # that fails to start still gets a proper error
+            first_chunk = next(chunks, b'')
+        except QueueFull as e:
+            logger.error(f"Render queue full: {str(e)}")
+            return server_busy(e, e.retry_after)
+        except RenderCancelled as e:
+            logger.warning(f"Render cancelled: {str(e)}")
+            if time.time() > deadline:
+                return jsonify({
+                    'error': 'Rendering took too long, please try again later',
+                    'details': str(e)
+                }), 504
+            return jsonify({'error': str(e)}), 499
+        except MemoryBudgetExceeded as e:
+            logger.error(f"Render rejected: {str(e)}")
+            return server_busy(e, render_pool.retry_after())
+        
+        def stream_body():
+            yield first_chunk
+            try:
+                yield from chunks
+            except Exception as e:
+                # Headers are gone already; all we can do is end the stream
+                logger.error(f"Streaming render {job_id} failed: {str(e)}")
+        
+        response = Response(stream_body(), mimetype='video/mp4')
+        response.headers['Cache-Control'] = 'no-store'
+        # Don't let a reverse proxy buffer the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.headers['X-Video-Url'] = f'/videos/{output_filename}'
+        response.headers['X-Job-Id'] = job_id
+        response.headers['X-Render-Quality'] = quality
+        response.headers['Access-Control-Expose-Headers'] = 'X-Video-Url, X-Job-Id, X-Render-Quality'
         return response
         
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"=== Error Serving Video ===")
-        logger.error(f"Error: {str(e)}")
-        logger.error(error_details)
+        logger.error(f"Error during animation streaming: {str(e)}")
+        logger.error(traceback.format_exc())
         return jsonify({
-            'error': f'Failed to serve video: {str(e)}',
-            'details': error_details
+            'error': f'Failed to generate animation: {str(e)}',
+            'details': traceback.format_exc()
         }), 500
+
+@app.route('/frame', methods=['GET', 'POST'])
+def render_single_frame():
     """
-    Endpoint to serve the generated video file.
+    Endpoint returning one frame of an animation as a JPEG, for posters,
+    share thumbnails and scrubbing. Takes the same input as /generate plus
+    `t`, the time in seconds (default: the poster frame). Only that frame
+    is rendered, and it is cached under its render's cache key; finished
+    renders leave their poster there, so it is served without rendering.
     """
     try:
-        file_path = os.path.join(app.static_folder, filename)
-        print(f"=== Download Request ===")
-        print(f"Requested filename: {filename}")
-        print(f"Full path: {file_path}")
-        print(f"File exists: {os.path.exists(file_path)}")
-        
-        if not os.path.exists(file_path):
-            print(f"File not found at path: {file_path}")
-            return jsonify({'error': 'File not found'}), 404
-            
-        # Get file details
-        file_size = os.path.getsize(file_path)
-        mod_time = os.path.getmtime(file_path)
-        print(f"File size: {file_size} bytes")
-        print(f"File modified: {time.ctime(mod_time)}")
+        deadline = request_deadline()
+        environ = request.environ
         
-        # Check if file is readable
+        client = client_key()
+        allowed, retry_after = rate_limiter.check(client)
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for {client}")
+            return too_many_requests('Too many requests, please slow down', retry_after)
+        
+        # Uploads are keyed by their contents and only saved if the frame
+        # isn't cached yet
+        source, error = read_profile_source(save=False)
+        if error:
+            return error
+        profile_source, source_type, x_handle = source
+        
+        quality = request_option('quality') or app.config['DEFAULT_RENDER_TIER']
+        if quality not in RENDER_TIERS:
+            logger.error(f"Unknown quality tier: {quality}")
+            return jsonify({'error': f"Unknown quality '{quality}', expected one of: {', '.join(RENDER_TIERS)}"}), 400
         try:
-            with open(file_path, 'rb') as f:
-                f.read(1)  # Read first byte to verify file is readable
-        except Exception as e:
-            print(f"Error reading file: {str(e)}")
-            return jsonify({'error': f'Cannot read file: {str(e)}'}), 500
-        
-        # Serve the file with proper headers
-        response = send_file(
-            file_path,
+            t = float(request_option('t', 5.0 * POSTER_PROGRESS))
+        except (TypeError, ValueError):
+            return jsonify({'error': 't must be a time in seconds'}), 400
+        
+        pepe_image_path = 'pepe_chainsaw.jpg'
+        render_key = cache_key(profile_source, source_type, pepe_image_path, duration=5.0, quality=quality)
+        frame = frame_index(t, 5.0, get_tier(quality)['fps'])
+        cache_ttl = app.config['RENDER_CACHE_HANDLE_TTL'] if source_type == 'x_handle' else None
+        
+        image = frame_store.get_bytes(f"{frame_key(render_key, frame)}.jpg", max_age=cache_ttl)
+        if image is not None:
+            logger.info(f"Frame cache hit: frame {frame} of {render_key}")
+            cpu_quota.charge(client, app.config['CPU_QUOTA_CACHE_HIT_COST'])
+        else:
+            allowed, retry_after = cpu_quota.check(client)
+            if not allowed:
+                logger.warning(f"CPU quota exceeded for {client}: {cpu_quota.usage(client):.1f}s used")
+                return too_many_requests('Render quota exceeded, please try again later', retry_after)
+            if source_type == 'uploaded_image':
+                profile_source = save_upload(profile_source)
+            try:
+                result = render_pool.render_frame(profile_source, t, duration=5.0, deadline=deadline,
+                                                  abandoned=lambda: client_disconnected(environ),
+                                                  tier=quality)
+            except QueueFull as e:
+                logger.error(f"Render queue full: {str(e)}")
+                return server_busy(e, e.retry_after)
+            except RenderCancelled as e:
+                logger.warning(f"Frame render cancelled: {str(e)}")
+                if time.time() > deadline:
+                    return jsonify({
+                        'error': 'Rendering took too long, please try again later',
+                        'details': str(e)
+                    }), 504
+                return jsonify({'error': str(e)}), 499
+            cpu_quota.charge(client, result['cpu_seconds'])
+            image = result['image']
+            store_frame(render_key, result['frame'], image)
+        
+        response = Response(image, mimetype='image/jpeg')
+        response.cache_control.public = True
+        response.cache_control.max_age = cache_ttl or app.config['VIDEO_MAX_AGE']
+        response.headers['X-Frame-Index'] = str(frame)
+        response.headers['Access-Control-Expose-Headers'] = 'X-Frame-Index'
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error during frame rendering: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({
+            'error': f'Failed to render frame: {str(e)}',
+            'details': traceback.format_exc()
+        }), 500
+
+def read_batch_sources():
+    """
+    Reads the profiles of a batch from the request: uploaded images
+    (profile_images) and/or X handles (a JSON list, or one per line or
+    comma separated in a form field). Returns (items, None), or
+    (None, error response) for bad input.
+    """
+    handles = request_option('handles') or []
+    if isinstance(handles, str):
+        handles = handles.replace(',', '\n').splitlines()
+    if not isinstance(handles, list):
+        return None, (jsonify({'error': 'handles must be a list of X handles'}), 400)
+    handles = [str(handle).strip().lstrip('@') for handle in handles]
+    handles = [handle for handle in handles if handle]
+    uploads = [f for f in request.files.getlist('profile_images') if f.filename]
+    
+    if not handles and not uploads:
+        return None, (jsonify({'error': 'A list of X handles or image uploads is required'}), 400)
+    if len(handles) + len(uploads) > app.config['BATCH_MAX_ITEMS']:
+        return None, (jsonify({'error': f"A batch can have at most {app.config['BATCH_MAX_ITEMS']} items"}), 400)
+    for profile_file in uploads:
+        if not allowed_file(profile_file.filename):
+            return None, (jsonify({'error': f'File type not allowed: {profile_file.filename}. '
+                                            'Please upload PNG, JPG, JPEG, or GIF images'}), 400)
+    
+    items = [{'profile_source': save_upload(f), 'source_type': 'uploaded_image',
+              'source': secure_filename(f.filename)} for f in uploads]
+    items += [{'profile_source': handle, 'source_type': 'x_handle', 'source': handle}
+              for handle in handles]
+    return items, None
+
+def batch_manifest(items):
+    """Public per-item status of a batch, in request order"""
+    manifest = []
+    for index, item in enumerate(items):
+        entry = {'index': index, 'source': item['source'], 'source_type': item['source_type'],
+                 'status': item['status']}
+        if item['status'] == 'done':
+            entry['video_url'] = f"/videos/{os.path.basename(item['output_path'])}"
+            entry['cached'] = item.get('cached', False)
+        elif item['status'] == 'failed':
+            entry['error'] = item.get('error')
+        manifest.append(entry)
+    return manifest
+
+def update_batch_job(job_id, items):
+    """Publish a batch's progress to the job registry"""
+    done = sum(1 for item in items if item['status'] == 'done')
+    failed = sum(1 for item in items if item['status'] == 'failed')
+    render_jobs.update(job_id, completed=done, failed=failed, items=batch_manifest(items),
+                       status='rendering' if done + failed < len(items) else 'done')
+
+def finish_batch_item(item, client):
+    """Charge, publish and cache a batch item whose render just finished"""
+    if item['status'] != 'done' or item.get('cached'):
+        return
+    result = item.pop('result')
+    cpu_quota.charge(client, result['cpu_seconds'])
+    publish_video(item['output_path'], result, item['render_key'])
+    cache_ttl = app.config['RENDER_CACHE_HANDLE_TTL'] if item['source_type'] == 'x_handle' else None
+    render_cache.put(item['render_key'], item['output_path'], ttl=cache_ttl)
+
+def zip_entry_name(index, item):
+    """Name of a batch item's video inside the zip"""
+    label = secure_filename(os.path.splitext(item['source'])[0]) or 'video'
+    return f"{index + 1:03d}_{label}.mp4"
+
+class ZipStream:
+    """
+    Write-only file object that collects what zipfile writes, so a zip can
+    be sent while it is being built. zipfile notices it can't seek and
+    writes sizes after each entry instead of before it.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    """
+    Endpoint to render a batch of Pepe slash animations.
+    Accepts a list of X handles and/or several uploaded images. Avatars are
+    fetched a few at a time while the renders are spread over the render
+    workers. By default it answers right away with a job to poll at
+    /jobs/<job_id> (per item status and video URLs); with format=zip the
+    videos are streamed back as a zip as they finish.
+    """
+    try:
+        client = client_key()
+        # A batch is one request to the rate limiter; its renders are
+        # charged to the CPU quota one by one
+        allowed, retry_after = rate_limiter.check(client)
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for {client}")
+            return too_many_requests('Too many requests, please slow down', retry_after)
+        
+        output_format = request_option('format', 'manifest')
+        if output_format not in ('manifest', 'zip'):
+            return jsonify({'error': f"Unknown format '{output_format}', expected manifest or zip"}), 400
+        # Batches aren't waited on interactively, so they are never degraded
+        quality = request_option('quality') or app.config['DEFAULT_RENDER_TIER']
+        if quality not in RENDER_TIERS:
+            logger.error(f"Unknown quality tier: {quality}")
+            return jsonify({'error': f"Unknown quality '{quality}', expected one of: {', '.join(RENDER_TIERS)}"}), 400
+        
+        items, error = read_batch_sources()
+        if error:
+            return error
+        
+        allowed, retry_after = cpu_quota.check(client)
+        if not allowed:
+            logger.warning(f"CPU quota exceeded for {client}: {cpu_quota.usage(client):.1f}s used")
+            return too_many_requests('Render quota exceeded, please try again later', retry_after)
+        
+        pepe_image_path = 'pepe_chainsaw.jpg'
+        for index, item in enumerate(items):
+            item['index'] = index
+            item['render_key'] = cache_key(item['profile_source'], item['source_type'], pepe_image_path,
+                                           duration=5.0, quality=quality)
+            cached_path = render_cache.get(item['render_key'])
+            if cached_path:
+                retention.touch(cached_path)
+                cpu_quota.charge(client, app.config['CPU_QUOTA_CACHE_HIT_COST'])
+                item.update(status='done', cached=True, output_path=cached_path)
+            else:
+                item.update(status='queued', output_path=video_store.path_for(f"pepe_slash_{uuid.uuid4()}.mp4"))
+        
+        # Workers look avatars up in the shared cache, so fetching them here
+        # (concurrently) takes the network wait out of the render
+        avatar_size = int(500 * tier_scale(get_tier(quality)))
+        
+        def prefetch(item):
+            if item['source_type'] == 'x_handle':
+                load_profile_image(item['profile_source'], (avatar_size, avatar_size),
+                                   avatar_cache=avatar_store, max_age=app.config['AVATAR_CACHE_TTL'])
+        
+        def admit(item):
+            if not cpu_quota.check(client)[0]:
+                return 'Render quota exceeded'
+            return None
+        
+        job_id = render_jobs.create(status='rendering', kind='batch', quality=quality, total=len(items),
+                                    completed=0, failed=0, items=batch_manifest(items))
+        batch = BatchRender(render_pool, items, tier=quality, duration=5.0,
+                            window=app.config['BATCH_RENDER_WINDOW'] or None,
+                            item_timeout=app.config['RENDER_DEADLINE'],
+                            prefetch=prefetch, prefetch_concurrency=app.config['BATCH_AVATAR_CONCURRENCY'],
+                            admit=admit, on_update=lambda item: update_batch_job(job_id, items))
+        logger.info(f"Batch {job_id}: {len(items)} items at {quality} quality")
+        
+        if output_format == 'manifest':
+            def run_batch():
+                try:
+                    for item in batch:
+                        finish_batch_item(item, client)
+                        update_batch_job(job_id, items)
+                except Exception as e:
+                    logger.error(f"Batch {job_id} failed: {str(e)}")
+                    logger.error(traceback.format_exc())
+                update_batch_job(job_id, items)
+                logger.info(f"Batch {job_id} finished")
+            
+            threading.Thread(target=run_batch, name=f'batch-{job_id}', daemon=True).start()
+            return jsonify({
+                'success': True,
+                'job_id': job_id,
+                'job_url': f'/jobs/{job_id}',
+                'quality': quality,
+                'total': len(items),
+                'items': batch_manifest(items)
+            }), 202
+        
+        def stream_zip():
+            out = ZipStream()
+            finished = iter(batch)
+            try:
+                # Videos are already compressed; store them as they are
+                with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as archive:
+                    for item in finished:
+                        finish_batch_item(item, client)
+                        update_batch_job(job_id, items)
+                        if item['status'] != 'done':
+                            continue
+                        with open(item['output_path'], 'rb') as video, \
+                                archive.open(zip_entry_name(item['index'], item), 'w') as entry:
+                            while True:
+                                data = video.read(1024 * 1024)
+                                if not data:
+                                    break
+                                entry.write(data)
+                                yield out.drain()
+                        yield out.drain()
+                    archive.writestr('manifest.json', json.dumps(batch_manifest(items), indent=2))
+                yield out.drain()
+            finally:
+                # Stops the batch if the client goes away
+                finished.close()
+                update_batch_job(job_id, items)
+        
+        response = Response(stream_zip(), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="pepe_slash_batch_{job_id}.zip"'
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.headers['X-Job-Id'] = job_id
+        response.headers['Access-Control-Expose-Headers'] = 'X-Job-Id'
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error during batch generation: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({
+            'error': f'Failed to generate batch: {str(e)}',
+            'details': traceback.format_exc()
+        }), 500
+
+def requested_range(entry):
+    """
+    The part of a video this request asks for, as (start, stop, status).
+    Returns None for a range past the end of the file.
+    """
+    size = entry['size']
+    if_range = request.if_range
+    if request.range and (not (if_range.etag or if_range.date) or if_range.etag == entry['etag']):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return None
+        return byte_range[0], byte_range[1], 206
+    return 0, size, 200
+
+def range_not_satisfiable(entry):
+    """416 response for a range past the end of a video"""
+    response = Response(status=416)
+    response.headers['Content-Range'] = f"bytes */{entry['size']}"
+    return response
+
+def with_range_headers(response, entry, start, stop):
+    """Adds the length, range and validator headers of a video response"""
+    response.content_length = stop - start
+    if response.status_code == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{entry['size']}"
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(entry['etag'])
+    response.last_modified = entry['mtime']
+    return response
+
+def video_file_response(entry, filename):
+    """
+    Response carrying the bytes of an indexed video. Recent videos are sent
+    from memory; others are delivered according to VIDEO_DELIVERY: handed
+    to the front proxy (x-accel-redirect, x-sendfile) or sent by this
+    process, zero-copy where the server supports it.
+    """
+    mode = app.config['VIDEO_DELIVERY']
+    data = video_cache.get(filename)
+    if data is None and mode == 'direct' and video_cache.accepts(entry['size']):
+        # Keep videos that are being watched; the next views come from memory
+        with open(entry['path'], 'rb') as f:
+            data = f.read()
+        video_cache.put(filename, data)
+    if data is not None:
+        byte_range = requested_range(entry)
+        if byte_range is None:
+            return range_not_satisfiable(entry)
+        start, stop, status = byte_range
+        response = Response(data[start:stop], status=status, mimetype='video/mp4')
+        return with_range_headers(response, entry, start, stop)
+    
+    if mode in ('x-accel-redirect', 'x-sendfile'):
+        # The proxy sends the file and takes care of Range requests
+        response = Response(mimetype='video/mp4')
+        if mode == 'x-accel-redirect':
+            relative_path = os.path.relpath(entry['path'], video_store.root).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = f"{app.config['VIDEO_ACCEL_PREFIX'].rstrip('/')}/{relative_path}"
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(entry['path'])
+        response.set_etag(entry['etag'])
+        response.last_modified = entry['mtime']
+        return response
+    
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is None:
+        # No zero-copy support in this server (e.g. the development server)
+        return send_file(
+            entry['path'],
             mimetype='video/mp4',
             as_attachment=False,
             download_name=filename,
             conditional=True,
-            max_age=0
+            etag=entry['etag'],
+            last_modified=entry['mtime']
         )
+    
+    # Servers like gunicorn sendfile() a wrapped file from its current
+    # offset for Content-Length bytes, so ranges are seeked to rather than
+    # sliced in Python (which is what send_file does)
+    byte_range = requested_range(entry)
+    if byte_range is None:
+        return range_not_satisfiable(entry)
+    start, stop, status = byte_range
+    f = open(entry['path'], 'rb')
+    f.seek(start)
+    response = Response(file_wrapper(f), status=status, mimetype='video/mp4', direct_passthrough=True)
+    return with_range_headers(response, entry, start, stop)
+
+@app.route('/videos/<filename>')
+def serve_video(filename):
+    """
+    Serve video files from the videos directory.
+    Files never change once rendered, so they are cached for good; the
+    strong ETag comes from the video index, and revalidations are answered
+    without touching the filesystem.
+    """
+    try:
+        entry = video_index.lookup(filename)
+        if entry is None:
+            logger.error(f"Video not found: {filename}")
+            return jsonify({'error': 'File not found'}), 404
+        
+        retention.touch(entry['path'])
+        if request.if_none_match.contains(entry['etag']):
+            response = Response(status=304)
+            response.set_etag(entry['etag'])
+        else:
+            try:
+                response = video_file_response(entry, filename)
+            except FileNotFoundError:
+                # Deleted since it was indexed, e.g. evicted by another node
+                # sharing the storage
+                logger.warning(f"Video deleted: {filename}")
+                video_index.discard(filename)
+                video_cache.discard(filename)
+                return jsonify({'error': 'File not found'}), 404
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['VIDEO_MAX_AGE']
+        response.cache_control.immutable = True
         
         # Add CORS headers
         response.headers['Access-Control-Allow-Origin'] = '*'
@@ -415,36 +1286,50 @@ def download_file(filename):
         
     except Exception as e:
         error_details = traceback.format_exc()
-        print(f"=== Error Serving File ===")
-        print(f"Error: {str(e)}")
-        print(error_details)
+        logger.error(f"=== Error Serving Video ===")
+        logger.error(f"Error: {str(e)}")
+        logger.error(error_details)
         return jsonify({
-            'error': f'Failed to serve file: {str(e)}',
+            'error': f'Failed to serve video: {str(e)}',
             'details': error_details
         }), 500
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Endpoint to poll a background render (e.g. the full render behind a preview).
+    """
+    job = render_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/metrics')
+def metrics():
+    """
+    Endpoint exposing render pool and admission control state.
+    """
+    return jsonify({
+        'render_pool': render_pool.stats(),
+        'rate_limit': rate_limiter.stats(),
+        'cpu_quota': cpu_quota.stats(),
+        'render_cache': render_cache.stats(),
+        'render_tiers': tier_selector.stats(),
+        'render_jobs': render_jobs.stats(),
+        'video_index': video_index.stats(),
+        'video_cache': video_cache.stats(),
+        'retention': retention.stats(),
+        'storage': video_store.stats()
+    })
+
 @app.route('/cleanup', methods=['POST'])
 def cleanup_files():
     """
-    Endpoint to clean up old files (can be called periodically).
+    Endpoint to apply the retention limits right away instead of waiting
+    for the retention manager's next run.
     """
     try:
-        # Get current time
-        current_time = time.time()
-        # Files older than 24 hours will be deleted
-        max_age = 24 * 60 * 60
-        
-        # Clean up uploads folder
-        files_removed = 0
-        for folder in [UPLOAD_FOLDER, OUTPUT_FOLDER]:
-            for filename in os.listdir(folder):
-                file_path = os.path.join(folder, filename)
-                if os.path.isfile(file_path):
-                    # Check file age
-                    file_age = current_time - os.path.getmtime(file_path)
-                    if file_age > max_age:
-                        os.remove(file_path)
-                        files_removed += 1        
+        files_removed = retention.run_once()
         return jsonify({
             'success': True,
             'message': f'Cleanup completed. {files_removed} files removed.'
@@ -459,5 +1344,10 @@ def cleanup_files():
         }), 500
 
 if __name__ == "__main__":
+    # Warm up the render workers before taking traffic (only in the process
+    # that serves requests, not in the debug reloader's watcher process)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        render_pool.start()
+    
     # Run the Flask app
     app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,276 @@
+"""
+Thin ffmpeg pipe writer used to encode rendered frames.
+
+Unlike moviepy's writer it can be aborted: the ffmpeg process is killed
+straight away instead of being left to flush the frames it has buffered.
+
+Finished files get their moov atom at the front (+faststart) so players can
+start before the download completes. When streaming, ffmpeg additionally
+writes a fragmented MP4 of the same encode to stdout, one fragment per GOP.
+"""
+import os
+import re
+import queue
+import logging
+import threading
+import functools
+import subprocess as sp
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def get_ffmpeg_binary():
+    """
+    Returns the ffmpeg binary to encode with: $FFMPEG_BINARY if set,
+    otherwise the one bundled with imageio-ffmpeg.
+    """
+    binary = os.environ.get('FFMPEG_BINARY')
+    if binary:
+        return binary
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_version(binary):
+    """
+    Returns the (major, minor) version of an ffmpeg binary, or None if it
+    can't be told (e.g. a git snapshot build, which counts as recent).
+    """
+    try:
+        result = sp.run([binary, '-version'], capture_output=True, text=True, timeout=30)
+    except (OSError, sp.SubprocessError) as e:
+        logger.warning(f"Could not get the ffmpeg version: {str(e)}")
+        return None
+    # "ffmpeg version 4.4.2-0ubuntu0.22.04.1 ..." or "ffmpeg version n5.1.2 ..."
+    match = re.match(r'ffmpeg version n?(\d+)\.(\d+)', result.stdout)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def vfr_options(binary):
+    """
+    Returns the options for variable frame rate output: -fps_mode only
+    exists since ffmpeg 5.1, older builds take -vsync.
+    """
+    version = ffmpeg_version(binary)
+    if version is not None and version < (5, 1):
+        return ['-vsync', 'vfr']
+    return ['-fps_mode', 'vfr']
+
+def tee_escape(path):
+    """
+    Escapes a file name for use as a slave of ffmpeg's tee muxer.
+    """
+    for char in '\\:|[]':
+        path = path.replace(char, '\\' + char)
+    return path
+
+class FfmpegWriter:
+    """
+    Writes RGB frames (or RGBA, with pix_fmt='rgba'; ffmpeg drops the
+    alpha) to a video file through an ffmpeg subprocess.
+
+    Used as a context manager the writer is closed normally when the block
+    succeeds and aborted when it raises.
+
+    If `on_data` is given, it is called from a reader thread with chunks of
+    a fragmented MP4 (frag_keyframe+empty_moov) as ffmpeg produces them,
+    while the file at output_path is written as usual.
+
+    With queue_frames > 0, write_frame() only queues the frame (blocking
+    while queue_frames are already waiting) and a writer thread feeds
+    ffmpeg, so the caller renders the next frames while ffmpeg encodes.
+    Errors of the writer thread are raised by the next write_frame() or
+    close().
+
+    With variable_frame_rate, frames that exactly repeat the one before are
+    dropped by ffmpeg and the previous frame gets their duration (a raw
+    pipe carries no timestamps, so the repeats are still written). Repeats
+    at the very end of the video are dropped without being made up for.
+    """
+
+    # Fragmented MP4 that a browser can play while it is still being written
+    STREAM_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+    # Drops a frame only if no block of it differs from the last one kept
+    DROP_REPEATS_FILTER = 'mpdecimate=hi=0:lo=0:frac=0'
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, output_path, size, fps, codec='libx264', preset='medium',
+                 ffmpeg_params=None, threads=None, on_data=None, pix_fmt='rgb24', queue_frames=0,
+                 variable_frame_rate=False):
+        self.output_path = output_path
+        self.size = size
+        self.on_data = on_data
+        self.pix_fmt = pix_fmt
+        self._reader = None
+        self._queue = None
+        self._writer = None
+        self._write_error = None
+        width, height = size
+        binary = get_ffmpeg_binary()
+        cmd = [
+            binary, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo',
+            '-s', f'{width}x{height}', '-pix_fmt', pix_fmt, '-r', f'{fps:.02f}',
+            '-an', '-i', '-',
+            '-vcodec', codec,
+        ]
+        if preset:
+            cmd += ['-preset', preset]
+        if threads:
+            cmd += ['-threads', str(threads)]
+        if ffmpeg_params:
+            cmd += list(ffmpeg_params)
+        if variable_frame_rate:
+            cmd += ['-vf', self.DROP_REPEATS_FILTER] + vfr_options(binary)
+        # Most players can only decode 4:2:0 H.264
+        cmd += ['-pix_fmt', 'yuv420p']
+        if on_data is None:
+            cmd += ['-movflags', '+faststart', output_path]
+        else:
+            # Encode once, mux twice: fragments to stdout, a regular file to
+            # disk. The tee muxer needs the codec headers out of band.
+            cmd += ['-flags', '+global_header', '-map', '0:v', '-f', 'tee',
+                    f'[f=mp4:movflags={self.STREAM_MOVFLAGS}]pipe\\:1|'
+                    f'[f=mp4:movflags=+faststart]file\\:{tee_escape(output_path)}']
+
+        popen_params = {'stdin': sp.PIPE, 'stdout': sp.DEVNULL, 'stderr': sp.PIPE}
+        if on_data is not None:
+            popen_params['stdout'] = sp.PIPE
+        if os.name == 'nt':
+            # Don't open a console window for ffmpeg
+            popen_params['creationflags'] = 0x08000000
+        self.proc = sp.Popen(cmd, **popen_params)
+        if on_data is not None:
+            self._reader = threading.Thread(target=self._read_stream, args=(self.proc.stdout,),
+                                            daemon=True)
+            self._reader.start()
+        if queue_frames:
+            self._queue = queue.Queue(maxsize=queue_frames)
+            self._writer = threading.Thread(target=self._write_frames, daemon=True)
+            self._writer.start()
+
+    def _read_stream(self, stdout):
+        # os.read returns whatever is in the pipe, so fragments are passed on
+        # as soon as ffmpeg flushes them rather than once a full buffer fills
+        fd = stdout.fileno()
+        while True:
+            chunk = os.read(fd, self.STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            try:
+                self.on_data(chunk)
+            except Exception as e:
+                logger.warning(f"Dropping stream of {self.output_path}: {e}")
+                # Keep draining stdout so ffmpeg never blocks on it
+                self.on_data = lambda chunk: None
+        stdout.close()
+
+    def _write(self, frame):
+        proc = self.proc
+        if proc is None:
+            raise IOError(f"Encoding of {self.output_path} was aborted")
+        try:
+            # Written from the array's own memory (e.g. a shared-memory slot)
+            proc.stdin.write(np.ascontiguousarray(frame).data)
+        except (BrokenPipeError, OSError) as e:
+            error = proc.stderr.read().decode('utf-8', errors='replace')
+            raise IOError(f"ffmpeg stopped while encoding {self.output_path}: {error or e}")
+
+    def _write_frames(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            frame, done = item
+            try:
+                # After an error, keep taking frames so the producer never
+                # blocks on a dead writer
+                if self._write_error is None:
+                    self._write(frame)
+            except Exception as e:
+                self._write_error = e
+            finally:
+                if done is not None:
+                    done(frame)
+
+    def write_frame(self, frame, done=None):
+        """
+        Sends one frame (a PIL image or an HxWx3 uint8 array, HxWx4 for
+        rgba) to ffmpeg. A queued array is copied first, so the caller may
+        reuse it straight away, unless `done` is given: then the writer
+        keeps the array itself and calls done(frame) once it no longer
+        needs it (also if the frame is never written).
+        """
+        if isinstance(frame, np.ndarray):
+            if self._queue is not None and done is None:
+                frame = frame.copy()
+        else:
+            mode = 'RGBA' if self.pix_fmt == 'rgba' else 'RGB'
+            if frame.mode != mode:
+                frame = frame.convert(mode)
+            frame = np.asarray(frame)
+        if self._queue is None or self._write_error is not None:
+            try:
+                if self._write_error is not None:
+                    raise self._write_error
+                self._write(frame)
+            finally:
+                if done is not None:
+                    done(frame)
+            return
+        self._queue.put((frame, done))
+
+    def _stop_writer(self):
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def close(self):
+        """
+        Finishes the file and waits for ffmpeg to exit.
+        """
+        if self.proc is None:
+            return
+        # Let the writer thread hand over the frames still queued
+        self._stop_writer()
+        if self._write_error is not None:
+            self.abort()
+            raise self._write_error
+        proc, self.proc = self.proc, None
+        proc.stdin.close()
+        if self._reader is not None:
+            self._reader.join()
+        error = proc.stderr.read()
+        proc.wait()
+        if proc.returncode:
+            raise IOError(f"ffmpeg failed to encode {self.output_path}: "
+                          f"{error.decode('utf-8', errors='replace')}")
+
+    def abort(self):
+        """
+        Kills ffmpeg without finishing the file and removes what it wrote.
+        """
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        proc.kill()
+        # The writer fails on the dead pipe (or on the missing process) and drains the queue
+        self._stop_writer()
+        if self._reader is not None:
+            self._reader.join()
+        proc.communicate()
+        try:
+            os.remove(self.output_path)
+        except OSError:
+            pass
+        logger.info(f"Aborted encoding of {self.output_path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
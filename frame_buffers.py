@@ -0,0 +1,146 @@
+"""
+Reusable frame buffers.
+
+A render draws every frame into a full-canvas buffer and hands it to the
+encoder; allocating a new one per frame costs a page-faulting multi-MB
+allocation each time. BufferPool keeps the buffers a render is done with
+so the next frame (and, with the pool kept in the template, the next
+render) reuses them. A buffer with several holders (e.g. a frame sent to
+the encoder more than once) goes back through a SharedBuffer.
+
+Every buffer a pool has to create is counted, and reported to allocation
+hooks, so steady-state renders can be checked for large allocations.
+"""
+import threading
+
+import numpy as np
+from PIL import Image
+
+_stats_lock = threading.Lock()
+_stats = {'allocations': 0, 'allocated_bytes': 0, 'reuses': 0}
+_allocation_hooks = []
+
+def add_allocation_hook(hook):
+    """
+    Calls hook(kind, shape, nbytes) whenever a pool has to create a buffer
+    ('array' with its shape, or 'image' with its (mode, size)).
+    """
+    _allocation_hooks.append(hook)
+
+def remove_allocation_hook(hook):
+    _allocation_hooks.remove(hook)
+
+def allocation_stats():
+    """Buffers created and reused by all pools of this process so far"""
+    with _stats_lock:
+        return dict(_stats)
+
+def _count_allocation(kind, shape, nbytes):
+    with _stats_lock:
+        _stats['allocations'] += 1
+        _stats['allocated_bytes'] += nbytes
+    for hook in list(_allocation_hooks):
+        hook(kind, shape, nbytes)
+
+def _count_reuse():
+    with _stats_lock:
+        _stats['reuses'] += 1
+
+class BufferPool:
+    """
+    Free lists of uint8 arrays (by shape) and PIL images (by mode and
+    size). take() returns a buffer with undefined contents; give() puts it
+    back for reuse. At most max_free buffers of each kind are kept.
+    Thread-safe, since encoder threads give frames back.
+    """
+
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def _take(self, key):
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                buffer = free.pop()
+            else:
+                buffer = None
+        if buffer is not None:
+            _count_reuse()
+        return buffer
+
+    def _give(self, key, buffer):
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) < self.max_free:
+                free.append(buffer)
+
+    def take(self, shape):
+        shape = tuple(shape)
+        array = self._take(('array', shape))
+        if array is None:
+            array = np.empty(shape, dtype=np.uint8)
+            _count_allocation('array', shape, array.nbytes)
+        return array
+
+    def give(self, array):
+        self._give(('array', array.shape), array)
+
+    def take_image(self, mode, size):
+        image = self._take(('image', mode, size))
+        if image is None:
+            image = Image.new(mode, size)
+            _count_allocation('image', (mode, size), size[0] * size[1] * len(image.getbands()))
+        return image
+
+    def give_image(self, image):
+        self._give(('image', image.mode, image.size), image)
+
+    def take_shared(self, shape):
+        """take() wrapped in a SharedBuffer held once by the caller"""
+        return SharedBuffer(self, self.take(shape))
+
+    def give_after(self, array, count):
+        """
+        Returns a callback that gives `array` back once it has been called
+        `count` times, e.g. once each of several encoders is done with its
+        part of a batch of frames.
+        """
+        remaining = [count]
+        lock = threading.Lock()
+
+        def done(_=None):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.give(array)
+        return done
+
+class SharedBuffer:
+    """
+    An array from a BufferPool with a count of its holders. Each retain()
+    is matched by a release(); the last release gives the array back to
+    the pool.
+    """
+
+    def __init__(self, pool, array):
+        self.pool = pool
+        self.array = array
+        self._holders = 1
+        self._lock = threading.Lock()
+
+    def retain(self):
+        """Adds a holder and returns the array"""
+        with self._lock:
+            self._holders += 1
+        return self.array
+
+    def release(self, _=None):
+        """Drops a holder; usable as an encoder's done callback"""
+        with self._lock:
+            self._holders -= 1
+            last = self._holders == 0
+        if last:
+            self.pool.give(self.array)
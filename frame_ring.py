@@ -0,0 +1,181 @@
+"""
+Shared-memory frame ring for compositing frames in several processes.
+
+Frames are never pickled: a fixed ring of frame slots lives in one
+multiprocessing.shared_memory block, compositor processes draw straight
+into their slot, and the process that encodes pipes the slot's memory to
+ffmpeg. Each slot has two semaphores for the ownership handshake: `free`
+(the producer may write it) and `ready` (the consumer may read it).
+
+Frame i always goes to slot i % slots and, with ForkedCompositors, is
+drawn by compositor i % processes. The slot count is a multiple of the
+process count, so every slot has exactly one producer, which fills it in
+frame order; the consumer reads frames in order, so no slot is ever
+written out of turn.
+"""
+import os
+import math
+import random
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+class FrameRing:
+    """
+    `slots` uint8 arrays of `shape` in shared memory. The process that
+    creates the ring owns (and eventually unlinks) the memory; it is passed
+    to child processes as an argument of Process.
+    """
+
+    def __init__(self, slots, shape, ctx=None):
+        ctx = ctx or multiprocessing.get_context()
+        self.slots = slots
+        self.shape = tuple(shape)
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * math.prod(self.shape))
+        self._free = [ctx.Semaphore(1) for _ in range(slots)]
+        self._ready = [ctx.Semaphore(0) for _ in range(slots)]
+        # Forked children inherit this object, so ownership goes by pid
+        self._owner_pid = os.getpid()
+        self._map()
+
+    def _map(self):
+        self.frames = np.ndarray((self.slots,) + self.shape, dtype=np.uint8, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {'name': self._shm.name, 'slots': self.slots, 'shape': self.shape,
+                'free': self._free, 'ready': self._ready}
+
+    def __setstate__(self, state):
+        self.slots = state['slots']
+        self.shape = state['shape']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._free = state['free']
+        self._ready = state['ready']
+        self._owner_pid = None
+        self._map()
+
+    def acquire(self, i, timeout=None):
+        """
+        Producer side: waits until the slot of frame i is free and returns
+        it to draw into. Raises TimeoutError if it stays taken.
+        """
+        slot = i % self.slots
+        if not self._free[slot].acquire(timeout=timeout):
+            raise TimeoutError(f"Frame slot {slot} was not released")
+        return self.frames[slot]
+
+    def publish(self, i):
+        """Producer side: hands the slot of frame i to the consumer"""
+        self._ready[i % self.slots].release()
+
+    def get(self, i, timeout=None):
+        """
+        Consumer side: waits for frame i and returns its slot, or None if it
+        isn't ready within timeout. The slot stays valid until release(i).
+        """
+        slot = i % self.slots
+        if not self._ready[slot].acquire(timeout=timeout):
+            return None
+        return self.frames[slot]
+
+    def release(self, i):
+        """Consumer side: gives the slot of frame i back to its producer"""
+        self._free[i % self.slots].release()
+
+    def close(self):
+        """Unmaps the ring; the owner also frees the shared memory"""
+        if self._shm is None:
+            return
+        shm, self._shm = self._shm, None
+        # The array has to go before the buffer it points into
+        self.frames = None
+        try:
+            shm.close()
+        except BufferError:
+            # A caller still holds a slot; the mapping goes with it
+            pass
+        if self._owner_pid == os.getpid():
+            shm.unlink()
+
+def _run_compositor(ring, render, first, step, total_frames, timeout):
+    """Body of a compositor process: draws frames first, first + step, ..."""
+    # Forked children start with the parent's random state; don't let them
+    # all draw the same "random" effects
+    random.seed()
+    for i in range(first, total_frames, step):
+        render(i, ring.acquire(i, timeout))
+        ring.publish(i)
+    ring.close()
+
+class ForkedCompositors:
+    """
+    Draws total_frames frames of `shape` with render(i, out) in `processes`
+    forked child processes, `slots_per_process` frames ahead of the
+    consumer at most. Iterating yields the frames in order; each one is
+    only valid until the next is requested.
+
+    The children are forked (so render and whatever it uses are shared
+    copy-on-write, not pickled); start them before the parent starts
+    threads. Only available where the platform can fork.
+    """
+
+    def __init__(self, render, shape, total_frames, processes, slots_per_process=2, frame_timeout=60.0):
+        self.render = render
+        self.total_frames = total_frames
+        self.frame_timeout = frame_timeout
+        self._ctx = multiprocessing.get_context('fork')
+        self.ring = FrameRing(processes * slots_per_process, shape, ctx=self._ctx)
+        self._processes = [
+            self._ctx.Process(target=_run_compositor, daemon=True,
+                              args=(self.ring, render, n, processes, total_frames, frame_timeout))
+            for n in range(processes)
+        ]
+        self._started = False
+
+    @staticmethod
+    def available():
+        return 'fork' in multiprocessing.get_all_start_methods()
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._started = True
+
+    def __iter__(self):
+        if not self._started:
+            self.start()
+        for i in range(self.total_frames):
+            producer = self._processes[i % len(self._processes)]
+            waited = 0.0
+            while True:
+                frame = self.ring.get(i, timeout=0.5)
+                if frame is not None:
+                    break
+                # A compositor that died never publishes its frames
+                if producer.exitcode is not None:
+                    raise RuntimeError(f"Compositor {producer.pid} exited with {producer.exitcode} before frame {i}")
+                waited += 0.5
+                if waited >= self.frame_timeout:
+                    raise TimeoutError(f"Frame {i} was not composited within {self.frame_timeout} seconds")
+            try:
+                yield frame
+            finally:
+                self.ring.release(i)
+
+    def close(self):
+        """Stops the compositors (if still running) and frees the ring"""
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process.pid is not None:
+                process.join()
+        self.ring.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
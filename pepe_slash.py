@@ -1,18 +1,58 @@
 import requests
 from PIL import Image, ImageDraw, ImageFilter, ImageOps
 from io import BytesIO
-import moviepy.editor as mpy
 import os
 import numpy as np
 import xml.etree.ElementTree as ET
 import re
 import math
 import random
-import tempfile
+import time
+import sys
+import datetime
+import argparse
+import logging
+import hashlib
+import zlib
+import json
+import contextlib
+import concurrent.futures
+import functools
+from encoder import FfmpegWriter
+from frame_ring import ForkedCompositors
+from frame_buffers import BufferPool
+from storage import temp_path_for
+from render_tiers import (RENDER_TIERS, DEFAULT_TIER, get_tier, resize_filter, rotate_filter,
+                          tier_scale, encoder_options)
 
-def fetch_profile_image(x_handle, target_size=(300, 300)):
+logger = logging.getLogger(__name__)
+
+# Frames that may wait for ffmpeg while the next ones are rendered
+ENCODE_QUEUE_FRAMES = 4
+# Point of the animation (mid-cut) whose frame is kept as a video's poster
+POSTER_PROGRESS = 0.5
+# JPEG quality of posters and single frames
+STILL_QUALITY = 90
+
+class RenderCancelled(Exception):
+    """Raised when a render is cancelled or runs past its deadline"""
+    pass
+
+def check_cancelled(deadline=None, cancel_event=None):
+    """
+    Raises RenderCancelled if the render was cancelled or its deadline
+    (a time.time() timestamp) has passed.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise RenderCancelled("Render cancelled")
+    if deadline is not None and time.time() > deadline:
+        raise RenderCancelled("Render deadline exceeded")
+
+def fetch_profile_image(x_handle, target_size=(300, 300), fallback=True):
     """
     Fetches the profile image with improved error handling and fallbacks.
+    If every source fails, returns a placeholder image (or raises, with
+    fallback=False).
     """
     try:
         # Remove @ if present
@@ -101,8 +141,35 @@ def fetch_profile_image(x_handle, target_size=(300, 300)):
         
     except Exception as e:
         print(f"Failed to fetch profile image for @{x_handle}: {str(e)}")
+        if not fallback:
+            raise
         return create_placeholder_image((300, 300), x_handle)
 
+def load_profile_image(x_handle, target_size, avatar_cache=None, max_age=None):
+    """
+    Returns the profile image of an X handle as an RGBA image, from the
+    avatar cache (a storage backend shared by all render workers) when it
+    has a copy younger than max_age seconds. Placeholders are not cached,
+    so a failed fetch is retried by the next render.
+    """
+    if avatar_cache is None:
+        return Image.fromarray(fetch_profile_image(x_handle, target_size=target_size))
+    name = f"{x_handle.replace('@', '').lower()}-{target_size[0]}x{target_size[1]}.png"
+    data = avatar_cache.get_bytes(name, max_age=max_age)
+    if data is not None:
+        return Image.open(BytesIO(data)).convert("RGBA")
+    try:
+        img = Image.fromarray(fetch_profile_image(x_handle, target_size=target_size, fallback=False))
+    except Exception:
+        return Image.fromarray(create_placeholder_image((300, 300), x_handle.replace('@', '')))
+    buffer = BytesIO()
+    img.save(buffer, 'PNG')
+    try:
+        avatar_cache.put_bytes(name, buffer.getvalue())
+    except OSError as e:
+        logger.warning(f"Could not cache avatar of @{x_handle}: {str(e)}")
+    return img
+
 def create_placeholder_image(size=(150, 150), username=""):
     """
     Creates a placeholder image when profile image fetch fails.
@@ -129,32 +196,19 @@ def create_placeholder_image(size=(150, 150), username=""):
     
     return np.array(img)
 
-def split_image_in_half(img):
-    """
-    Splits a PIL Image into left and right halves.
-    """
-    width, height = img.size
-    left = img.crop((0, 0, width//2, height))
-    right = img.crop((width//2, 0, width, height))
-    return left, right
-
-import random
-
-def add_blood_drops(img, x, y, width, height):
-    """Add realistic blood drops falling from the bottom of the chopping area"""
-    draw = ImageDraw.Draw(img, 'RGBA')
-    
+def draw_blood_drops(draw, x, y, width, height, scale=1.0):
+    """Draw 1-2 blood drops (and a trail) below the chopping area"""
     # Limit to 1-2 drops at a time
     num_drops = random.randint(1, 2)
     
     for i in range(num_drops):
         # Position drops at the bottom of the chopping area
         drop_x = x + random.randint(-width//4, width//4)  # Narrower range
-        drop_y = y + height + random.randint(-10, 10)  # Start from bottom
+        drop_y = y + height + int(random.randint(-10, 10) * scale)  # Start from bottom
         
         # Make drops more realistic
-        drop_width = random.randint(12, 18)  # Smaller width
-        drop_height = random.randint(25, 35)  # More natural height
+        drop_width = int(random.randint(12, 18) * scale)  # Smaller width
+        drop_height = int(random.randint(25, 35) * scale)  # More natural height
         red = random.randint(200, 255)  # Slightly darker red
         alpha = random.randint(220, 255)  # More opaque
         
@@ -166,283 +220,1033 @@ def add_blood_drops(img, x, y, width, height):
         
         # Add small trail if this isn't the last frame
         if i < num_drops - 1:
-            trail_length = random.randint(5, 10)
-            trail_width = random.randint(2, 4)
+            trail_length = int(random.randint(5, 10) * scale)
+            trail_width = max(1, int(random.randint(2, 4) * scale))
             draw.line(
                 [(drop_x + drop_width // 2, drop_y + drop_height),
                  (drop_x + drop_width // 2, drop_y + drop_height + trail_length)],
                 fill=(red, 0, 0, alpha - 30),  # Slightly transparent trail
                 width=trail_width
             )
+
+def load_template(pepe_image_path, saw_path='saww.jpg', tier=None):
+    """
+    Loads and preprocesses the template layers (background, Pepe and saw)
+    for a render tier. Nothing here depends on the profile, so the result can
+    be built once per tier and shared by every render that uses it.
+    """
+    tier = tier if isinstance(tier, dict) else get_tier(tier)
+    canvas_width, canvas_height = tier['canvas_size']
+    scale = tier_scale(tier)
+    resample = resize_filter(tier)
+    profile_size = (int(300 * scale), int(300 * scale))
     
-    # Apply a very slight blur for realism
-    img = img.filter(ImageFilter.GaussianBlur(0.3))
+    # Load background image from root directory
+    background = Image.open(pepe_image_path).convert("RGBA")
     
-    # Add a subtle glow to make drops stand out
-    glow = Image.new('RGBA', img.size, (255, 0, 0, 10))
-    img = Image.alpha_composite(img, glow)
-    return img
+    # Resize background to fit canvas
+    bg_width = int(canvas_width * 0.8)  # 80% of canvas width
+    bg_height = int(background.size[1] * (bg_width / background.size[0]))
+    background = background.resize((bg_width, bg_height), resample)
+    
+    # Add subtle glow effect to background
+    glow = Image.new('RGBA', background.size, (255, 255, 255, 10))
+    background = Image.alpha_composite(background, glow)
+    
+    # Position background
+    bg_pos = (canvas_width // 2 - bg_width // 2, canvas_height // 2 - bg_height // 2)
+    
+    # Load Pepe image with optimized processing
+    pepe_pil = Image.open(pepe_image_path).convert("RGBA")
+    pepe_height = int(profile_size[1] * 1.2)  # Reduced from 1.5
+    pepe_width = int(pepe_pil.size[0] * (pepe_height / pepe_pil.size[1]))
+    pepe_pil = pepe_pil.resize((pepe_width, pepe_height), resample)
+    
+    # Add glow effect to Pepe with reduced intensity
+    glow = Image.new('RGBA', pepe_pil.size, (255, 255, 255, 20))  # Reduced from 30
+    pepe_img = Image.alpha_composite(pepe_pil, glow)
+    
+    # Position Pepe (start from right side)
+    margin = int(50 * scale)
+    pepe_pos = (canvas_width - pepe_width - margin, canvas_height - pepe_height - margin)
+    
+    # Load saw image
+    if saw_path and os.path.exists(saw_path):
+        saw_img = Image.open(saw_path).convert("RGBA")
+        # Make saw larger and more prominent
+        saw_width = int(profile_size[1] * 0.8)  # 80% of profile height
+        saw_height = int(saw_img.size[1] * (saw_width / saw_img.size[0]))
+        saw_img = saw_img.resize((saw_width, saw_height), resample)
+        
+        # Add stronger glow effect to saw
+        glow = Image.new('RGBA', saw_img.size, (255, 255, 255, 40))
+        saw_img = Image.alpha_composite(saw_img, glow)
+    else:
+        logger.warning("Saw image not found, using default chainsaw effect")
+        saw_img = None
+    
+    return {
+        'background': background,
+        'bg_pos': bg_pos,
+        'pepe_img': pepe_img,
+        'pepe_pos': pepe_pos,
+        'saw_img': saw_img,
+    }
 
-def create_slash_animation(profile_path_or_handle, pepe_image_path, output_path=None, duration=5.0):
+def prepare_scene(profile_path_or_handle, pepe_image_path, duration=5.0, template=None, tier=None,
+                  avatar_cache=None, avatar_max_age=None):
     """
-    Creates a 5-second animation with:
-    - Optimized memory usage
-    - Smooth performance
-    - Engaging effects
-    - Automatic saving to outputs folder with timestamp
+    Sets up everything a render needs before the first frame: the tier's
+    canvas and filters, the template layers, the profile image and the
+    positions of all elements. render_frames() draws frames from the
+    result.
     """
+    # Set up animation parameters from the quality tier
+    tier = get_tier(tier)
+    canvas_width, canvas_height = tier['canvas_size']
+    fps = tier['fps']
+    # Layout is designed for 1280x720 and scaled to the tier's canvas
+    scale = tier_scale(tier)
+    resample = resize_filter(tier)
+    
+    # Create canvas and position elements
+    profile_size = (int(300 * scale), int(300 * scale))  # Reduced from 400
+    
+    # Template layers only depend on the template files and tier, so reuse
+    # them when the caller (e.g. a warm render worker) has already loaded them
+    if template is None:
+        template = load_template(pepe_image_path, tier=tier)
+    
+    # Fetch user's profile image (larger size)
+    if os.path.exists(profile_path_or_handle):
+        profile_img = Image.open(profile_path_or_handle).convert("RGBA")
+        # Make profile bigger
+        profile_size = (int(500 * scale), int(500 * scale))
+        profile_img = profile_img.resize(profile_size, resample)
+    else:
+        target_size = (int(500 * scale), int(500 * scale))
+        profile_img = load_profile_image(profile_path_or_handle, target_size,
+                                         avatar_cache=avatar_cache, max_age=avatar_max_age)
+    
+    # Position profile on chair (bottom of screen, moved up and right)
+    profile_pos = (canvas_width // 2 + int(50 * scale) - profile_size[0] // 2,
+                   canvas_height - profile_size[1] - int(300 * scale))
+    
+    return {
+        'tier': tier,
+        'canvas_size': (canvas_width, canvas_height),
+        'fps': fps,
+        'total_frames': int(duration * fps),
+        'scale': scale,
+        'rotate_resample': rotate_filter(tier),
+        'template': template,
+        'profile_img': profile_img,
+        'profile_size': profile_size,
+        'profile_pos': profile_pos,
+    }
+
+# Split-phase blood glow (a red layer at alpha 10) over an opaque pixel, per channel value
+_GLOW_RED = np.array([round((255 * 10 + v * 245) / 255) for v in range(256)], dtype=np.uint8)
+_GLOW_OTHER = np.array([round(v * 245 / 255) for v in range(256)], dtype=np.uint8)
+
+# Pixels around pasted layers whose blur (GaussianBlur(0.3)) can change
+BLUR_MARGIN = 4
+
+def template_plates(template, canvas_size):
+    """
+    Returns the profile-independent base plates of a template as RGBA
+    arrays: the white canvas with the background, without and with the
+    intro Pepe, and blurred with the blood glow as in the split phase.
+    They are composited once and kept in the template.
+    """
+    plates = template.get('plates')
+    if plates is None or plates['size'] != canvas_size:
+        plate = Image.new('RGBA', canvas_size, (255, 255, 255, 255))
+        plate.paste(template['background'], template['bg_pos'], template['background'])
+        base = np.array(plate)
+        split = np.array(plate.filter(ImageFilter.GaussianBlur(0.3)))
+        glow_batch(split)
+        plate.paste(template['pepe_img'], template['pepe_pos'], template['pepe_img'])
+        plates = {'size': canvas_size, 'base': base, 'intro': np.array(plate), 'split': split}
+        plate.close()
+        template['plates'] = plates
+    return plates
+
+def glow_batch(pixels):
+    """
+    Composites the blood drops' red glow over RGBA pixels (any shape ending
+    in 4) in place, as Image.alpha_composite(img, glow) does.
+    """
+    # Opaque pixels (nearly all of them) go through lookup tables; the
+    # rest get the full alpha compositing formula
+    translucent = pixels[..., 3] != 255
+    partial = pixels[translucent].astype(np.float32)
+    pixels[..., 0] = _GLOW_RED[pixels[..., 0]]
+    pixels[..., 1] = _GLOW_OTHER[pixels[..., 1]]
+    pixels[..., 2] = _GLOW_OTHER[pixels[..., 2]]
+    if len(partial):
+        alpha = partial[:, 3:4] * (245 / 255)
+        out_alpha = alpha + 10
+        partial[:, :3] *= alpha
+        partial[:, 0:1] += 255 * 10
+        partial[:, :3] /= out_alpha
+        partial[:, 3:4] = out_alpha
+        pixels[translucent] = (partial + 0.5).astype(np.uint8)
+
+def paste_batch(frames, layer, pos):
+    """
+    Pastes an RGBA layer (h, w, 4), or one layer per frame (K, h, w, 4),
+    onto a batch of RGBA frames (K, H, W, 4) in place, using the layer's
+    alpha as the mask like Image.paste(layer, pos, layer). Returns the
+    pasted box (left, top, right, bottom), or None if it is off the canvas.
+    """
+    height, width = frames.shape[1:3]
+    x, y = int(pos[0]), int(pos[1])
+    layer_height, layer_width = layer.shape[-3:-1]
+    # Clip to the canvas
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + layer_width, width), min(y + layer_height, height)
+    if left >= right or top >= bottom:
+        return None
+    src = layer[..., top - y:bottom - y, left - x:right - x, :]
+    dst = frames[:, top:bottom, left:right, :]
+    alpha = src[..., 3]
+    # Opaque pixels are copied whole (as 32-bit words); only the (few)
+    # translucent ones are blended
+    np.copyto(dst.view(np.uint32)[..., 0], src.view(np.uint32)[..., 0], where=alpha == 255)
+    translucent = (alpha - np.uint8(1)) < 254
+    if translucent.any():
+        translucent = np.nonzero(translucent)
+        if src.ndim == 3:
+            # Shared layer: the same pixels of every frame
+            pixels = (slice(None),) + translucent
+        else:
+            pixels = translucent
+        src_pixels = src[translucent].astype(np.uint16)
+        mask = src_pixels[..., 3:4]
+        blended = dst[pixels] * (255 - mask)
+        blended += src_pixels * mask
+        # Rounded division by 255 without a divide
+        blended += 128
+        blended += blended >> 8
+        blended >>= 8
+        dst[pixels] = blended
+    return left, top, right, bottom
+
+def union_box(a, b):
+    """Smallest box containing both boxes (either may be None)"""
+    if a is None or b is None:
+        return a or b
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def merge_boxes(boxes, margin):
+    """
+    Merges boxes that are closer than 2 * margin (None entries are skipped),
+    so regions processed with that margin never overlap.
+    """
+    merged = [box for box in boxes if box is not None]
+    changed = True
+    while changed:
+        changed = False
+        for a in range(len(merged)):
+            for b in range(a + 1, len(merged)):
+                first, second = merged[a], merged[b]
+                if (first[0] - margin < second[2] + margin and second[0] - margin < first[2] + margin
+                        and first[1] - margin < second[3] + margin and second[1] - margin < first[3] + margin):
+                    merged[a] = union_box(first, second)
+                    del merged[b]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+def template_buffers(template):
+    """
+    Frame buffer pool kept with a template, so every render using the
+    template reuses the buffers of the ones before it.
+    """
+    buffers = template.get('buffers')
+    if buffers is None:
+        buffers = template['buffers'] = BufferPool()
+    return buffers
+
+def profile_array(scene):
+    """The scene's profile image as an RGBA array (converted once)"""
+    array = scene.get('profile_array')
+    if array is None:
+        array = scene['profile_array'] = np.asarray(scene['profile_img'])
+    return array
+
+def shake_plate(plate, shake_x, shake_y, out, top=0, bottom=None):
+    """
+    Writes `plate` shifted by the camera shake into every frame of `out`,
+    as canvas.transform(size, AFFINE, (1, 0, shake_x, 0, 1, shake_y))
+    would: uncovered pixels become transparent black. Only rows top to
+    bottom are written when given (e.g. one tile).
+    """
+    height, width = plate.shape[:2]
+    bottom = height if bottom is None else bottom
+    out = out[:, top:bottom]
+    left, right = max(0, -shake_x), min(width, width - shake_x)
+    # Rows of the tile that the shifted plate covers, relative to the tile
+    covered_top = min(max(-shake_y, top), bottom) - top
+    covered_bottom = max(min(height - shake_y, bottom), top) - top
+    out[:, covered_top:covered_bottom, left:right] = plate[top + covered_top + shake_y:top + covered_bottom + shake_y,
+                                                           left + shake_x:right + shake_x]
+    out[:, :covered_top] = 0
+    out[:, covered_bottom:] = 0
+    out[:, covered_top:covered_bottom, :left] = 0
+    out[:, covered_top:covered_bottom, right:] = 0
+
+def blood_drops_layer(x, y, width, height, scale, buffers):
+    """
+    Draws the blood drops (see draw_blood_drops) on a transparent layer
+    only as big as the area they can fall in, taken from `buffers`.
+    Returns them as an RGBA array and its position on the canvas, or None
+    if nothing was drawn.
+    """
+    pad = int(4 * scale) + 2
+    left = x - width // 4 - pad
+    top = y + height - int(10 * scale) - pad
+    size = (width // 2 + int(18 * scale) + 2 * pad, int(65 * scale) + 2 * pad)
+    layer = buffers.take_image('RGBA', size)
     try:
-        # Set up animation parameters with optimized sizes
-        canvas_width = 1280  # Reduced from 1920
-        canvas_height = 720  # Reduced from 1080
-        fps = 30  # Reduced from 60 to save memory
-        total_frames = int(duration * fps)
-        frames = []
-        
-        # Calculate timing for different phases
-        approach_duration = duration * 0.2
-        approach_frames = int(approach_duration * fps)
-        
-        chainsaw_duration = duration * 0.2
-        chainsaw_frames = int(chainsaw_duration * fps)
-        
-        cut_duration = duration * 0.2
-        cut_frames = int(cut_duration * fps)
-        
-        split_duration = duration * 0.4
-        split_frames = int(split_duration * fps)
-        
-        # Create canvas and position elements
-        profile_size = (300, 300)  # Reduced from 400
-        
-        # Load background image from root directory
-        background = Image.open(pepe_image_path).convert("RGBA")
-        
-        # Resize background to fit canvas
-        bg_width = int(canvas_width * 0.8)  # 80% of canvas width
-        bg_height = int(background.size[1] * (bg_width / background.size[0]))
-        background = background.resize((bg_width, bg_height), Image.Resampling.LANCZOS)
-        
-        # Add subtle glow effect to background
-        glow = Image.new('RGBA', background.size, (255, 255, 255, 10))
-        background = Image.alpha_composite(background, glow)
-        
-        # Position background
-        bg_pos = (canvas_width // 2 - bg_width // 2, canvas_height // 2 - bg_height // 2)
-        
-        # Load Pepe image with optimized processing
-        pepe_pil = Image.open(pepe_image_path).convert("RGBA")
-        pepe_height = int(profile_size[1] * 1.2)  # Reduced from 1.5
-        pepe_width = int(pepe_pil.size[0] * (pepe_height / pepe_pil.size[1]))
-        pepe_pil = pepe_pil.resize((pepe_width, pepe_height), Image.Resampling.LANCZOS)
-        
-        # Add glow effect to Pepe with reduced intensity
-        glow = Image.new('RGBA', pepe_pil.size, (255, 255, 255, 20))  # Reduced from 30
-        pepe_img = Image.alpha_composite(pepe_pil, glow)
-        
-        # Load saw image
-        saw_path = 'saww.jpg'
-        if os.path.exists(saw_path):
-            saw_img = Image.open(saw_path).convert("RGBA")
-            # Make saw larger and more prominent
-            saw_width = int(profile_size[1] * 0.8)  # 80% of profile height
-            saw_height = int(saw_img.size[1] * (saw_width / saw_img.size[0]))
-            saw_img = saw_img.resize((saw_width, saw_height), Image.Resampling.LANCZOS)
-            
-            # Add stronger glow effect to saw
-            glow = Image.new('RGBA', saw_img.size, (255, 255, 255, 40))
-            saw_img = Image.alpha_composite(saw_img, glow)
+        layer.paste((0, 0, 0, 0), (0, 0) + size)
+        draw_blood_drops(ImageDraw.Draw(layer), x - left, y - top, width, height, scale=scale)
+        box = layer.getbbox()
+        if not box:
+            return None
+        return np.asarray(layer.crop(box)), (left + box[0], top + box[1])
+    finally:
+        buffers.give_image(layer)
+
+def saw_transform(phase_progress, scale):
+    """
+    Angle of the saw at this point of the cutting phase, and how far it has
+    swayed sideways and moved down from the profile's center.
+    """
+    angle = math.sin(phase_progress * math.pi * 2) * 5
+    sway = int(5 * scale * math.sin(phase_progress * math.pi))
+    drop = int(10 * scale * phase_progress)
+    return angle, sway, drop
+
+def saw_frame(scene, i, phase_progress):
+    """
+    Returns the rotated saw of cutting frame i as an RGBA array, and the
+    offset of its top left corner from the profile's center. Precompiled
+    templates (see template_bundle) carry every frame's saw; otherwise it
+    is rotated here, once per angle, and kept with the template.
+    """
+    template = scene['template']
+    table = template.get('saw_frames')
+    if table is not None and len(table) == scene['total_frames'] and table[i]['sprite'] >= 0:
+        entry = table[i]
+        return template['saw_sprites'][entry['sprite']], int(entry['x']), int(entry['y'])
+    saw_img = template['saw_img']
+    angle, sway, drop = saw_transform(phase_progress, scene['scale'])
+    rotations = template.setdefault('saw_rotations', {})
+    saw_rotated = rotations.get((angle, scene['rotate_resample']))
+    if saw_rotated is None:
+        saw_rotated = np.asarray(saw_img.rotate(angle, scene['rotate_resample'], expand=True))
+        rotations[(angle, scene['rotate_resample'])] = saw_rotated
+    return saw_rotated, sway - saw_img.size[0] // 2, drop - saw_img.size[1] // 2
+
+def split_halves(scene):
+    """
+    Returns the two halves of a scene's profile with their initial tilt,
+    which don't change from frame to frame (computed once per scene).
+    """
+    halves = scene.get('split_halves')
+    if halves is None:
+        profile_img, profile_size = scene['profile_img'], scene['profile_size']
+        rotate_resample = scene['rotate_resample']
+        left_half = profile_img.crop((0, 0, profile_size[0] // 2, profile_size[1]))
+        right_half = profile_img.crop((profile_size[0] // 2, 0, profile_size[0], profile_size[1]))
+        halves = (left_half.rotate(-10, rotate_resample, expand=True),
+                  right_half.rotate(10, rotate_resample, expand=True))
+        scene['split_halves'] = halves
+    return halves
+
+def group_layers(count, layers, positions):
+    """
+    Groups the layers of `count` frames (one per frame, as PIL images or
+    arrays, or a single array shared by all frames) by size and position,
+    so frames whose layers match (e.g. all X handles of a batch) are pasted
+    in one operation. Returns (stacked layers, position, frame indexes or
+    None for all frames) tuples for paste_groups().
+    """
+    groups = {}
+    for k, pos in enumerate(positions):
+        layer = layers if isinstance(layers, np.ndarray) else layers[k]
+        size = layer.shape if isinstance(layer, np.ndarray) else layer.size
+        groups.setdefault((size, (int(pos[0]), int(pos[1]))), []).append(k)
+    grouped = []
+    for (_, pos), indexes in groups.items():
+        if isinstance(layers, np.ndarray):
+            stacked = layers
+        elif len(indexes) == 1:
+            stacked = np.asarray(layers[indexes[0]])[None]
         else:
-            logger.warning("Saw image not found, using default chainsaw effect")
-            saw_img = None
-        
-        # Add glow effect to Pepe with reduced intensity
-        glow = Image.new('RGBA', pepe_pil.size, (255, 255, 255, 20))  # Reduced from 30
-        pepe_img = Image.alpha_composite(pepe_pil, glow)
-        
-        # Position Pepe (start from right side)
-        pepe_pos = (canvas_width - pepe_width - 50, canvas_height - pepe_height - 50)
-        
-        # Fetch user's profile image (larger size)
-        if os.path.exists(profile_path_or_handle):
-            profile_img = Image.open(profile_path_or_handle).convert("RGBA")
-            # Make profile bigger
-            profile_size = (500, 500)
-            profile_img = profile_img.resize(profile_size, Image.Resampling.LANCZOS)
+            stacked = np.stack([np.asarray(layers[k]) for k in indexes])
+        grouped.append((stacked, pos, None if len(indexes) == count else indexes))
+    return grouped
+
+def paste_groups(frames, groups, top=0):
+    """
+    Pastes grouped layers (see group_layers) onto frames whose first row
+    is row `top` of the canvas (e.g. a horizontal tile). Returns the canvas
+    box of everything pasted.
+    """
+    box = None
+    for stacked, (x, y), indexes in groups:
+        if indexes is None:
+            pasted = paste_batch(frames, stacked, (x, y - top))
         else:
-            profile_img = Image.fromarray(fetch_profile_image(profile_path_or_handle, target_size=(500, 500)))
+            # Fancy indexing copies, so write the group back
+            group = frames[indexes]
+            pasted = paste_batch(group, stacked, (x, y - top))
+            frames[indexes] = group
+        if pasted is not None:
+            box = union_box(box, (pasted[0], pasted[1] + top, pasted[2], pasted[3] + top))
+    return box
+
+# Compositing threads shared by all renders of the process (see set_tile_threads)
+_tiles = {'threads': 0, 'executor': None, 'pid': None}
+
+def set_tile_threads(threads):
+    """
+    Composites every frame in `threads` horizontal tiles at once, on a
+    thread pool shared by all renders of this process; NumPy and Pillow
+    release the GIL for the pixel work. 0 or 1 composites each frame on
+    the rendering thread.
+    """
+    executor = _tiles['executor']
+    if executor is not None and _tiles['pid'] == os.getpid():
+        executor.shutdown(wait=False)
+    _tiles.update(threads=threads if threads > 1 else 0, executor=None, pid=None)
+
+def map_tiles(height, work):
+    """
+    Runs work(top, bottom) for horizontal tiles covering `height` rows (in
+    parallel, see set_tile_threads) and returns the results in tile order.
+    """
+    threads = _tiles['threads']
+    if not threads:
+        return [work(0, height)]
+    if _tiles['pid'] != os.getpid():
+        # Threads don't survive a fork, so a forked process needs its own pool
+        _tiles['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=threads - 1,
+                                                                   thread_name_prefix='tile')
+        _tiles['pid'] = os.getpid()
+    bounds = [height * n // threads for n in range(threads + 1)]
+    futures = [_tiles['executor'].submit(work, bounds[n], bounds[n + 1]) for n in range(1, threads)]
+    try:
+        # The calling thread takes the first tile
+        results = [work(bounds[0], bounds[1])]
+    finally:
+        concurrent.futures.wait(futures)
+    results.extend(future.result() for future in futures)
+    return results
+
+def plan_frames(scenes, i):
+    """
+    Works out frame i of several scenes (see render_frames) without drawing
+    it: draws its random effects and prepares its layers. The plan's
+    'signature' holds everything the frame's pixels depend on, so two
+    frames of the same scenes with equal signatures come out identical.
+    """
+    first = scenes[0]
+    canvas_width = first['canvas_size'][0]
+    scale = first['scale']
+    rotate_resample = first['rotate_resample']
+    template = first['template']
+    saw_img = template['saw_img']
+    progress = i / first['total_frames']
+    
+    if progress < 0.2:  # Approach phase: no profile yet, every frame is the same
+        shake_x = int(random.randint(-5, 5) * scale)
+        shake_y = int(random.randint(-5, 5) * scale)
+        plate = 'intro' if progress < 0.1 else 'base'
+        return {'progress': progress, 'plate': plate, 'shake': (shake_x, shake_y), 'pastes': [],
+                'signature': ('approach', plate, shake_x, shake_y)}
+    
+    # Each entry is pasted over the base plate in turn
+    pastes = []
+    
+    if progress < 0.4:  # Profile approach phase
+        phase_progress = (progress - 0.2) / 0.2
+        positions = []
+        for scene in scenes:
+            profile_pos = scene['profile_pos']
+            profile_x = profile_pos[0] - ((canvas_width // 2) - profile_pos[0]) * phase_progress * 0.6
+            positions.append((int(profile_x), profile_pos[1]))
+        pastes.append(group_layers(len(scenes), [profile_array(scene) for scene in scenes], positions))
+        signature = ('profile', tuple(positions))
         
-        # Position profile on chair (bottom of screen, moved up and right)
-        profile_pos = (canvas_width // 2 + 50 - profile_size[0] // 2, canvas_height - profile_size[1] - 300)
+    elif progress < 0.6:  # Cutting phase
+        phase_progress = (progress - 0.4) / 0.2
+        pastes.append(group_layers(len(scenes), [profile_array(scene) for scene in scenes],
+                                   [scene['profile_pos'] for scene in scenes]))
+        signature = ('cutting',)
         
-        # Split the profile image into left and right halves
-        left_half, right_half = split_image_in_half(profile_img)
+        if saw_img:
+            # The saw moves the same way for every scene, so rotate it once
+            saw_rotated, saw_x, saw_y = saw_frame(first, i, phase_progress)
+            positions = [(scene['profile_pos'][0] + scene['profile_size'][0] // 2 + saw_x,
+                          scene['profile_pos'][1] + scene['profile_size'][1] // 2 + saw_y)
+                         for scene in scenes]
+            pastes.append(group_layers(len(scenes), saw_rotated, positions))
+            # The saw sprite is picked by its angle
+            signature += (saw_transform(phase_progress, scale)[0], saw_x, saw_y)
         
-        # Generate animation frames
-        temp_dir = tempfile.mkdtemp()
-        print(f"Created temporary directory: {temp_dir}")
+    else:  # Split phase
+        phase_progress = (progress - 0.6) / 0.4
+        fall_offset = int(150 * scale * phase_progress)
+        left_rotate = -10 - (phase_progress * 20)
+        right_rotate = 10 + (phase_progress * 20)
+        left_layers, right_layers, left_positions, right_positions = [], [], [], []
+        for scene in scenes:
+            profile_size, profile_pos = scene['profile_size'], scene['profile_pos']
+            left_half, right_half = split_halves(scene)
+            offset = int(profile_size[0] * phase_progress)
+            left_layers.append(left_half.rotate(left_rotate, rotate_resample, expand=True))
+            right_layers.append(right_half.rotate(right_rotate, rotate_resample, expand=True))
+            left_positions.append((profile_pos[0] - offset, profile_pos[1] + fall_offset))
+            right_positions.append((profile_pos[0] + offset, profile_pos[1] + fall_offset))
+        pastes.append(group_layers(len(scenes), left_layers, left_positions))
+        pastes.append(group_layers(len(scenes), right_layers, right_positions))
+        signature = ('split', left_rotate, right_rotate, tuple(left_positions), tuple(right_positions))
         
+        # Blood drops are drawn on one transparent layer for the batch
+        profile_pos, profile_size = first['profile_pos'], first['profile_size']
+        drops = blood_drops_layer(profile_pos[0], profile_pos[1], profile_size[0], profile_size[1],
+                                  scale, template_buffers(template))
+        if drops is not None:
+            drops_layer, drops_pos = drops
+            pastes.append([(drops_layer, drops_pos, None)])
+            signature += (drops_pos, drops_layer.shape, drops_layer.tobytes())
+    
+    return {'progress': progress, 'plate': 'base', 'shake': None, 'pastes': pastes,
+            'signature': signature}
+
+def render_frames(scenes, i, out=None):
+    """
+    Draws frame i of several scenes that share a template, tier and
+    duration, and returns them as one (K, H, W, 4) RGBA array (written to
+    `out` when given).
+    
+    What doesn't depend on the profile (the plates, the camera shake, the
+    saw, the blood drops) is drawn once for the whole batch and broadcast;
+    only the profile layers are drawn per scene, and the split phase's blur
+    and glow are only applied around them. The random effects are shared
+    by the batch.
+    
+    The layers are prepared first (plan_frames); pasting, blurring and the
+    final composite are then done tile by tile (see map_tiles) by
+    composite_frames.
+    """
+    return composite_frames(scenes, plan_frames(scenes, i), out=out)
+
+def composite_frames(scenes, plan, out=None):
+    """Draws the frames planned by plan_frames() (see render_frames)"""
+    first = scenes[0]
+    canvas_width, canvas_height = first['canvas_size']
+    progress = plan['progress']
+    pastes = plan['pastes']
+    
+    if out is None:
+        out = np.empty((len(scenes), canvas_height, canvas_width, 4), dtype=np.uint8)
+    frames = out[:len(scenes)]
+    plates = template_plates(first['template'], (canvas_width, canvas_height))
+    
+    if plan['shake'] is not None:
+        plate = plates[plan['plate']]
+        shake_x, shake_y = plan['shake']
+        map_tiles(canvas_height, lambda top, bottom: shake_plate(plate, shake_x, shake_y, frames, top, bottom))
+        return frames
+    
+    def paste(top, bottom):
+        tile = frames[:, top:bottom]
+        tile[:] = plates['base'][top:bottom]
+        return [paste_groups(tile, groups, top) for groups in pastes]
+    
+    tile_boxes = map_tiles(canvas_height, paste)
+    if progress < 0.6:
+        return frames
+    
+    # Blur and glow are local, so away from what was drawn on it the
+    # frame is the blurred, glowing plate; only redo them around the layers
+    boxes = [functools.reduce(union_box, per_tile) for per_tile in zip(*tile_boxes)]
+    regions = [(box, np.empty((len(frames), box[3] - box[1], box[2] - box[0], 4), dtype=np.uint8))
+               for box in merge_boxes(boxes, BLUR_MARGIN)]
+    
+    def blur(top, bottom):
+        # Each tile blurs its rows of every region, reading BLUR_MARGIN
+        # rows around them (all pasting is done by now)
+        for (left, region_top, right, region_bottom), region in regions:
+            rows_top, rows_bottom = max(region_top, top), min(region_bottom, bottom)
+            if rows_top >= rows_bottom:
+                continue
+            pad_left, pad_top = max(left - BLUR_MARGIN, 0), max(rows_top - BLUR_MARGIN, 0)
+            pad_right = min(right + BLUR_MARGIN, canvas_width)
+            pad_bottom = min(rows_bottom + BLUR_MARGIN, canvas_height)
+            rows = region[:, rows_top - region_top:rows_bottom - region_top]
+            for k in range(len(frames)):
+                padded = Image.fromarray(frames[k, pad_top:pad_bottom, pad_left:pad_right], 'RGBA')
+                blurred = np.asarray(padded.filter(ImageFilter.GaussianBlur(0.3)))
+                rows[k] = blurred[rows_top - pad_top:rows_bottom - pad_top, left - pad_left:right - pad_left]
+            glow_batch(rows)
+    
+    def finish(top, bottom):
+        frames[:, top:bottom] = plates['split'][top:bottom]
+        for (left, region_top, right, region_bottom), region in regions:
+            rows_top, rows_bottom = max(region_top, top), min(region_bottom, bottom)
+            if rows_top < rows_bottom:
+                frames[:, rows_top:rows_bottom, left:right] = region[:, rows_top - region_top:rows_bottom - region_top]
+    
+    map_tiles(canvas_height, blur)
+    map_tiles(canvas_height, finish)
+    return frames
+
+def frame_index(t, duration, fps):
+    """Index of the frame shown t seconds into a render, clamped to the video"""
+    return min(max(int(t * fps), 0), int(duration * fps) - 1)
+
+def encode_still(frame):
+    """Encodes an RGBA frame as a JPEG poster or thumbnail"""
+    output = BytesIO()
+    Image.fromarray(frame, 'RGBA').convert('RGB').save(output, 'JPEG', quality=STILL_QUALITY)
+    return output.getvalue()
+
+def render_frame_at(profile_path_or_handle, pepe_image_path, t, duration=5.0, template=None, tier=None,
+                    avatar_cache=None, avatar_max_age=None):
+    """
+    Draws only the frame shown t seconds into the animation, e.g. for a
+    thumbnail or while scrubbing, and returns its index and the frame as an
+    HxWx4 RGBA array. Only the layers of that frame's phase are prepared
+    (see plan_frames); encode_still() makes a JPEG of it.
+    """
+    scene = prepare_scene(profile_path_or_handle, pepe_image_path, duration=duration,
+                          template=template, tier=tier, avatar_cache=avatar_cache,
+                          avatar_max_age=avatar_max_age)
+    i = frame_index(t, duration, scene['fps'])
+    return i, render_frames([scene], i)[0]
+
+def distinct_frames(scene, buffers):
+    """
+    Draws the frames of a single scene into shared buffers (see
+    frame_buffers.SharedBuffer) and yields (i, frame, repeated) for each
+    frame i. A frame identical to the one before is not kept: the previous
+    buffer is yielded again with repeated set. The caller retain()s a
+    frame for as long as it needs it after the next one is requested.
+    
+    Repeats are caught before drawing when the frame's plan has the same
+    signature as the previous one (see plan_frames), and otherwise after
+    drawing by a CRC of the pixels, confirmed by comparing the frames, so
+    only exact repeats are collapsed.
+    """
+    canvas_width, canvas_height = scene['canvas_size']
+    previous = signature = digest = None
+    try:
+        for i in range(scene['total_frames']):
+            plan = plan_frames([scene], i)
+            if previous is not None and plan['signature'] == signature:
+                yield i, previous, True
+                continue
+            signature = plan['signature']
+            frame = buffers.take_shared((canvas_height, canvas_width, 4))
+            composite_frames([scene], plan, out=frame.array[None])
+            frame_digest = zlib.crc32(frame.array)
+            if previous is not None and frame_digest == digest and np.array_equal(frame.array, previous.array):
+                frame.release()
+                yield i, previous, True
+                continue
+            if previous is not None:
+                previous.release()
+            previous, digest = frame, frame_digest
+            yield i, frame, False
+    finally:
+        if previous is not None:
+            previous.release()
+
+def create_slash_animations(jobs, pepe_image_path, duration=5.0, template=None, codec='libx264',
+                            tier=None, avatar_cache=None, avatar_max_age=None, variable_frame_rate=False):
+    """
+    Renders several animations of the same template, tier and duration in
+    one pass (see render_frames), each to its own encoder.
+    
+    jobs is a list of dicts with 'profile' (X handle or image path) and
+    'output_path', and optionally 'deadline', 'cancel_event', 'on_data' and
+    'on_poster' as for create_slash_animation(). A job that fails or is
+    cancelled is dropped without stopping the others. Returns one entry
+    per job: None if its video was written, otherwise the exception that
+    stopped it.
+    Every frame is drawn; variable_frame_rate only has the encoders drop
+    repeated frames (see create_slash_animation).
+    """
+    if template is None:
+        template = load_template(pepe_image_path, tier=tier)
+    errors = [None] * len(jobs)
+    scenes = [None] * len(jobs)
+    writers = [None] * len(jobs)
+    
+    for k, job in enumerate(jobs):
         try:
-            # Frame generation loop
-            for i in range(total_frames):
-                progress = i / total_frames
-                frame_path = os.path.join(temp_dir, f'frame_{i:04d}.png')
-                
-                # Create a new canvas for this frame
-                canvas = Image.new('RGBA', (canvas_width, canvas_height), (255, 255, 255, 255))
-                
-                # Draw background image first
-                canvas.paste(background, bg_pos, background)
-                
-                # Draw background Pepe (remove duplicate)
-                # Only draw background Pepe once at the start
-                if progress < 0.1:  # Only draw background Pepe in first frame
-                    canvas.paste(pepe_img, pepe_pos, pepe_img)
-                
-                # Animation phases
-                if progress < 0.2:  # Approach phase
-                    phase_progress = progress / 0.2
-                    
-                    # Add subtle camera shake
-                    shake_x = random.randint(-5, 5)
-                    shake_y = random.randint(-5, 5)
-                    canvas = canvas.transform(canvas.size, Image.AFFINE, (1, 0, shake_x, 0, 1, shake_y))
-                    
-                elif progress < 0.4:  # Profile approach phase
-                    phase_progress = (progress - 0.2) / 0.2
-                    
-                    # Profile moves from right to bottom (slower and limited to half screen)
-                    # Only move 50% of the way across the screen
-                    profile_x = profile_pos[0] - ((canvas_width // 2) - profile_pos[0]) * phase_progress * 0.6
-                    canvas.paste(profile_img, (int(profile_x), profile_pos[1]), profile_img)
-                    
-                elif progress < 0.6:  # Cutting phase
-                    phase_progress = (progress - 0.4) / 0.2
-                    
-                    # Profile is now on the chair
-                    canvas.paste(profile_img, profile_pos, profile_img)
-                    
-                    # Vertical cutting now
-                    if saw_img:
-                        # Position saw on profile
-                        saw_x = profile_pos[0] + profile_size[0] // 2 - saw_width // 2
-                        saw_y = profile_pos[1] + profile_size[1] // 2 - saw_height // 2
-                        
-                        # Animate saw moving vertically (slower)
-                        saw_offset = int(10 * phase_progress)  # Slower movement
-                        saw_x += int(5 * math.sin(phase_progress * math.pi))  # Side-to-side motion
-                        
-                        # Rotate saw slightly
-                        saw_angle = math.sin(phase_progress * math.pi * 2) * 5
-                        saw_rotated = saw_img.rotate(saw_angle, expand=True)
-                        
-                        # Add saw to canvas
-                        canvas.paste(saw_rotated, (saw_x, saw_y + saw_offset), saw_rotated)
-                        
-                    # Add saw to canvas
-                    canvas.paste(saw_rotated, (saw_x, saw_y + saw_offset), saw_rotated)
-                    
-                else:  # Split phase
-                    phase_progress = (progress - 0.6) / 0.4
-                    
-                    # Split vertically
-                    left_half = profile_img.crop((0, 0, profile_size[0] // 2, profile_size[1]))
-                    right_half = profile_img.crop((profile_size[0] // 2, 0, profile_size[0], profile_size[1]))
-                    
-                    # Move halves apart horizontally with falling motion
-                    offset = int(profile_size[0] * phase_progress)
-                    
-                    # Add rotation for dramatic effect
-                    left_half = left_half.rotate(-10, expand=True)
-                    right_half = right_half.rotate(10, expand=True)
-                    
-                    # Calculate falling positions
-                    fall_offset = int(150 * phase_progress)  # Pieces fall 150 pixels
-                    
-                    # Add rotation that increases with falling
-                    left_rotate = -10 - (phase_progress * 20)  # Rotate more as it falls
-                    right_rotate = 10 + (phase_progress * 20)
-                    
-                    # Apply rotation
-                    left_half = left_half.rotate(left_rotate, expand=True)
-                    right_half = right_half.rotate(right_rotate, expand=True)
-                    
-                    canvas.paste(left_half, (profile_pos[0] - offset, profile_pos[1] + fall_offset), left_half)
-                    canvas.paste(right_half, (profile_pos[0] + offset, profile_pos[1] + fall_offset), right_half)
-                    
-                    # Add blood drops
-                    blood_progress = phase_progress
-                    canvas = add_blood_drops(canvas, profile_pos[0], profile_pos[1], profile_size[0], profile_size[1])
-                
-                # Save frame with proper error handling
+            scenes[k] = prepare_scene(job['profile'], pepe_image_path, duration=duration,
+                                      template=template, tier=tier, avatar_cache=avatar_cache,
+                                      avatar_max_age=avatar_max_age)
+        except Exception as e:
+            logger.error(f"Could not prepare {job['profile']}: {str(e)}")
+            errors[k] = e
+    active = [k for k in range(len(jobs)) if errors[k] is None]
+    if not active:
+        return errors
+    tier_options = scenes[active[0]]['tier']
+    canvas_width, canvas_height = tier_options['canvas_size']
+    
+    def drop(k, error):
+        errors[k] = error
+        active.remove(k)
+        writers[k].abort()
+    
+    try:
+        for k in active:
+            writers[k] = FfmpegWriter(jobs[k]['output_path'], (canvas_width, canvas_height), tier_options['fps'],
+                                      codec=codec, on_data=jobs[k].get('on_data'), pix_fmt='rgba',
+                                      queue_frames=ENCODE_QUEUE_FRAMES, variable_frame_rate=variable_frame_rate,
+                                      **encoder_options(tier_options, codec))
+        buffers = template_buffers(template)
+        batch_shape = (len(active), canvas_height, canvas_width, 4)
+        total_frames = scenes[active[0]]['total_frames']
+        poster = frame_index(duration * POSTER_PROGRESS, duration, tier_options['fps'])
+        for i in range(total_frames):
+            for k in list(active):
+                try:
+                    check_cancelled(jobs[k].get('deadline'), jobs[k].get('cancel_event'))
+                except RenderCancelled as e:
+                    drop(k, e)
+            if not active:
+                break
+            buffer = buffers.take(batch_shape)
+            frames = render_frames([scenes[k] for k in active], i, out=buffer)
+            # The buffer goes back once every encoder is done with its frame
+            done = buffers.give_after(buffer, len(frames))
+            for frame, k in zip(frames, list(active)):
                 try:
-                    # Ensure directory exists
-                    os.makedirs(os.path.dirname(frame_path), exist_ok=True)
-                    
-                    # Save with proper quality settings
-                    canvas.save(frame_path, 'PNG', quality=95)
-                    frames.append(frame_path)
-                    print(f"Generated frame {i+1}/{total_frames}")
+                    if i == poster and jobs[k].get('on_poster') is not None:
+                        jobs[k]['on_poster'](i, encode_still(frame))
+                    writers[k].write_frame(frame, done=done)
                 except Exception as e:
-                    print(f"Error saving frame {i}: {str(e)}")
-                    raise
-                finally:
-                    # Clear canvas memory
-                    canvas.close()
-            
-            # Create video from frames
+                    drop(k, e)
+        for k in list(active):
             try:
-                # Ensure all frames exist before creating video
-                for frame in frames:
-                    if not os.path.exists(frame):
-                        raise FileNotFoundError(f"Frame file not found: {frame}")
-                
-                video = mpy.ImageSequenceClip(frames, fps=fps)
-                video.write_videofile(output_path, codec='libx264', fps=fps)
-                print(f"Animation saved to {output_path}")
-                return output_path
+                writers[k].close()
             except Exception as e:
-                print(f"Error creating video: {str(e)}")
-                raise
-        except Exception as e:
-            print(f"Error creating animation: {str(e)}")
-            raise
+                errors[k] = e
+        saved = errors.count(None)
+        logger.info(f"Batch of {len(jobs)} animations: {saved} saved, {len(jobs) - saved} failed")
+    except BaseException:
+        for k in active:
+            if writers[k] is not None:
+                writers[k].abort()
+        raise
+    return errors
+
+def create_slash_animation(profile_path_or_handle, pepe_image_path, output_path=None, duration=5.0,
+                           template=None, codec='libx264', deadline=None, cancel_event=None,
+                           tier=None, on_data=None, avatar_cache=None, avatar_max_age=None, compositors=0,
+                           variable_frame_rate=False, on_poster=None):
+    """
+    Creates a 5-second animation with:
+    - Optimized memory usage
+    - Smooth performance
+    - Engaging effects
+    - Automatic saving to outputs folder with timestamp
+    
+    The render stops with RenderCancelled between frames once cancel_event
+    is set or the deadline (a time.time() timestamp) has passed.
+    
+    tier names the quality tier (see render_tiers) that sets canvas size,
+    fps, resampling filters and encoder settings.
+    
+    Frames go to the encoder as soon as they are drawn. If on_data is given,
+    it is also called with chunks of a fragmented MP4 of the same video while
+    it is being encoded, so the video can be streamed before it is finished.
+    If on_poster is given, it is called with the index of the poster frame
+    (see POSTER_PROGRESS) and a JPEG of it, encoded on its way to the
+    encoder, so the video never has to be decoded for it.
+    
+    Profile images of X handles are looked up in avatar_cache (a storage
+    backend) before they are fetched.
+    
+    With compositors > 1 (and a platform that can fork), frames are drawn
+    by that many child processes into a shared-memory ring (see frame_ring)
+    while this process feeds them to the encoder.
+    
+    Otherwise frames identical to the one before are not drawn again (see
+    distinct_frames); the previous frame is sent again instead, which x264
+    encodes as a skipped frame. With variable_frame_rate, ffmpeg drops the
+    repeats and the frame they repeat is shown for longer.
+    """
+    try:
+        scene = prepare_scene(profile_path_or_handle, pepe_image_path, duration=duration,
+                              template=template, tier=tier, avatar_cache=avatar_cache,
+                              avatar_max_age=avatar_max_age)
+        total_frames = scene['total_frames']
+        canvas_width, canvas_height = scene['canvas_size']
+        poster = frame_index(duration * POSTER_PROGRESS, duration, scene['fps'])
+        
+        compositor = None
+        if compositors > 1 and ForkedCompositors.available():
+            # Build what render_frames caches before forking, so the
+            # compositors share it instead of each building their own
+            template_plates(scene['template'], scene['canvas_size'])
+            split_halves(scene)
+            compositor = ForkedCompositors(lambda i, out: render_frames([scene], i, out=out),
+                                           (1, canvas_height, canvas_width, 4), total_frames, compositors)
+            compositor.start()
+        
+        try:
+            # Encode frame by frame, rendering the next frames while ffmpeg
+            # encodes; a cancelled render kills ffmpeg right away
+            # (compositors already run ahead of the encoder in the ring)
+            with FfmpegWriter(output_path, scene['canvas_size'], scene['fps'], codec=codec,
+                              on_data=on_data, pix_fmt='rgba',
+                              queue_frames=0 if compositor else ENCODE_QUEUE_FRAMES,
+                              variable_frame_rate=variable_frame_rate,
+                              **encoder_options(scene['tier'], codec)) as writer:
+                if compositor is not None:
+                    # Frames arrive in shared memory and go to ffmpeg from there
+                    for i, frames in enumerate(compositor):
+                        check_cancelled(deadline, cancel_event)
+                        if i == poster and on_poster is not None:
+                            on_poster(i, encode_still(frames[0]))
+                        writer.write_frame(frames[0])
+                        print(f"Generated frame {i+1}/{total_frames}")
+                else:
+                    # Frames are drawn into buffers the encoder gives back once
+                    # written, so a render allocates no canvases once warm
+                    repeated_frames = 0
+                    with contextlib.closing(distinct_frames(scene, template_buffers(scene['template']))) as frames:
+                        for i, frame, repeated in frames:
+                            check_cancelled(deadline, cancel_event)
+                            if i == poster and on_poster is not None:
+                                on_poster(i, encode_still(frame.array))
+                            writer.write_frame(frame.retain(), done=frame.release)
+                            repeated_frames += repeated
+                            print(f"Generated frame {i+1}/{total_frames}")
+                    logger.info(f"{output_path}: {repeated_frames}/{total_frames} frames repeated the previous one")
         finally:
-            # Clean up temporary files
-            for frame in frames:
-                try:
-                    os.remove(frame)
-                except:
-                    pass
-            try:
-                os.rmdir(temp_dir)
-            except:
-                pass
+            if compositor is not None:
+                compositor.close()
+        print(f"Animation saved to {output_path}")
+        return output_path
     except Exception as e:
         print(f"Error in create_slash_animation: {str(e)}")
         raise
 
+# State of a batch worker process (see render_batch_file)
+_batch_state = {}
+
+def _init_batch_worker(pepe_image_path, tier):
+    """
+    Runs once in every batch worker: loads the template layers so each
+    render only has to prepare its profile.
+    """
+    _batch_state['template'] = load_template(pepe_image_path, tier=tier)
+    _batch_state['tier'] = tier
+    # Per-frame progress from N workers at once would drown the summary
+    sys.stdout = open(os.devnull, 'w')
+
+def _render_batch_item(source, output_path):
+    """
+    Renders one batch item to a temporary file that is renamed into place
+    once complete, so an interrupted run never leaves a truncated video
+    behind. Returns the render time in seconds.
+    """
+    started = time.monotonic()
+    temp_path = temp_path_for(output_path)
+    try:
+        create_slash_animation(source, None, temp_path, template=_batch_state['template'],
+                               tier=_batch_state['tier'])
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return time.monotonic() - started
+
+def read_batch_sources(path):
+    """
+    Reads X handles and image paths, one per line, from a file or from
+    stdin ('-'). Blank lines, '#' comments and repeats are skipped.
+    """
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    sources = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if line and line not in sources:
+            sources.append(line)
+    return sources
+
+def batch_output_name(source):
+    """
+    Stable output file name for a batch item, so a resumed run finds the
+    videos of the previous one.
+    """
+    label = os.path.splitext(os.path.basename(source))[0].lstrip('@')
+    label = re.sub(r'[^A-Za-z0-9_-]+', '_', label).strip('_') or 'profile'
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+    return f"pepe_slash_{label}_{digest}.mp4"
+
+def load_batch_manifest(manifest_path):
+    """
+    Loads the checkpoint manifest of a batch run ({source: item}), or an
+    empty one for a new run.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f).get('items', {})
+
+def save_batch_manifest(manifest_path, items):
+    """
+    Writes the checkpoint manifest atomically, so an interrupt while saving
+    doesn't lose the progress recorded so far.
+    """
+    temp_path = temp_path_for(manifest_path)
+    with open(temp_path, 'w') as f:
+        json.dump({'updated': time.time(), 'items': items}, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+def render_batch_file(sources, pepe_image_path, output_dir, workers=None, tier=None, manifest_path=None):
+    """
+    Renders every source (X handle or image path) into output_dir on
+    `workers` processes (default: one per CPU), each with the template
+    loaded once.
+    
+    Progress is checkpointed to a manifest (default: manifest.json in
+    output_dir) after every video, and items it records as done are
+    skipped, so an interrupted run picks up where it stopped. Failed items
+    are retried on the next run. Returns a summary of the run.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, 'manifest.json')
+    items = load_batch_manifest(manifest_path)
+    
+    todo = []
+    skipped = 0
+    for source in sources:
+        output_path = os.path.join(output_dir, batch_output_name(source))
+        item = items.get(source)
+        if item and item['status'] == 'done' and os.path.exists(item['output']):
+            skipped += 1
+            continue
+        items[source] = {'output': output_path, 'status': 'pending'}
+        todo.append(source)
+    save_batch_manifest(manifest_path, items)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(todo)))
+    print(f"{len(sources)} profiles: {skipped} already rendered, {len(todo)} to render "
+          f"on {workers} workers")
+    
+    summary = {'total': len(sources), 'skipped': skipped, 'rendered': 0, 'failed': 0,
+               'render_seconds': 0.0, 'interrupted': False}
+    started = time.monotonic()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                                      initargs=(pepe_image_path, tier))
+    futures = {}
+    try:
+        futures = {executor.submit(_render_batch_item, source, items[source]['output']): source
+                   for source in todo}
+        for future in concurrent.futures.as_completed(futures):
+            source = futures[future]
+            item = items[source]
+            try:
+                seconds = future.result()
+                item.update(status='done', seconds=round(seconds, 2), finished=time.time())
+                summary['rendered'] += 1
+                summary['render_seconds'] += seconds
+                print(f"[{summary['rendered'] + summary['failed']}/{len(todo)}] {source} -> "
+                      f"{item['output']} ({seconds:.1f}s)")
+            except Exception as e:
+                item.update(status='failed', error=str(e))
+                summary['failed'] += 1
+                print(f"[{summary['rendered'] + summary['failed']}/{len(todo)}] {source} failed: {str(e)}")
+            save_batch_manifest(manifest_path, items)
+        executor.shutdown()
+    except KeyboardInterrupt:
+        summary['interrupted'] = True
+        # Queued renders are cancelled by hand to keep Python 3.8 working
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        save_batch_manifest(manifest_path, items)
+    summary['wall_seconds'] = time.monotonic() - started
+    summary['manifest'] = manifest_path
+    return summary
+
+def print_batch_summary(summary):
+    """Prints the throughput of a batch run"""
+    wall = summary['wall_seconds']
+    rendered = summary['rendered']
+    print()
+    print(f"Rendered {rendered}, failed {summary['failed']}, skipped {summary['skipped']} "
+          f"of {summary['total']} in {wall:.1f}s")
+    if rendered:
+        average = summary['render_seconds'] / rendered
+        print(f"Throughput: {rendered / wall * 60:.1f} videos/min, {average:.1f}s per video "
+              f"({summary['render_seconds'] / wall:.1f}x parallel speedup)")
+    if summary['interrupted'] or summary['failed']:
+        print(f"Run again with the same arguments to resume (checkpoint: {summary['manifest']})")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a Pepe slash animation")
+    parser.add_argument('profile', help="X handle or path to a profile image (with --batch: a file "
+                                        "listing them, one per line, or - for stdin)")
+    parser.add_argument('pepe_image', help="Path to the Pepe chainsaw image")
+    parser.add_argument('output', nargs='?', help="Output path (default: timestamped file in outputs/; "
+                                                  "with --batch: output directory, default outputs/batch)")
+    parser.add_argument('--quality', choices=list(RENDER_TIERS), default=DEFAULT_TIER,
+                        help=f"Render tier (default: {DEFAULT_TIER})")
+    parser.add_argument('--batch', action='store_true',
+                        help="Render every profile listed in the profile file, resuming an earlier run")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Render processes for --batch (default: one per CPU)")
+    parser.add_argument('--manifest', default=None,
+                        help="Checkpoint manifest for --batch (default: manifest.json in the output directory)")
+    parser.add_argument('--tile-threads', type=int, default=0,
+                        help="Threads compositing each frame of a single render in horizontal tiles "
+                             "(default: 0, one thread)")
+    args = parser.parse_args()
+    
     try:
-        # Check if required arguments are provided
-        if len(sys.argv) < 3:
-            print("Usage: python pepe_slash.py <profile_handle_or_path> <pepe_image_path> [output_path]")
-            sys.exit(1)
-
-        # Parse command line arguments
-        profile_path_or_handle = sys.argv[1]
-        pepe_image_path = sys.argv[2]
-        
-        # Create outputs directory if it doesn't exist
-        output_dir = "outputs"
-        os.makedirs(output_dir, exist_ok=True)
+        if args.batch:
+            sources = read_batch_sources(args.profile)
+            summary = render_batch_file(sources, args.pepe_image, args.output or os.path.join("outputs", "batch"),
+                                        workers=args.workers, tier=args.quality, manifest_path=args.manifest)
+            print_batch_summary(summary)
+            if summary['interrupted']:
+                sys.exit(130)
+            sys.exit(1 if summary['failed'] else 0)
         
-        # Generate timestamped filename
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_path = os.path.join(output_dir, f"pepe_slash_{timestamp}.mp4")
+        output_path = args.output
+        if not output_path:
+            # Create outputs directory if it doesn't exist
+            output_dir = "outputs"
+            os.makedirs(output_dir, exist_ok=True)
+            
+            # Generate timestamped filename
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_path = os.path.join(output_dir, f"pepe_slash_{timestamp}.mp4")
 
         # Create animation
-        create_slash_animation(profile_path_or_handle, pepe_image_path, output_path)
+        set_tile_threads(args.tile_threads)
+        create_slash_animation(args.profile, args.pepe_image, output_path, tier=args.quality)
     except Exception as e:
         print(f"Error: {str(e)}")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
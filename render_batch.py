@@ -0,0 +1,136 @@
+"""
+Batch rendering of many profiles on a RenderPool.
+
+Avatars are prefetched on a small thread pool while renders are fanned out
+over the warm workers (which already hold the preprocessed template), with
+a bounded number of renders in flight so a batch never floods the queue
+that interactive requests share.
+"""
+import time
+import logging
+import concurrent.futures
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from render_pool import QueueFull
+
+logger = logging.getLogger(__name__)
+
+class BatchRender:
+    """
+    Renders `items` (dicts with 'profile_source' and 'output_path'; items
+    whose 'status' is already 'done', e.g. cache hits, are passed through)
+    on `pool`, at most `window` at a time (default: one per worker).
+
+    prefetch(item) runs on up to prefetch_concurrency threads before an
+    item is submitted, e.g. to fetch its avatar into the shared cache.
+    admit(item) may return an error message to fail an item instead of
+    rendering it (e.g. when the client ran out of quota). on_update(item)
+    is called when an item's render starts.
+
+    Iterating over the batch yields each item as it finishes, with its
+    'status' set to 'done' (and 'result') or 'failed' (and 'error').
+    """
+
+    def __init__(self, pool, items, tier=None, duration=5.0, window=None, item_timeout=120.0,
+                 prefetch=None, prefetch_concurrency=8, admit=None, on_update=None, poll_interval=0.5):
+        self.pool = pool
+        self.items = items
+        self.tier = tier
+        self.duration = duration
+        self.window = window or pool.max_workers
+        self.item_timeout = item_timeout
+        self.prefetch = prefetch
+        self.prefetch_concurrency = prefetch_concurrency
+        self.admit = admit
+        self.on_update = on_update
+        self.poll_interval = poll_interval
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stops submitting items; renders in flight are cancelled by the
+        iterating thread.
+        """
+        self.cancelled = True
+
+    def _prefetch(self, item):
+        try:
+            self.prefetch(item)
+        except Exception as e:
+            # The render fetches it again (or uses a placeholder)
+            logger.warning(f"Prefetch of {item['profile_source']} failed: {str(e)}")
+
+    def __iter__(self):
+        pending = deque()
+        for item in self.items:
+            if item.get('status') == 'done':
+                yield item
+            else:
+                item['status'] = 'queued'
+                pending.append(item)
+
+        fetcher = None
+        prefetched = {}
+        if self.prefetch is not None and pending:
+            fetcher = ThreadPoolExecutor(max_workers=self.prefetch_concurrency)
+            prefetched = {id(item): fetcher.submit(self._prefetch, item) for item in pending}
+        in_flight = {}
+        try:
+            while pending or in_flight:
+                if self.cancelled:
+                    break
+                # Top up the renders in flight, in order, once avatars are in
+                while pending and len(in_flight) < self.window:
+                    item = pending[0]
+                    fetched = prefetched.get(id(item))
+                    if fetched is not None and not fetched.done():
+                        break
+                    error = self.admit(item) if self.admit is not None else None
+                    if error:
+                        pending.popleft()
+                        item.update(status='failed', error=error)
+                        yield item
+                        continue
+                    try:
+                        future = self.pool.submit(item['profile_source'], item['output_path'],
+                                                  duration=self.duration, timeout=self.item_timeout,
+                                                  deadline=time.time() + self.item_timeout,
+                                                  tier=self.tier)
+                    except QueueFull:
+                        # Interactive traffic has the queue; try again shortly
+                        break
+                    except Exception as e:
+                        pending.popleft()
+                        item.update(status='failed', error=str(e))
+                        yield item
+                        continue
+                    pending.popleft()
+                    item['status'] = 'rendering'
+                    in_flight[future] = item
+                    if self.on_update is not None:
+                        self.on_update(item)
+
+                if not in_flight:
+                    time.sleep(self.poll_interval)
+                    continue
+                done, _ = concurrent.futures.wait(list(in_flight), timeout=self.poll_interval,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight.pop(future)
+                    try:
+                        item.update(status='done', result=future.result())
+                    except Exception as e:
+                        item.update(status='failed', error=str(e) or type(e).__name__)
+                    yield item
+        finally:
+            for future in in_flight:
+                self.pool.cancel(future)
+            for item in list(pending) + list(in_flight.values()):
+                item.update(status='failed', error='Batch cancelled')
+            if fetcher is not None:
+                # Drop prefetches that haven't started (shutdown's
+                # cancel_futures needs Python 3.9)
+                for future in prefetched.values():
+                    future.cancel()
+                fetcher.shutdown(wait=False)
@@ -0,0 +1,141 @@
+"""
+Index of finished renders, so repeat requests for the same profile and
+template are answered with the existing video.
+
+Entries live in memory and, when a storage backend is given, also as
+small records in that storage, so app nodes sharing it share their hits.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+def stream_digest(f, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-256 hex digest of what is left in a binary file object.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+    """
+    with open(path, 'rb') as f:
+        return stream_digest(f, chunk_size)
+
+def cache_key(profile_source, source_type, template_path, **params):
+    """
+    Builds the cache key of a render. Uploaded images are keyed by their
+    contents, given as a path or as a binary file object (read and rewound),
+    X handles by the (case-insensitive) handle. Any extra render parameters
+    (duration, quality, ...) are part of the key.
+    """
+    if source_type == 'uploaded_image' and isinstance(profile_source, str):
+        source = f"image:{file_digest(profile_source)}"
+    elif source_type == 'uploaded_image':
+        # An upload that isn't saved yet; rewind it so it still can be
+        source = f"image:{stream_digest(profile_source)}"
+        profile_source.seek(0)
+    else:
+        source = f"handle:{profile_source.lower()}"
+    extra = ','.join(f"{name}={params[name]}" for name in sorted(params))
+    return hashlib.sha256(f"{source}|{template_path}|{extra}".encode('utf-8')).hexdigest()
+
+def frame_key(render_key, frame):
+    """
+    Cache key of a single frame of a render, derived from the render's
+    cache_key() so a frame request and the video it belongs to agree on
+    what was rendered.
+    """
+    return f"{render_key}-{frame}"
+
+class RenderCache:
+    """
+    Maps cache keys to finished video files. Each entry may expire after
+    its own ttl; without one it is kept until the file disappears.
+
+    With a `storage` backend, entries are also written there as records
+    naming the video, and looked up in `videos` (the video storage) by
+    other nodes that miss in memory.
+    """
+
+    def __init__(self, storage=None, videos=None):
+        self.storage = storage
+        self.videos = videos
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._shared_hits = 0
+        self._misses = 0
+
+    def _get_shared(self, key):
+        data = self.storage.get_bytes(f"{key}.json")
+        if data is None:
+            return None
+        try:
+            record = json.loads(data)
+        except ValueError:
+            return None
+        if record.get('expires') is not None and record['expires'] <= time.time():
+            return None
+        path = self.videos.locate(record['name'])
+        if path is None:
+            return None
+        return path, record.get('expires')
+
+    def get(self, key):
+        """
+        Returns the path of the cached video for `key`, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                path, expires = entry
+                if (expires is None or expires > time.time()) and os.path.exists(path):
+                    self._hits += 1
+                    return path
+                del self._entries[key]
+        entry = self._get_shared(key) if self.storage is not None else None
+        with self._lock:
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries[key] = entry
+            self._shared_hits += 1
+            return entry[0]
+
+    def put(self, key, path, ttl=None):
+        """
+        Records a finished render.
+        """
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (path, expires)
+        if self.storage is not None:
+            record = {'name': os.path.basename(path), 'expires': expires}
+            self.storage.put_bytes(f"{key}.json", json.dumps(record).encode('utf-8'))
+
+    def discard(self, key):
+        """
+        Forgets a render (e.g. after its file was deleted).
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.storage is not None:
+            self.storage.delete(f"{key}.json")
+
+    def stats(self):
+        """
+        Returns a snapshot of the cache's counters.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self._hits,
+                'shared_hits': self._shared_hits,
+                'misses': self._misses,
+            }
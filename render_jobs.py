@@ -0,0 +1,61 @@
+"""
+Registry of renders that finish in the background, so clients can poll
+for their status (e.g. the full-quality render behind a preview).
+"""
+import threading
+import time
+import uuid
+
+class JobRegistry:
+    """
+    Thread-safe map of job ids to status dicts. Jobs are forgotten `ttl`
+    seconds after they were created.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        expired = [job_id for job_id, job in self._jobs.items() if now - job['created'] > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def create(self, **fields):
+        """
+        Registers a new job and returns its id.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            self._jobs[job_id] = dict(fields, job_id=job_id, created=now)
+        return job_id
+
+    def update(self, job_id, **fields):
+        """
+        Updates a job's fields (ignored if the job has been forgotten).
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def get(self, job_id):
+        """
+        Returns a copy of the job's fields, or None for unknown jobs.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def stats(self):
+        """
+        Returns the number of known jobs per status.
+        """
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.get('status')] = counts.get(job.get('status'), 0) + 1
+            return counts
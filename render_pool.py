@@ -0,0 +1,895 @@
+"""
+Warm render worker pool.
+
+Workers are started once (through a forkserver where the platform has one,
+spawn otherwise), import the render stack a single time and keep the
+preprocessed template layers in memory, so a job only pays for the frames
+it actually renders. With a template bundle directory, the layers are
+compiled once on disk (see template_bundle) and every worker maps the same
+copy read-only.
+
+Every job reports its memory use. Workers are recycled after a number of
+jobs or once they cross a memory watermark, and jobs are only admitted
+while their estimated memory fits the box's budget and the queue of
+waiting renders is not full.
+
+Submitted jobs carry a deadline and a cancel event that the render loop
+checks between frames, so abandoned renders stop promptly.
+"""
+import os
+import sys
+import hashlib
+import logging
+import subprocess
+import multiprocessing
+import threading
+import time
+import math
+import tracemalloc
+import concurrent.futures
+import functools
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from encoder import get_ffmpeg_binary
+from pepe_slash import RenderCancelled, ENCODE_QUEUE_FRAMES
+from render_cache import file_digest
+from retention import ArtifactIndex
+from storage import make_storage, temp_path_for
+from template_bundle import ensure_template_bundles
+from frame_buffers import allocation_stats
+from render_tiers import RENDER_TIERS, DEFAULT_TIER, get_tier
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# H.264 encoders we know how to drive, in order of preference
+H264_ENCODERS = ['libx264', 'h264_nvenc', 'h264_qsv', 'h264_videotoolbox', 'h264_amf', 'libopenh264']
+
+# Modules the forkserver imports once so forked workers inherit them
+PRELOAD_MODULES = ['pepe_slash', 'template_bundle']
+
+# Per-process state filled in by _init_worker
+_worker_state = {}
+
+# Rough fixed cost of a warm worker (interpreter, numpy and PIL, template layers)
+WORKER_BASE_MEMORY = 200 * 1024 * 1024
+
+# Full-canvas RGBA images alive at the same time while rendering a frame
+# (canvas, shaken copy, blurred copy, glow layer, encoder buffers, frames
+# queued for the encoder)
+FRAME_BUFFERS_PER_JOB = 8 + ENCODE_QUEUE_FRAMES
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a render cannot fit in the memory budget"""
+    pass
+
+class QueueFull(Exception):
+    """Raised when too many renders are already waiting for a worker"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def current_rss():
+    """
+    Returns the resident set size of this process in bytes, or None if it
+    cannot be determined on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in bytes, or None.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def cpu_seconds_between(before, after):
+    """
+    Returns the CPU time spent between two os.times() samples, including
+    finished child processes such as ffmpeg (those are only counted on
+    POSIX systems).
+    """
+    return ((after.user - before.user) + (after.system - before.system)
+            + (after.children_user - before.children_user)
+            + (after.children_system - before.children_system))
+
+def total_memory():
+    """
+    Returns the physical memory of the box in bytes, or None.
+    """
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def estimate_job_memory(canvas_size=(1280, 720)):
+    """
+    Estimates the peak memory of one render job in bytes.
+    """
+    frame_bytes = canvas_size[0] * canvas_size[1] * 4
+    return WORKER_BASE_MEMORY + FRAME_BUFFERS_PER_JOB * frame_bytes
+
+def probe_h264_encoders(ffmpeg_binary):
+    """
+    Returns the H.264 encoders supported by the given ffmpeg build, preferred first.
+    """
+    try:
+        result = subprocess.run([ffmpeg_binary, '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not list ffmpeg encoders: {str(e)}")
+        return []
+
+    # Lines look like " V....D libx264   libx264 H.264 / AVC / MPEG-4 AVC ..."
+    available = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0].startswith('V'):
+            available.add(parts[1])
+    return [name for name in H264_ENCODERS if name in available]
+
+def _start_method():
+    """Prefer a forkserver so workers are forked from an already-warm process"""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return 'forkserver'
+    return 'spawn'
+
+def _init_worker(pepe_image_path, saw_path, codec, video_storage=None, avatar_storage=None,
+                 avatar_max_age=None, template_bundles=None, tile_threads=0, variable_frame_rate=False,
+                 artifact_db=None):
+    """
+    Runs once in every worker process: imports the render stack and loads
+    the template layers so jobs can start rendering straight away. The
+    storage backends are given as (backend, root) pairs; template_bundles
+    maps tiers to compiled bundles to map instead of loading the layers.
+    tile_threads is passed to pepe_slash.set_tile_threads(), and
+    variable_frame_rate to every render. Avatars the worker caches are
+    recorded in the retention index at artifact_db.
+    """
+    from pepe_slash import load_template, set_tile_threads
+    from template_bundle import load_template_bundle
+
+    # Template layers are sized per tier, so prepare one set for each
+    _worker_state['templates'] = {
+        name: (load_template_bundle(template_bundles[name]) if template_bundles
+               else load_template(pepe_image_path, saw_path=saw_path, tier=name))
+        for name in RENDER_TIERS
+    }
+    _worker_state['codec'] = codec
+    _worker_state['variable_frame_rate'] = variable_frame_rate
+    set_tile_threads(tile_threads)
+    _worker_state['jobs_done'] = 0
+    _worker_state['videos'] = make_storage(*video_storage) if video_storage else None
+    artifacts = ArtifactIndex(artifact_db) if artifact_db else None
+    _worker_state['avatars'] = make_storage(
+        *avatar_storage,
+        on_put=(lambda path, size: artifacts.add(path, 'avatar', size)) if artifacts else None
+    ) if avatar_storage else None
+    _worker_state['avatar_max_age'] = avatar_max_age
+    tracemalloc.start()
+    logger.info(f"Render worker {os.getpid()} ready (codec: {codec})")
+
+def _warmup():
+    """No-op job used to make sure workers are started before real traffic"""
+    return os.getpid()
+
+def _temp_output(output_path):
+    """Temporary path a video is encoded to before it is published"""
+    videos = _worker_state['videos']
+    if videos is not None:
+        return videos.temp_path(os.path.basename(output_path))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    return temp_path_for(output_path)
+
+def _publish_output(temp_path, output_path, return_bytes):
+    """
+    Publishes a finished video under output_path and returns its part of
+    the job result (final path, validators and, if small, its bytes).
+    """
+    videos = _worker_state['videos']
+    # The file never changes once written, so its validators are final now;
+    # hashing here keeps that work off the web process
+    try:
+        st = os.stat(temp_path)
+        video_bytes = None
+        if st.st_size <= return_bytes:
+            # Still in the page cache: read it once for both the hash and the caller
+            with open(temp_path, 'rb') as f:
+                video_bytes = f.read()
+            etag = hashlib.sha256(video_bytes).hexdigest()
+        else:
+            etag = file_digest(temp_path)
+        if videos is not None:
+            output_path = videos.publish(temp_path, os.path.basename(output_path))
+        else:
+            os.replace(temp_path, output_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return {
+        'output_path': output_path,
+        'video': {'etag': etag, 'size': st.st_size, 'mtime': st.st_mtime},
+        'video_bytes': video_bytes,
+    }
+
+def _job_memory(rss_before, traced_before, buffers_before):
+    """
+    Memory accounting of the job(s) that just ran in this worker, including
+    the frame buffers they had to allocate rather than reuse.
+    """
+    traced_after, traced_peak = tracemalloc.get_traced_memory()
+    buffers_after = allocation_stats()
+    return {
+        'pid': os.getpid(),
+        'jobs_done': _worker_state['jobs_done'],
+        'rss_before': rss_before,
+        'rss_after': current_rss(),
+        'rss_peak': peak_rss(),
+        'tracemalloc_delta': traced_after - traced_before,
+        'tracemalloc_peak': traced_peak - traced_before,
+        'buffer_allocations': buffers_after['allocations'] - buffers_before['allocations'],
+        'buffer_allocated_bytes': buffers_after['allocated_bytes'] - buffers_before['allocated_bytes'],
+        'buffer_reuses': buffers_after['reuses'] - buffers_before['reuses'],
+    }
+
+def _run_job(profile_source, output_path, duration, deadline=None, cancel_event=None, tier=None,
+             stream_queue=None, return_bytes=0, compositors=0):
+    """
+    Renders one animation inside a warm worker and returns the output path
+    together with the job's memory accounting.
+
+    The video is encoded to a temporary file and only renamed to
+    output_path once it is complete. With a stream_queue, chunks of a
+    fragmented MP4 are put on it while the video is encoded, followed by
+    None once the render has ended. Videos of up to return_bytes bytes are
+    sent back with the result as video_bytes, and the poster frame (see
+    pepe_slash.POSTER_PROGRESS) as poster, a JPEG, with its index as
+    poster_frame. With compositors > 1, frames are drawn by that many child
+    processes (see frame_ring).
+    """
+    from pepe_slash import create_slash_animation
+
+    if hasattr(tracemalloc, 'reset_peak'):
+        # Python 3.9+; on older versions the peak covers the worker's lifetime
+        tracemalloc.reset_peak()
+    traced_before, _ = tracemalloc.get_traced_memory()
+    buffers_before = allocation_stats()
+    rss_before = current_rss()
+    started = time.monotonic()
+    cpu_before = os.times()
+
+    tier = tier or DEFAULT_TIER
+    temp_path = _temp_output(output_path)
+    poster = {}
+    try:
+        create_slash_animation(profile_source, None, temp_path, duration=duration,
+                               template=_worker_state['templates'][tier],
+                               codec=_worker_state['codec'],
+                               deadline=deadline, cancel_event=cancel_event, tier=tier,
+                               on_data=stream_queue.put if stream_queue is not None else None,
+                               avatar_cache=_worker_state['avatars'],
+                               avatar_max_age=_worker_state['avatar_max_age'],
+                               compositors=compositors,
+                               variable_frame_rate=_worker_state['variable_frame_rate'],
+                               on_poster=lambda i, image: poster.update(poster_frame=i, poster=image))
+    finally:
+        if stream_queue is not None:
+            stream_queue.put(None)
+
+    cpu_after = os.times()
+    _worker_state['jobs_done'] += 1
+    result = _publish_output(temp_path, output_path, return_bytes)
+    result.update(poster)
+    result.update(
+        render_seconds=time.monotonic() - started,
+        cpu_seconds=cpu_seconds_between(cpu_before, cpu_after),
+        memory=_job_memory(rss_before, traced_before, buffers_before),
+    )
+    return result
+
+def _run_batch_job(jobs, duration, tier=None, return_bytes=0):
+    """
+    Renders several animations of one tier in a single pass (see
+    pepe_slash.create_slash_animations). jobs are dicts with the arguments
+    of _run_job. Returns one entry per job: its result, as _run_job's, or
+    the exception that stopped it. The batch's CPU time is split evenly.
+    """
+    from pepe_slash import create_slash_animations
+
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    traced_before, _ = tracemalloc.get_traced_memory()
+    buffers_before = allocation_stats()
+    rss_before = current_rss()
+    started = time.monotonic()
+    cpu_before = os.times()
+
+    tier = tier or DEFAULT_TIER
+    temp_paths = [_temp_output(job['output_path']) for job in jobs]
+    posters = [{} for _ in jobs]
+    specs = [{
+        'profile': job['profile_source'],
+        'output_path': temp_path,
+        'deadline': job.get('deadline'),
+        'cancel_event': job.get('cancel_event'),
+        'on_data': job['stream_queue'].put if job.get('stream_queue') is not None else None,
+        'on_poster': lambda i, image, poster=poster: poster.update(poster_frame=i, poster=image),
+    } for job, temp_path, poster in zip(jobs, temp_paths, posters)]
+    try:
+        errors = create_slash_animations(specs, None, duration=duration,
+                                         template=_worker_state['templates'][tier],
+                                         codec=_worker_state['codec'], tier=tier,
+                                         avatar_cache=_worker_state['avatars'],
+                                         avatar_max_age=_worker_state['avatar_max_age'],
+                                         variable_frame_rate=_worker_state['variable_frame_rate'])
+    finally:
+        for job in jobs:
+            if job.get('stream_queue') is not None:
+                job['stream_queue'].put(None)
+
+    cpu_after = os.times()
+    _worker_state['jobs_done'] += len(jobs)
+    render_seconds = time.monotonic() - started
+    cpu_seconds = cpu_seconds_between(cpu_before, cpu_after) / len(jobs)
+    memory = _job_memory(rss_before, traced_before, buffers_before)
+    results = []
+    for job, temp_path, poster, error in zip(jobs, temp_paths, posters, errors):
+        if error is not None:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            results.append(error)
+            continue
+        try:
+            result = _publish_output(temp_path, job['output_path'], return_bytes)
+        except Exception as e:
+            results.append(e)
+            continue
+        result.update(poster)
+        result.update(render_seconds=render_seconds, cpu_seconds=cpu_seconds, memory=memory,
+                      batch_size=len(jobs))
+        results.append(result)
+    return results
+
+def _run_frame_job(profile_source, t, duration, cancel_event=None, tier=None):
+    """
+    Renders the single frame t seconds into an animation (see
+    pepe_slash.render_frame_at) and returns it as image, a JPEG, with its
+    index as frame, and the CPU time it took.
+    """
+    from pepe_slash import render_frame_at, encode_still, check_cancelled
+
+    # Frames queue behind renders; don't start one nobody waits for any more
+    check_cancelled(cancel_event=cancel_event)
+    started = time.monotonic()
+    cpu_before = os.times()
+    tier = tier or DEFAULT_TIER
+    i, frame = render_frame_at(profile_source, None, t, duration=duration,
+                               template=_worker_state['templates'][tier], tier=tier,
+                               avatar_cache=_worker_state['avatars'],
+                               avatar_max_age=_worker_state['avatar_max_age'])
+    image = encode_still(frame)
+    return {
+        'frame': i,
+        'image': image,
+        'render_seconds': time.monotonic() - started,
+        'cpu_seconds': cpu_seconds_between(cpu_before, os.times()),
+    }
+
+class RenderPool:
+    """
+    Pool of warm render workers. The pool is started lazily on first use,
+    or explicitly with start().
+
+    max_jobs_per_worker and worker_memory_limit (bytes) control recycling;
+    memory_budget (bytes) caps the estimated memory of jobs in flight and
+    defaults to three quarters of the box's physical memory. max_queue is
+    how many renders may wait for a busy worker before submit() raises
+    QueueFull (None for no limit). Videos of up to return_video_bytes bytes
+    come back in the job result, e.g. to warm an in-memory cache.
+
+    video_storage and avatar_storage are (backend, root) pairs of
+    storage.make_storage() backends that workers publish videos to and
+    cache fetched avatars in (for avatar_max_age seconds). With artifact_db,
+    the avatars they cache are recorded in that retention index (see
+    retention.ArtifactIndex) so they are evicted like other artifacts.
+
+    With batch_size > 1, renders submitted while every worker is busy are
+    grouped (per tier and duration) for up to batch_window seconds and
+    rendered batch_size at a time in one pass on a single worker, which
+    shares the profile-independent work of each frame between them.
+
+    With template_bundle_dir, the template is compiled into bundles there
+    when the pool starts, and workers memory-map them (shared, read-only)
+    instead of each preparing their own copy of the layers.
+
+    With compositors > 1, a render submitted while no other render is in
+    flight has its frames drawn by that many processes, which pass them to
+    the worker (and on to ffmpeg) through shared memory. tile_threads > 1
+    has every worker composite each frame in that many horizontal tiles in
+    parallel threads. With variable_frame_rate, frames that repeat the one
+    before are dropped from the videos and the previous frame is shown for
+    longer instead.
+    """
+
+    def __init__(self, pepe_image_path, max_workers=None, saw_path='saww.jpg',
+                 max_jobs_per_worker=50, worker_memory_limit=1024 * 1024 * 1024,
+                 memory_budget=None, max_queue=None, return_video_bytes=0,
+                 video_storage=None, avatar_storage=None, avatar_max_age=3600,
+                 batch_size=1, batch_window=0.05, template_bundle_dir=None, compositors=0,
+                 tile_threads=0, variable_frame_rate=False, artifact_db=None):
+        self.pepe_image_path = pepe_image_path
+        self.saw_path = saw_path
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.worker_memory_limit = worker_memory_limit
+        if memory_budget is None:
+            physical = total_memory()
+            memory_budget = int(physical * 0.75) if physical else None
+        self.memory_budget = memory_budget
+        self.max_queue = max_queue
+        self.return_video_bytes = return_video_bytes
+        self.video_storage = video_storage
+        self.avatar_storage = avatar_storage
+        self.avatar_max_age = avatar_max_age
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.template_bundle_dir = template_bundle_dir
+        self.compositors = compositors
+        self.tile_threads = tile_threads
+        self.variable_frame_rate = variable_frame_rate
+        self.artifact_db = artifact_db
+        self._template_bundles = None
+        self.codec = None
+        self._method = None
+        self._executor = None
+        self._manager = None
+        self._lock = threading.Lock()
+        self._memory_available = threading.Condition(self._lock)
+        self._reserved_memory = 0
+        self._jobs_submitted = 0
+        self._jobs_in_generation = 0
+        self._recycles = 0
+        self._last_job_memory = None
+        self._pending = 0
+        self._queue_rejections = 0
+        # (tier, duration) -> renders waiting to be dispatched as one batch
+        self._batches = {}
+        self._batches_dispatched = 0
+        self._batched_jobs = 0
+        self._frames_rendered = 0
+        # Moving average of render time, used to suggest a Retry-After
+        self._avg_render_seconds = None
+
+    def _new_executor(self):
+        """Creates a fresh generation of workers (caller holds the lock)"""
+        ctx = multiprocessing.get_context(self._method)
+        options = {}
+        if sys.version_info >= (3, 11) and self.max_jobs_per_worker:
+            # Recycle individual workers after N jobs
+            options['max_tasks_per_child'] = self.max_jobs_per_worker
+        executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(self.pepe_image_path, self.saw_path, self.codec, self.video_storage,
+                      self.avatar_storage, self.avatar_max_age, self._template_bundles,
+                      self.tile_threads, self.variable_frame_rate, self.artifact_db),
+            **options
+        )
+        self._jobs_in_generation = 0
+        return executor
+
+    def start(self):
+        """
+        Starts the worker processes and waits until each one has warmed up.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return
+
+            # Check the available H.264 encoders once for the whole pool
+            encoders = probe_h264_encoders(get_ffmpeg_binary())
+            self.codec = encoders[0] if encoders else 'libx264'
+            logger.info(f"Available H.264 encoders: {encoders}, using {self.codec}")
+
+            if self.template_bundle_dir:
+                try:
+                    self._template_bundles = ensure_template_bundles(self.pepe_image_path, self.template_bundle_dir,
+                                                                     saw_path=self.saw_path)
+                except Exception as e:
+                    # Workers fall back to preparing the layers themselves
+                    logger.error(f"Could not compile template bundles: {str(e)}")
+
+            self._method = _start_method()
+            if self._method == 'forkserver':
+                multiprocessing.get_context('forkserver').set_forkserver_preload(PRELOAD_MODULES)
+
+            self._executor = self._new_executor()
+            # Cancel events have to be shared with the worker processes
+            self._manager = multiprocessing.get_context(self._method).Manager()
+            logger.info(f"Starting {self.max_workers} render workers ({self._method})")
+            warmups = [self._executor.submit(_warmup) for _ in range(self.max_workers)]
+        pids = {future.result() for future in warmups}
+        logger.info(f"Render workers ready: {sorted(pids)}")
+
+    def _recycle(self, reason):
+        """
+        Replaces the current workers with a fresh generation. The old
+        generation drains: jobs already queued on it still finish before
+        its processes exit. Caller holds the lock.
+        """
+        logger.info(f"Recycling render workers: {reason}")
+        old_executor = self._executor
+        self._executor = self._new_executor()
+        self._recycles += 1
+        old_executor.shutdown(wait=False)
+
+    def _executor_submit(self, fn, *args, **kwargs):
+        """
+        Submits a job to the current workers and returns (future, executor).
+        A pool broken by a worker that died abruptly (e.g. killed for
+        running out of memory) takes no jobs anymore: it is recycled and
+        the job submitted once more. Caller holds the lock.
+        """
+        try:
+            return self._executor.submit(fn, *args, **kwargs), self._executor
+        except BrokenProcessPool as e:
+            self._recycle(f"the pool is broken: {str(e)}")
+        return self._executor.submit(fn, *args, **kwargs), self._executor
+
+    def _recycle_if_broken(self, future, executor):
+        """
+        Recycles the workers if a job failed because its worker died
+        abruptly. Caller holds the lock.
+        """
+        if isinstance(future.exception(), BrokenProcessPool) and executor is self._executor:
+            self._recycle("a render worker died")
+
+    def _job_finished(self, future, executor, estimate):
+        """Releases the job's memory reservation and recycles workers if needed"""
+        with self._lock:
+            self._reserved_memory -= estimate
+            self._pending -= 1
+            self._memory_available.notify_all()
+
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                self._recycle_if_broken(future, executor)
+                return
+            result = future.result()
+            if self._avg_render_seconds is None:
+                self._avg_render_seconds = result['render_seconds']
+            else:
+                self._avg_render_seconds = 0.8 * self._avg_render_seconds + 0.2 * result['render_seconds']
+            memory = result['memory']
+            self._last_job_memory = memory
+            logger.info(f"Render memory (pid {memory['pid']}): rss_peak={memory['rss_peak']} "
+                        f"tracemalloc_delta={memory['tracemalloc_delta']} "
+                        f"tracemalloc_peak={memory['tracemalloc_peak']} "
+                        f"buffer_allocations={memory['buffer_allocations']}")
+
+            # Only act on the generation that is still taking new jobs
+            if executor is not self._executor:
+                return
+            rss = memory['rss_after'] or memory['rss_peak']
+            if self.worker_memory_limit and rss and rss > self.worker_memory_limit:
+                self._recycle(f"worker {memory['pid']} at {rss} bytes is over the memory watermark")
+            elif (sys.version_info < (3, 11) and self.max_jobs_per_worker
+                    and self._jobs_in_generation >= self.max_jobs_per_worker * self.max_workers):
+                self._recycle(f"{self._jobs_in_generation} jobs since the last recycle")
+
+    def retry_after(self):
+        """
+        Suggests how many seconds a rejected client should wait, based on
+        the queue length and recent render times.
+        """
+        with self._lock:
+            return self._retry_after()
+
+    def _retry_after(self):
+        average = self._avg_render_seconds or 10.0
+        return max(1, math.ceil(average * self._pending / self.max_workers))
+
+    def expected_wait(self):
+        """
+        Estimates how long a render submitted now would wait for a free
+        worker, from the queue length and recent render times.
+        """
+        with self._lock:
+            return self._expected_wait()
+
+    def _expected_wait(self):
+        if self._avg_render_seconds is None:
+            return 0.0
+        queued_ahead = max(0, self._pending + 1 - self.max_workers)
+        return self._avg_render_seconds * queued_ahead / self.max_workers
+
+    def submit(self, profile_source, output_path, duration=5.0, timeout=None, deadline=None,
+               tier=None, stream=False):
+        """
+        Queues a render on a warm worker and returns its Future. The render
+        uses the named quality tier and gives up once `deadline` (a
+        time.time() timestamp) passes or the job is cancelled with cancel().
+        With stream=True the video can be read with iter_stream() while it
+        is being encoded.
+
+        Raises QueueFull if max_queue renders are already waiting. Waits (up
+        to timeout seconds) while the memory budget is taken by other jobs,
+        and raises MemoryBudgetExceeded if the job can never fit or is not
+        admitted in time.
+        """
+        self.start()
+        estimate = estimate_job_memory(get_tier(tier)['canvas_size'])
+        with self._lock:
+            if self.max_queue is not None and self._pending >= self.max_workers + self.max_queue:
+                self._queue_rejections += 1
+                raise QueueFull(f"{self._pending} renders already queued", self._retry_after())
+            self._pending += 1
+            if self.memory_budget:
+                if estimate > self.memory_budget:
+                    self._pending -= 1
+                    raise MemoryBudgetExceeded(
+                        f"Render needs about {estimate} bytes, budget is {self.memory_budget}")
+                admitted = self._memory_available.wait_for(
+                    lambda: self._reserved_memory + estimate <= self.memory_budget, timeout=timeout)
+                if not admitted:
+                    self._pending -= 1
+                    raise MemoryBudgetExceeded("Timed out waiting for render memory")
+            self._reserved_memory += estimate
+            self._jobs_submitted += 1
+            executor = self._executor
+            cancel_event = self._manager.Event()
+            stream_queue = self._manager.Queue() if stream else None
+            batch_key = None
+            if self.batch_size > 1 and self._pending > self.max_workers:
+                # It would wait for a worker anyway: wait with others to share one
+                batch_key = (tier or DEFAULT_TIER, duration)
+                future = concurrent.futures.Future()
+                batch = self._batches.get(batch_key)
+                if batch is None:
+                    timer = threading.Timer(self.batch_window, self._dispatch_batch, args=(batch_key,))
+                    timer.daemon = True
+                    batch = self._batches[batch_key] = {'jobs': [], 'timer': timer}
+                    timer.start()
+                batch['jobs'].append({
+                    'profile_source': profile_source,
+                    'output_path': output_path,
+                    'deadline': deadline,
+                    'cancel_event': cancel_event,
+                    'stream_queue': stream_queue,
+                    'future': future,
+                })
+                if len(batch['jobs']) < self.batch_size:
+                    batch_key = None
+            else:
+                # Spare cores only go to compositing while this is the only render
+                try:
+                    future, executor = self._executor_submit(
+                        _run_job, profile_source, output_path, duration,
+                        deadline=deadline, cancel_event=cancel_event, tier=tier,
+                        stream_queue=stream_queue, return_bytes=self.return_video_bytes,
+                        compositors=self.compositors if self._pending == 1 else 0)
+                except Exception:
+                    # Nothing was queued: give back what the job took
+                    self._pending -= 1
+                    self._reserved_memory -= estimate
+                    self._jobs_submitted -= 1
+                    self._memory_available.notify_all()
+                    raise
+            self._jobs_in_generation += 1
+            future.cancel_event = cancel_event
+            future.stream_queue = stream_queue
+        future.add_done_callback(lambda f: self._job_finished(f, executor, estimate))
+        if batch_key is not None:
+            # Full batch, no need to wait for the window to close
+            self._dispatch_batch(batch_key)
+        return future
+
+    def _dispatch_batch(self, key):
+        """
+        Sends the renders waiting under key to a worker: alone as a regular
+        job if only one is left, otherwise as one batch job. Renders
+        cancelled while they waited are dropped.
+        """
+        with self._lock:
+            batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        batch['timer'].cancel()
+        jobs = [job for job in batch['jobs'] if job['future'].set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        futures = [job.pop('future') for job in jobs]
+        tier, duration = key
+        try:
+            with self._lock:
+                if len(jobs) == 1:
+                    job = jobs[0]
+                    outer, _ = self._executor_submit(
+                        _run_job, job['profile_source'], job['output_path'], duration,
+                        deadline=job['deadline'], cancel_event=job['cancel_event'],
+                        tier=tier, stream_queue=job['stream_queue'],
+                        return_bytes=self.return_video_bytes)
+                else:
+                    outer, _ = self._executor_submit(_run_batch_job, jobs, duration, tier=tier,
+                                                     return_bytes=self.return_video_bytes)
+                    self._batches_dispatched += 1
+                    self._batched_jobs += len(jobs)
+        except Exception as e:
+            # The pool is shutting down, or broke again right away
+            for future in futures:
+                future.set_exception(e)
+            return
+        outer.add_done_callback(functools.partial(self._batch_finished, futures=futures))
+
+    def _batch_finished(self, outer, futures):
+        """Hands the outcome of a dispatched batch to each render's Future"""
+        if outer.cancelled():
+            results = [RenderCancelled("Render cancelled")] * len(futures)
+        elif outer.exception() is not None:
+            results = [outer.exception()] * len(futures)
+        else:
+            results = outer.result()
+            if len(futures) == 1:
+                results = [results]
+        for future, result in zip(futures, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def cancel(self, future):
+        """
+        Cancels a submitted render: drops it if it is still queued, otherwise
+        tells the worker to stop at the next frame.
+        """
+        if not future.cancel():
+            try:
+                future.cancel_event.set()
+            except (OSError, EOFError):
+                # The manager is already gone (pool shutting down)
+                pass
+
+    def wait(self, future, deadline=None, abandoned=None, poll_interval=0.5):
+        """
+        Waits for a submitted render and returns its result. Cancels the
+        render and raises RenderCancelled once the deadline passes or
+        abandoned() returns True (e.g. the client disconnected).
+        """
+        while True:
+            try:
+                return future.result(timeout=poll_interval)
+            except concurrent.futures.TimeoutError:
+                pass
+            if deadline is not None and time.time() > deadline:
+                self.cancel(future)
+                raise RenderCancelled("Render deadline exceeded")
+            if abandoned is not None and abandoned():
+                self.cancel(future)
+                raise RenderCancelled("Render abandoned by the client")
+
+    def iter_stream(self, future, deadline=None, abandoned=None, poll_interval=0.5):
+        """
+        Yields chunks of a fragmented MP4 of a render submitted with
+        stream=True as the worker encodes it. Raises like wait() if the
+        render fails or is cancelled; closing the generator early cancels
+        the render.
+        """
+        finished = False
+        try:
+            while True:
+                try:
+                    chunk = future.stream_queue.get(timeout=poll_interval)
+                except queue.Empty:
+                    if future.done():
+                        # The worker died without ending the stream
+                        finished = True
+                        future.result()
+                        return
+                    if deadline is not None and time.time() > deadline:
+                        raise RenderCancelled("Render deadline exceeded")
+                    if abandoned is not None and abandoned():
+                        raise RenderCancelled("Render abandoned by the client")
+                    continue
+                if chunk is None:
+                    break
+                yield chunk
+            # The stream has ended; surface the render's outcome
+            finished = True
+            self.wait(future, deadline=deadline, abandoned=abandoned)
+        finally:
+            if not finished:
+                self.cancel(future)
+
+    def render_frame(self, profile_source, t, duration=5.0, deadline=None, abandoned=None, tier=None):
+        """
+        Renders the single frame t seconds into an animation on a warm
+        worker and returns _run_frame_job's result. Frames wait in the same
+        queue as renders (and raise QueueFull like submit()), but take only
+        one canvas, so they are not held to the memory budget.
+        """
+        self.start()
+        with self._lock:
+            if self.max_queue is not None and self._pending >= self.max_workers + self.max_queue:
+                self._queue_rejections += 1
+                raise QueueFull(f"{self._pending} renders already queued", self._retry_after())
+            self._pending += 1
+            cancel_event = self._manager.Event()
+            try:
+                future, executor = self._executor_submit(_run_frame_job, profile_source, t, duration,
+                                                         cancel_event=cancel_event, tier=tier)
+            except Exception:
+                self._pending -= 1
+                raise
+            future.cancel_event = cancel_event
+        future.add_done_callback(lambda f: self._frame_finished(f, executor))
+        return self.wait(future, deadline=deadline, abandoned=abandoned)
+
+    def _frame_finished(self, future, executor):
+        """Takes a finished frame job off the queue"""
+        with self._lock:
+            self._pending -= 1
+            self._frames_rendered += 1
+            if not future.cancelled() and future.exception() is not None:
+                self._recycle_if_broken(future, executor)
+
+    def render(self, profile_source, output_path, duration=5.0, timeout=None,
+               deadline=None, abandoned=None, tier=None):
+        """
+        Renders an animation on a warm worker and blocks until it is written.
+        """
+        future = self.submit(profile_source, output_path, duration, timeout=timeout, deadline=deadline,
+                             tier=tier)
+        return self.wait(future, deadline=deadline, abandoned=abandoned)
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool's counters.
+        """
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'codec': self.codec,
+                'jobs_submitted': self._jobs_submitted,
+                'pending': self._pending,
+                'max_queue': self.max_queue,
+                'queue_rejections': self._queue_rejections,
+                'batch_size': self.batch_size,
+                'batches': self._batches_dispatched,
+                'batched_jobs': self._batched_jobs,
+                'frames_rendered': self._frames_rendered,
+                'avg_render_seconds': self._avg_render_seconds,
+                'expected_wait': self._expected_wait(),
+                'recycles': self._recycles,
+                'reserved_memory': self._reserved_memory,
+                'memory_budget': self.memory_budget,
+                'last_job_memory': self._last_job_memory,
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker processes.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+            if self._manager is not None:
+                self._manager.shutdown()
+                self._manager = None
@@ -0,0 +1,173 @@
+"""
+Named render quality tiers.
+
+A tier bundles everything that trades quality for render time: canvas
+size, frame rate, the resampling filter used for resizes and rotations,
+and the x264 preset/CRF/tune and thread count used to encode.
+
+AdaptiveTierSelector trades quality for latency under load by picking a
+cheaper tier while the render queue is backed up.
+"""
+import threading
+import time
+
+from PIL import Image
+
+RENDER_TIERS = {
+    # Interactive previews: quarter the pixels, half the frames, cheapest filters
+    'preview': {
+        'canvas_size': (640, 360),
+        'fps': 15,
+        'resample': 'nearest',
+        'preset': 'ultrafast',
+        'crf': 30,
+        'tune': 'fastdecode',
+        'threads': 2,
+    },
+    'standard': {
+        'canvas_size': (1280, 720),
+        'fps': 30,
+        'resample': 'bilinear',
+        'preset': 'veryfast',
+        'crf': 23,
+        'tune': 'animation',
+        'threads': 0,
+    },
+    # What every render used before tiers existed (23 is libx264's default CRF)
+    'hq': {
+        'canvas_size': (1280, 720),
+        'fps': 30,
+        'resample': 'lanczos',
+        'preset': 'medium',
+        'crf': 23,
+        'tune': None,
+        'threads': 0,
+    },
+}
+
+# Requests that don't pick a tier get the same encode as before tiers existed
+DEFAULT_TIER = 'hq'
+
+# Template layouts are designed on a 1280x720 canvas and scaled from there
+BASE_CANVAS_WIDTH = 1280
+
+_RESAMPLE_FILTERS = {
+    'nearest': Image.Resampling.NEAREST,
+    'bilinear': Image.Resampling.BILINEAR,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+
+def get_tier(name):
+    """
+    Returns the settings of a tier by name (None for the default tier).
+    Raises ValueError for unknown tiers.
+    """
+    name = name or DEFAULT_TIER
+    if name not in RENDER_TIERS:
+        raise ValueError(f"Unknown render tier '{name}', expected one of: {', '.join(RENDER_TIERS)}")
+    return RENDER_TIERS[name]
+
+def resize_filter(tier):
+    """Resampling filter for resizing images in this tier"""
+    return _RESAMPLE_FILTERS[tier['resample']]
+
+def rotate_filter(tier):
+    """Resampling filter for rotating images (rotate() has no LANCZOS, use BICUBIC)"""
+    if tier['resample'] == 'lanczos':
+        return Image.Resampling.BICUBIC
+    return _RESAMPLE_FILTERS[tier['resample']]
+
+def tier_scale(tier):
+    """Scale of this tier's canvas relative to the 1280x720 layout"""
+    return tier['canvas_size'][0] / BASE_CANVAS_WIDTH
+
+def encoder_options(tier, codec):
+    """
+    Returns the FfmpegWriter keyword arguments for encoding a tier with the
+    given codec. Preset names, CRF and tune are x264 options; hardware
+    encoders keep their own defaults and only get the thread count.
+    """
+    options = {'preset': None, 'threads': tier['threads'] or None}
+    if codec == 'libx264':
+        options['preset'] = tier['preset']
+        ffmpeg_params = ['-crf', str(tier['crf'])]
+        if tier['tune']:
+            ffmpeg_params += ['-tune', tier['tune']]
+        options['ffmpeg_params'] = ffmpeg_params
+    return options
+
+# Tiers from best to cheapest, the order load shedding walks through
+TIER_ORDER = ['hq', 'standard', 'preview']
+
+class AdaptiveTierSelector:
+    """
+    Picks a cheaper tier than the one requested while the render queue is
+    backed up.
+
+    Load is measured as the expected queue wait (queued renders per worker
+    times recent render time). Above `degrade_wait` seconds the selector
+    steps one tier down; below `recover_wait` it steps back up. Steps are at
+    least `hold_seconds` apart, so one slow or fast render doesn't make the
+    quality flap.
+    """
+
+    def __init__(self, degrade_wait=20.0, recover_wait=5.0, hold_seconds=15.0, enabled=True):
+        self.degrade_wait = degrade_wait
+        self.recover_wait = recover_wait
+        self.hold_seconds = hold_seconds
+        self.enabled = enabled
+        # How many tiers below the requested one renders currently get
+        self.level = 0
+        self._changed = 0.0
+        self._lock = threading.Lock()
+        self._last_wait = 0.0
+        self._chosen = {name: 0 for name in TIER_ORDER}
+        self._degraded = 0
+
+    def update(self, expected_wait):
+        """
+        Feeds in the current expected queue wait and adjusts the level.
+        """
+        with self._lock:
+            self._last_wait = expected_wait
+            now = time.monotonic()
+            if now - self._changed < self.hold_seconds:
+                return self.level
+            if expected_wait > self.degrade_wait and self.level < len(TIER_ORDER) - 1:
+                self.level += 1
+                self._changed = now
+            elif expected_wait < self.recover_wait and self.level > 0:
+                self.level -= 1
+                self._changed = now
+            return self.level
+
+    def choose(self, requested, expected_wait):
+        """
+        Returns the tier to render for a request that asked for `requested`,
+        given the current expected queue wait in seconds.
+        """
+        if not self.enabled:
+            return requested
+        level = self.update(expected_wait)
+        index = min(TIER_ORDER.index(requested) + level, len(TIER_ORDER) - 1)
+        chosen = TIER_ORDER[index]
+        with self._lock:
+            self._chosen[chosen] += 1
+            if chosen != requested:
+                self._degraded += 1
+        return chosen
+
+    def stats(self):
+        """
+        Returns a snapshot of the selector's state and counters.
+        """
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'level': self.level,
+                'expected_wait': round(self._last_wait, 2),
+                'degrade_wait': self.degrade_wait,
+                'recover_wait': self.recover_wait,
+                'chosen': dict(self._chosen),
+                'degraded': self._degraded,
+            }
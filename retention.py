@@ -0,0 +1,288 @@
+"""
+Retention of generated artifacts (rendered videos, uploads).
+
+Every artifact is recorded in a small SQLite index when it is produced,
+with its size, creation time, last access and render cache key. A
+background thread enforces an age limit, a total byte quota and free disk
+watermarks from that index, evicting least recently used artifacts first,
+so nothing ever lists or stats directories while serving requests.
+"""
+import os
+import shutil
+import sqlite3
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ArtifactIndex:
+    """
+    SQLite table of produced artifacts, keyed by path.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        # Other app processes share the file
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA busy_timeout=5000')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS artifacts ('
+            ' path TEXT PRIMARY KEY,'
+            ' kind TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' created REAL NOT NULL,'
+            ' last_access REAL NOT NULL,'
+            ' cache_key TEXT)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS artifacts_created ON artifacts (created)')
+
+    def add(self, path, kind, size, created=None, cache_key=None, replace=True):
+        """
+        Records an artifact. An earlier record of the same path is replaced,
+        or kept with replace=False.
+        """
+        created = created or time.time()
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO artifacts"
+                ' (path, kind, size, created, last_access, cache_key) VALUES (?, ?, ?, ?, ?, ?)',
+                (path, kind, size, created, created, cache_key))
+
+    def touch_many(self, accesses):
+        """
+        Records last access times, given as a {path: timestamp} dict.
+        """
+        if not accesses:
+            return
+        with self._lock:
+            self._db.executemany(
+                'UPDATE artifacts SET last_access = MAX(last_access, ?) WHERE path = ?',
+                [(timestamp, path) for path, timestamp in accesses.items()])
+
+    def remove(self, path):
+        with self._lock:
+            self._db.execute('DELETE FROM artifacts WHERE path = ?', (path,))
+
+    def total_size(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM artifacts').fetchone()[0]
+
+    def created_before(self, timestamp, limit=500):
+        """
+        Returns (path, size, cache_key) of artifacts created before timestamp.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT path, size, cache_key FROM artifacts WHERE created < ? ORDER BY created LIMIT ?',
+                (timestamp, limit)).fetchall()
+
+    def least_recently_used(self, limit=100):
+        """
+        Returns (path, size, cache_key) of the least recently accessed artifacts.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT path, size, cache_key FROM artifacts ORDER BY last_access LIMIT ?',
+                (limit,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class RetentionManager:
+    """
+    Background service that keeps the artifacts in an ArtifactIndex within
+    their limits:
+
+    - artifacts older than `max_age` seconds are deleted;
+    - while they take more than `max_bytes` in total, the least recently
+      used ones are deleted;
+    - while the disk under `disk_path` has less than `min_free_bytes` free,
+      least recently used artifacts are deleted until `target_free_bytes`
+      are free.
+
+    A limit of 0 (or None) is not enforced. `on_evict(path, cache_key)` is
+    called for every deleted artifact so in-memory indexes can forget it.
+    Accesses are buffered in memory and written to the index by the
+    background thread.
+    """
+
+    def __init__(self, index, max_bytes=0, max_age=0, disk_path='.', min_free_bytes=0,
+                 target_free_bytes=0, interval=60.0, on_evict=None):
+        self.index = index
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.disk_path = disk_path
+        self.min_free_bytes = min_free_bytes
+        self.target_free_bytes = max(target_free_bytes, min_free_bytes)
+        self.interval = interval
+        self.on_evict = on_evict
+        self._accesses = {}
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._evicted = {'age': 0, 'quota': 0, 'disk': 0}
+        self._evicted_bytes = 0
+        self._last_run = None
+
+    def start(self, adopt=()):
+        """
+        Starts the background thread (once). `adopt` lists (directory, kind)
+        pairs whose existing files the thread indexes before its first run.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, args=(adopt,), name='retention',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, adopt):
+        for directory, kind in adopt:
+            try:
+                adopted = self.adopt(directory, kind)
+                logger.info(f"Retention indexed {adopted} files in {directory}")
+            except OSError as e:
+                logger.error(f"Could not index {directory}: {str(e)}")
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Retention run failed: {str(e)}")
+
+    def add(self, path, kind, size, cache_key=None):
+        """
+        Records a newly produced artifact.
+        """
+        self.index.add(path, kind, size, cache_key=cache_key)
+
+    def touch(self, path):
+        """
+        Notes that an artifact was just used. Cheap: only the background
+        thread writes to the index.
+        """
+        with self._lock:
+            self._accesses[path] = time.time()
+
+    def adopt(self, directory, kind):
+        """
+        Records files under `directory` that aren't indexed yet, e.g. ones
+        written before the index existed. Walks the whole tree, so it is
+        meant for startup, not requests. Hidden (temporary) files are skipped.
+        """
+        adopted = 0
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                self.index.add(path, kind, st.st_size, created=st.st_mtime, replace=False)
+                adopted += 1
+        return adopted
+
+    def _delete(self, path, cache_key, reason):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete {path}: {str(e)}")
+            return False
+        self.index.remove(path)
+        if self.on_evict is not None:
+            self.on_evict(path, cache_key)
+        self._evicted[reason] += 1
+        return True
+
+    def _free_bytes(self):
+        return shutil.disk_usage(self.disk_path).free
+
+    def _evict_lru(self, reason, needed):
+        """
+        Deletes least recently used artifacts until `needed` bytes are freed.
+        Returns the number deleted.
+        """
+        deleted = freed = 0
+        while freed < needed:
+            progress = False
+            for path, size, key in self.index.least_recently_used():
+                if freed >= needed:
+                    break
+                if self._delete(path, key, reason):
+                    deleted += 1
+                    freed += size
+                    progress = True
+            if not progress:
+                # Nothing left, or nothing we are able to delete
+                logger.warning(f"Retention could not free {needed - freed} more bytes ({reason})")
+                break
+        self._evicted_bytes += freed
+        return deleted
+
+    def run_once(self):
+        """
+        Flushes buffered accesses and enforces the limits. Returns the number
+        of artifacts deleted.
+        """
+        with self._run_lock:
+            with self._lock:
+                accesses, self._accesses = self._accesses, {}
+            self.index.touch_many(accesses)
+            deleted = 0
+            now = time.time()
+
+            if self.max_age:
+                while True:
+                    expired = self.index.created_before(now - self.max_age)
+                    progress = False
+                    for path, size, key in expired:
+                        if self._delete(path, key, 'age'):
+                            deleted += 1
+                            self._evicted_bytes += size
+                            progress = True
+                    if not progress:
+                        break
+
+            if self.max_bytes:
+                excess = self.index.total_size() - self.max_bytes
+                if excess > 0:
+                    deleted += self._evict_lru('quota', excess)
+
+            if self.min_free_bytes:
+                free = self._free_bytes()
+                if free < self.min_free_bytes:
+                    deleted += self._evict_lru('disk', self.target_free_bytes - free)
+
+            self._last_run = now
+            if deleted:
+                logger.info(f"Retention deleted {deleted} artifacts")
+            return deleted
+
+    def stats(self):
+        """
+        Returns a snapshot of the index size, limits and eviction counters.
+        """
+        return {
+            'artifacts': self.index.count(),
+            'bytes': self.index.total_size(),
+            'max_bytes': self.max_bytes,
+            'max_age': self.max_age,
+            'free_bytes': self._free_bytes(),
+            'min_free_bytes': self.min_free_bytes,
+            'evicted': dict(self._evicted),
+            'evicted_bytes': self._evicted_bytes,
+            'last_run': self._last_run,
+        }
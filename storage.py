@@ -0,0 +1,270 @@
+"""
+Artifact storage backends.
+
+Artifacts (rendered videos, cached avatars, render cache records) are
+addressed by flat names; the backend decides where they live. Writes are
+atomic: a file is written under a temporary name and published with a
+rename, so a partial file is never visible under its name.
+
+- LocalStorage keeps files on this node's disk, spread over a two-level
+  hash-sharded tree (root/ab/cd/name) so no directory grows large and a
+  name maps to its path without listing anything.
+- SharedDirectoryStorage is the same layout on a directory every app node
+  mounts (NFS, EFS, ...), with the fsyncs needed for other nodes to see
+  complete files.
+
+Other backends (e.g. an object store) implement ArtifactStorage. Backends
+without local paths can only hold artifacts read and written as bytes.
+"""
+import os
+import abc
+import hashlib
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+class ArtifactStorage(abc.ABC):
+    """
+    Interface of an artifact storage backend. Backends must implement
+    publish(), get_bytes(), put_bytes() and delete().
+    """
+
+    def path_for(self, name):
+        """
+        Returns the local path an artifact is published at, or None if the
+        backend has no local paths.
+        """
+        return None
+
+    def locate(self, name):
+        """
+        Returns the local path of an existing artifact, or None.
+        """
+        return None
+
+    def temp_path(self, name):
+        """
+        Returns a local path to write an artifact to before publish().
+        """
+        return os.path.join(tempfile.gettempdir(), f'.{uuid.uuid4().hex}.{name}')
+
+    @abc.abstractmethod
+    def publish(self, temp_path, name):
+        """
+        Atomically publishes a finished local file as an artifact (the
+        temporary file is consumed). Returns its local path, if any.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_bytes(self, name, max_age=None):
+        """
+        Returns the contents of an artifact, or None if it doesn't exist or
+        was written more than max_age seconds ago.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put_bytes(self, name, data):
+        """
+        Atomically writes an artifact.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, name):
+        """
+        Deletes an artifact if it exists.
+        """
+        raise NotImplementedError
+
+    def iter_files(self):
+        """
+        Yields the local paths of all artifacts (for maintenance, not requests).
+        """
+        return iter(())
+
+    def stats(self):
+        return {}
+
+class LocalStorage(ArtifactStorage):
+    """
+    Hash-sharded tree of files under `root`. Files written before sharding
+    (directly in root) are still found. Up to `read_cache_bytes` of recently
+    read small artifacts are kept in memory. `on_put(path, size)` is called
+    for every artifact written with put_bytes(), e.g. to register it with
+    retention.
+    """
+
+    def __init__(self, root, read_cache_bytes=8 * 1024 * 1024, on_put=None):
+        self.root = root
+        self.on_put = on_put
+        os.makedirs(root, exist_ok=True)
+        self.read_cache_bytes = read_cache_bytes
+        # name -> (data, mtime)
+        self._read_cache = OrderedDict()
+        self._read_cache_size = 0
+        self._lock = threading.Lock()
+        self._reads = 0
+        self._cached_reads = 0
+
+    def path_for(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], name)
+
+    def locate(self, name):
+        """
+        Returns the path of an existing file, or None. Costs at most two stats.
+        """
+        if os.path.basename(name) != name or name.startswith('.'):
+            return None
+        path = self.path_for(name)
+        if os.path.isfile(path):
+            return path
+        legacy = os.path.join(self.root, name)
+        if os.path.isfile(legacy):
+            return legacy
+        return None
+
+    def _cache(self, name, data, mtime):
+        if len(data) > self.read_cache_bytes // 8:
+            return
+        with self._lock:
+            old = self._read_cache.pop(name, None)
+            if old is not None:
+                self._read_cache_size -= len(old[0])
+            self._read_cache[name] = (data, mtime)
+            self._read_cache_size += len(data)
+            while self._read_cache_size > self.read_cache_bytes:
+                _, (evicted, _) = self._read_cache.popitem(last=False)
+                self._read_cache_size -= len(evicted)
+
+    def _uncache(self, name):
+        with self._lock:
+            old = self._read_cache.pop(name, None)
+            if old is not None:
+                self._read_cache_size -= len(old[0])
+
+    def get_bytes(self, name, max_age=None):
+        with self._lock:
+            self._reads += 1
+            cached = self._read_cache.get(name)
+            if cached is not None:
+                self._read_cache.move_to_end(name)
+        if cached is not None:
+            data, mtime = cached
+            if max_age is None or time.time() - mtime <= max_age:
+                with self._lock:
+                    self._cached_reads += 1
+                return data
+        path = self.locate(name)
+        if path is None:
+            self._uncache(name)
+            return None
+        try:
+            mtime = os.stat(path).st_mtime
+            if max_age is not None and time.time() - mtime > max_age:
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._cache(name, data, mtime)
+        return data
+
+    def temp_path(self, name):
+        # Next to the final path, so publishing is a rename within one filesystem
+        path = self.path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return temp_path_for(path)
+
+    def put_bytes(self, name, data):
+        temp_path = self.temp_path(name)
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            path = self.publish(temp_path, name)
+        except Exception:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        self._cache(name, data, time.time())
+        if self.on_put is not None:
+            self.on_put(path, len(data))
+        return path
+
+    def publish(self, temp_path, name):
+        path = self.path_for(name)
+        os.replace(temp_path, path)
+        return path
+
+    def delete(self, name):
+        self._uncache(name)
+        path = self.locate(name)
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def iter_files(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not name.startswith('.'):
+                    yield os.path.join(directory, name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': type(self).__name__,
+                'root': self.root,
+                'reads': self._reads,
+                'cached_reads': self._cached_reads,
+                'read_cache_bytes': self._read_cache_size,
+            }
+
+class SharedDirectoryStorage(LocalStorage):
+    """
+    LocalStorage on a directory shared by all app nodes. Files are fsynced
+    before they are renamed into place, and the directory after, so other
+    nodes never see a published name with incomplete contents.
+    """
+
+    def publish(self, temp_path, name):
+        path = self.path_for(name)
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return path
+
+STORAGE_BACKENDS = {
+    'local': LocalStorage,
+    'shared': SharedDirectoryStorage,
+}
+
+def make_storage(backend, root, **kwargs):
+    """
+    Creates a storage backend by name ('local' or 'shared').
+    """
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend '{backend}', expected one of: {', '.join(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[backend](root, **kwargs)
+
+def temp_path_for(path):
+    """
+    Returns a hidden temporary name in the same directory as `path`, so
+    publishing it is a rename within one filesystem. The extension is kept
+    for tools (like ffmpeg) that pick the format from it.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{uuid.uuid4().hex}.{name}')
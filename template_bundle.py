@@ -0,0 +1,173 @@
+"""
+Precompiled template bundles.
+
+Everything a frame needs that doesn't depend on the profile (the template
+layers, the composited plates of pepe_slash.template_plates() and the saw
+at every angle of the cutting phase) is baked once per tier into a
+directory of .npy files, with a per-frame table saying which saw sprite
+goes where. Render workers memory-map the arrays read-only, so they share
+one copy through the page cache and start without decoding, resizing or
+compositing anything.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+from PIL import Image
+
+from render_tiers import RENDER_TIERS, DEFAULT_TIER, get_tier, rotate_filter, tier_scale
+from storage import temp_path_for
+
+logger = logging.getLogger(__name__)
+
+# Bump when the bundle layout or anything baked into it changes
+BUNDLE_VERSION = 1
+
+# One row per frame: index of the saw sprite (-1 outside the cutting
+# phase) and the offset of its top left corner from the profile's center
+SAW_FRAME_DTYPE = np.dtype([('sprite', '<i2'), ('x', '<i4'), ('y', '<i4')])
+
+LAYERS = ('background', 'pepe_img', 'saw_img')
+PLATES = ('base', 'intro', 'split')
+
+def bundle_key(pepe_image_path, saw_path, tier, duration=5.0):
+    """
+    Hash of everything a bundle is compiled from: the template images, the
+    tier settings and the frame count.
+    """
+    tier = get_tier(tier)
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': BUNDLE_VERSION, 'tier': tier,
+                              'frames': int(duration * tier['fps'])}, sort_keys=True).encode())
+    for path in (pepe_image_path, saw_path):
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        else:
+            digest.update(b'-')
+    return digest.hexdigest()
+
+def compile_template(pepe_image_path, path, saw_path='saww.jpg', tier=None, duration=5.0):
+    """
+    Compiles the template of a tier into a bundle directory at `path`
+    (written under a temporary name and renamed into place).
+    """
+    from pepe_slash import load_template, template_plates, saw_transform
+
+    tier_name = tier
+    tier = get_tier(tier)
+    canvas_size = tier['canvas_size']
+    total_frames = int(duration * tier['fps'])
+    template = load_template(pepe_image_path, saw_path=saw_path, tier=tier)
+    plates = template_plates(template, canvas_size)
+
+    # The saw is rotated to the same angles in every render; rotate each
+    # angle once and pack the sprites into one array
+    saw_img = template['saw_img']
+    saw_frames = np.full(total_frames, -1, dtype=SAW_FRAME_DTYPE)
+    sprites, sprite_index, offset = [], [], 0
+    angles = {}
+    if saw_img is not None:
+        rotate_resample = rotate_filter(tier)
+        for i in range(total_frames):
+            progress = i / total_frames
+            if not 0.4 <= progress < 0.6:
+                continue
+            angle, sway, drop = saw_transform((progress - 0.4) / 0.2, tier_scale(tier))
+            if angle not in angles:
+                sprite = np.asarray(saw_img.rotate(angle, rotate_resample, expand=True))
+                angles[angle] = len(sprites)
+                sprites.append(sprite.reshape(-1))
+                sprite_index.append((offset, sprite.shape[0], sprite.shape[1]))
+                offset += sprite.size
+            saw_frames[i] = (angles[angle], sway - saw_img.size[0] // 2, drop - saw_img.size[1] // 2)
+
+    temp_path = temp_path_for(path)
+    os.makedirs(temp_path)
+    try:
+        for name in LAYERS:
+            if template[name] is not None:
+                np.save(os.path.join(temp_path, f'{name}.npy'), np.asarray(template[name]))
+        for name in PLATES:
+            np.save(os.path.join(temp_path, f'plate_{name}.npy'), plates[name])
+        np.save(os.path.join(temp_path, 'saw_frames.npy'), saw_frames)
+        np.save(os.path.join(temp_path, 'saw_sprites.npy'),
+                np.concatenate(sprites) if sprites else np.empty(0, dtype=np.uint8))
+        np.save(os.path.join(temp_path, 'saw_index.npy'),
+                np.array(sprite_index, dtype=np.int64).reshape(-1, 3))
+        with open(os.path.join(temp_path, 'bundle.json'), 'w') as f:
+            json.dump({
+                'version': BUNDLE_VERSION,
+                'tier': tier_name,
+                'canvas_size': list(canvas_size),
+                'total_frames': total_frames,
+                'bg_pos': list(template['bg_pos']),
+                'pepe_pos': list(template['pepe_pos']),
+            }, f)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Another process published the same bundle first
+            if not os.path.exists(os.path.join(path, 'bundle.json')):
+                raise
+            shutil.rmtree(temp_path, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    return path
+
+def ensure_template_bundle(pepe_image_path, bundle_dir, saw_path='saww.jpg', tier=None, duration=5.0):
+    """
+    Returns the path of the bundle for this template and tier under
+    bundle_dir, compiling it first if the template changed or it doesn't
+    exist yet.
+    """
+    key = bundle_key(pepe_image_path, saw_path, tier, duration)
+    path = os.path.join(bundle_dir, f'{tier or DEFAULT_TIER}-{key[:16]}')
+    if not os.path.exists(os.path.join(path, 'bundle.json')):
+        os.makedirs(bundle_dir, exist_ok=True)
+        logger.info(f"Compiling template bundle {path}")
+        compile_template(pepe_image_path, path, saw_path=saw_path, tier=tier, duration=duration)
+    return path
+
+def load_template_bundle(path):
+    """
+    Maps a compiled bundle read-only and returns it as a template for
+    pepe_slash (like load_template(), plus its plates and saw table). The
+    images share the mapped memory; nothing is copied.
+    """
+    with open(os.path.join(path, 'bundle.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != BUNDLE_VERSION:
+        raise ValueError(f"Template bundle {path} has version {meta['version']}, expected {BUNDLE_VERSION}")
+
+    def load(name):
+        return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+    template = {
+        'bg_pos': tuple(meta['bg_pos']),
+        'pepe_pos': tuple(meta['pepe_pos']),
+    }
+    for name in LAYERS:
+        if os.path.exists(os.path.join(path, f'{name}.npy')):
+            template[name] = Image.fromarray(load(name), 'RGBA')
+        else:
+            template[name] = None
+    plates = {'size': tuple(meta['canvas_size'])}
+    for name in PLATES:
+        plates[name] = load(f'plate_{name}')
+    template['plates'] = plates
+    atlas = load('saw_sprites')
+    template['saw_sprites'] = [atlas[offset:offset + height * width * 4].reshape(height, width, 4)
+                               for offset, height, width in load('saw_index')]
+    template['saw_frames'] = load('saw_frames')
+    return template
+
+def ensure_template_bundles(pepe_image_path, bundle_dir, saw_path='saww.jpg', duration=5.0):
+    """Compiles (if needed) the bundles of every tier; returns tier -> path"""
+    return {name: ensure_template_bundle(pepe_image_path, bundle_dir, saw_path=saw_path, tier=name,
+                                         duration=duration)
+            for name in RENDER_TIERS}
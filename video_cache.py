@@ -0,0 +1,83 @@
+"""
+Size-bounded in-memory LRU of video bytes.
+
+Fresh renders get most of their views in the first minutes, so their bytes
+are kept in memory straight from the render result, and videos read from
+disk are kept after their first view. The disk stays the durable copy.
+"""
+import threading
+from collections import OrderedDict
+
+class VideoMemoryCache:
+    """
+    Least-recently-used map of video file names to their bytes, holding at
+    most `max_bytes` in total. Files over `max_item_bytes` are not kept.
+    A max_bytes of 0 disables the cache.
+    """
+
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def accepts(self, size):
+        """Whether a file of this size would be kept"""
+        return 0 < size <= min(self.max_item_bytes, self.max_bytes)
+
+    def put(self, filename, data):
+        """
+        Keeps a video's bytes, evicting the least recently used ones as needed.
+        """
+        if not self.accepts(len(data)):
+            return
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[filename] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._evictions += 1
+
+    def get(self, filename):
+        """
+        Returns a video's bytes, or None if they aren't in memory.
+        """
+        with self._lock:
+            data = self._entries.get(filename)
+            if data is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(filename)
+            self._hits += 1
+            return data
+
+    def discard(self, filename):
+        """
+        Drops a video (e.g. after its file was deleted).
+        """
+        with self._lock:
+            data = self._entries.pop(filename, None)
+            if data is not None:
+                self._bytes -= len(data)
+
+    def stats(self):
+        """
+        Returns a snapshot of the cache's size and counters.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+            }
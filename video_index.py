@@ -0,0 +1,81 @@
+"""
+In-memory index of published videos and their HTTP validators.
+
+Rendered files get a unique name and never change once written, so their
+ETag (a content hash) and size are worked out once when the render
+finishes. Conditional requests are then answered from this index without
+touching the filesystem.
+"""
+import os
+import threading
+
+from render_cache import file_digest
+
+class VideoIndex:
+    """
+    Maps video file names in `store` (a storage backend) to their
+    path, ETag, size and modification time.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._indexed = 0
+        self._scanned = 0
+
+    def add(self, path, etag=None, size=None, mtime=None):
+        """
+        Records a finished video. Whatever the caller doesn't already know
+        (e.g. from the render worker) is read from the file.
+        """
+        if size is None or mtime is None:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        if etag is None:
+            etag = file_digest(path)
+        entry = {'path': path, 'etag': etag, 'size': size, 'mtime': mtime}
+        with self._lock:
+            self._entries[os.path.basename(path)] = entry
+            self._indexed += 1
+        return entry
+
+    def get(self, filename):
+        """
+        Returns the entry of a video, or None if it isn't indexed.
+        """
+        with self._lock:
+            return self._entries.get(filename)
+
+    def lookup(self, filename):
+        """
+        Returns the entry of a video, indexing it from disk if it was
+        written before this process started. Returns None for unknown files.
+        """
+        entry = self.get(filename)
+        if entry is not None:
+            return entry
+        path = self.store.locate(filename)
+        if path is None:
+            return None
+        with self._lock:
+            self._scanned += 1
+        return self.add(path)
+
+    def discard(self, filename):
+        """
+        Forgets a video (e.g. after its file was deleted).
+        """
+        with self._lock:
+            self._entries.pop(filename, None)
+
+    def stats(self):
+        """
+        Returns a snapshot of the index's counters.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'indexed': self._indexed,
+                'indexed_from_disk': self._scanned,
+            }